@@ -1,10 +1,10 @@
 import os
 import configparser
 
-def load_config():
+def load_config(path='config.ini'):
     config = configparser.ConfigParser()
     config.optionxform = str
-    config.read('config.ini')
+    config.read(path)
 
     for (dll_name, dll_filename) in config.items('kinesis.dlls'):
         globals()[dll_name+'_fullpath'] = os.path.join(config['kinesis.folder']['root'], dll_filename)
@@ -21,6 +21,15 @@ def load_config():
 
     globals()['analyzer_start_position'] = float(config['kinesis.analyzer_initialization']['analyzer_start_position'])
 
+    globals()['analyzer_measurement_velocity_in_deg_per_s'] = float(config['kinesis.analyzer_motion']['measurement_velocity_in_deg_per_s'])
+    globals()['analyzer_measurement_acceleration_in_deg_per_s2'] = float(config['kinesis.analyzer_motion']['measurement_acceleration_in_deg_per_s2'])
+    globals()['analyzer_auto_size_capture'] = config['kinesis.analyzer_motion'].getboolean('auto_size_capture')
+    globals()['analyzer_capture_margin'] = float(config['kinesis.analyzer_motion']['capture_margin'])
+    globals()['analyzer_velocity_search_min_in_deg_per_s'] = float(config['kinesis.analyzer_motion']['velocity_search_min_in_deg_per_s'])
+    globals()['analyzer_velocity_search_max_in_deg_per_s'] = float(config['kinesis.analyzer_motion']['velocity_search_max_in_deg_per_s'])
+    globals()['analyzer_velocity_search_tolerance_in_deg_per_s'] = float(config['kinesis.analyzer_motion']['velocity_search_tolerance_in_deg_per_s'])
+    globals()['analyzer_velocity_search_repetitions'] = int(config['kinesis.analyzer_motion']['velocity_search_repetitions'])
+
     globals()['trigger_out_cycle_count'] = int(config['kinesis.trigger_out_settings']['trigger_out_cycle_count'])
     globals()['trigger_out_trigger_count'] = int(config['kinesis.trigger_out_settings']['trigger_out_trigger_count'])
     globals()['trigger_out_interval_in_deg'] = float(config['kinesis.trigger_out_settings']['trigger_out_interval_in_deg'])
@@ -38,8 +47,35 @@ def load_config():
     globals()['ai_timeout_in_seconds'] = float(config['nidaqmx.timmings']['ai_timeout_in_seconds'])
     globals()['nidaqmx_calibration_duration_in_seconds'] = float(config['nidaqmx.timmings']['calibration_duration_in_seconds'])
 
+    globals()['nidaqmx_calibration_target_standard_error_in_volts'] = float(config['nidaqmx.calibration']['target_standard_error_in_volts'])
+    globals()['nidaqmx_calibration_chunk_duration_in_seconds'] = float(config['nidaqmx.calibration']['chunk_duration_in_seconds'])
+    globals()['nidaqmx_calibration_expiry_in_hours'] = float(config['nidaqmx.calibration']['expiry_in_hours'])
+    globals()['nidaqmx_calibration_file'] = config['nidaqmx.calibration']['calibration_file']
+
+    globals()['nidaqmx_autotune_enabled'] = config['nidaqmx.autotune'].getboolean('enabled')
+    globals()['nidaqmx_autotune_safety_factor'] = float(config['nidaqmx.autotune']['safety_factor'])
+    globals()['nidaqmx_autotune_timeout_margin_in_seconds'] = float(config['nidaqmx.autotune']['timeout_margin_in_seconds'])
+    globals()['nidaqmx_autotune_min_samples'] = int(config['nidaqmx.autotune']['min_samples'])
+    globals()['nidaqmx_autotune_history_length'] = int(config['nidaqmx.autotune']['history_length'])
+    globals()['nidaqmx_autotune_file'] = config['nidaqmx.autotune']['tuning_file']
+
+    globals()['nidaqmx_acquisition_mode'] = config['nidaqmx.acquisition_settings']['acquisition_mode']
     globals()['nidaqmx_number_of_samples_averaged_per_trigger'] = int(config['nidaqmx.acquisition_settings']['number_of_samples_averaged_per_trigger'])
 
+    globals()['nidaqmx_trigger_low_threshold_in_volts'] = float(config['nidaqmx.trigger_detection']['low_threshold_in_volts'])
+    globals()['nidaqmx_trigger_high_threshold_in_volts'] = float(config['nidaqmx.trigger_detection']['high_threshold_in_volts'])
+    globals()['nidaqmx_trigger_reconstruct_missing'] = config['nidaqmx.trigger_detection'].getboolean('reconstruct_missing')
+
+    globals()['fast_mode_enabled'] = config['analyzer.fast_mode'].getboolean('enabled')
+    globals()['fast_mode_number_of_angles'] = int(config['analyzer.fast_mode']['number_of_angles'])
+    globals()['fast_mode_repeats'] = int(config['analyzer.fast_mode']['repeats'])
+    globals()['fast_mode_samples_per_angle'] = int(config['analyzer.fast_mode']['samples_per_angle'])
+
+    globals()['adaptive_averaging_enabled'] = config['analyzer.adaptive_averaging'].getboolean('enabled')
+    globals()['adaptive_averaging_target_ellipticity_std'] = float(config['analyzer.adaptive_averaging']['target_ellipticity_std'])
+    globals()['adaptive_averaging_min_revolutions'] = int(config['analyzer.adaptive_averaging']['min_revolutions'])
+    globals()['adaptive_averaging_max_revolutions'] = int(config['analyzer.adaptive_averaging']['max_revolutions'])
+
     globals()['detector_max_intensity'] = float(config['detector']['max_intensity'])
 
     globals()['powermeter_resource'] = config['powermeter']['resource']
@@ -59,6 +95,40 @@ def load_config():
     globals()['hwp_mapping_steps'] = int(config['mapping.settings']['hwp_mapping_steps'])
     globals()['qwp_mapping_steps'] = int(config['mapping.settings']['qwp_mapping_steps'])
 
+    globals()['hwp_sweep_start_in_deg'] = float(config['mapping.hwp_sweep']['start_in_deg'])
+    globals()['hwp_sweep_stop_in_deg'] = float(config['mapping.hwp_sweep']['stop_in_deg'])
+    globals()['hwp_sweep_velocity_in_deg_per_s'] = float(config['mapping.hwp_sweep']['velocity_in_deg_per_s'])
+    globals()['hwp_sweep_bin_width_in_deg'] = float(config['mapping.hwp_sweep']['bin_width_in_deg'])
+
+    globals()['optimal_design_number_of_points'] = int(config['mapping.optimal_design']['number_of_points'])
+    globals()['optimal_design_hwp_candidate_step_in_deg'] = float(config['mapping.optimal_design']['hwp_candidate_step_in_deg'])
+    globals()['optimal_design_qwp_candidate_step_in_deg'] = float(config['mapping.optimal_design']['qwp_candidate_step_in_deg'])
+    globals()['optimal_design_noise_std'] = float(config['mapping.optimal_design']['noise_std'])
+
+    globals()['mapping_quality_max_missed_triggers'] = int(config['mapping.quality']['max_missed_triggers'])
+    globals()['mapping_quality_max_nrmse'] = float(config['mapping.quality']['max_nrmse'])
+    globals()['mapping_quality_retry_mode'] = config['mapping.quality']['retry_mode']
+    globals()['mapping_quality_max_retries_per_point'] = int(config['mapping.quality']['max_retries_per_point'])
+    globals()['mapping_quality_retry_budget'] = int(config['mapping.quality']['retry_budget'])
+
+    globals()['time_lapse_duration_in_minutes'] = float(config['time_lapse.settings']['duration_in_minutes'])
+    globals()['time_lapse_interval_in_seconds'] = float(config['time_lapse.settings']['interval_in_seconds'])
+
+    globals()['closed_loop_search_half_width_in_deg'] = float(config['compensation.closed_loop']['search_half_width_in_deg'])
+    globals()['closed_loop_tolerance_in_deg'] = float(config['compensation.closed_loop']['tolerance_in_deg'])
+    globals()['closed_loop_target_ellipticity'] = float(config['compensation.closed_loop']['target_ellipticity'])
+    globals()['closed_loop_max_evaluations'] = int(config['compensation.closed_loop']['max_evaluations'])
+    globals()['closed_loop_hwp_step_in_deg'] = float(config['compensation.closed_loop']['hwp_step_in_deg'])
+
+    globals()['session_mode'] = config['hardware.session']['mode']
+    globals()['session_folder'] = config['hardware.session']['folder']
+    globals()['session_replay_speed'] = float(config['hardware.session']['replay_speed'])
+
+    globals()['live_analysis_enabled'] = config['analysis.live'].getboolean('enabled')
+    globals()['live_analysis_catch_up'] = config['analysis.live'].getboolean('catch_up')
+    globals()['live_analysis_system_fit_starts'] = int(config['analysis.live']['system_fit_starts'])
+    globals()['live_analysis_chunked_system_fit'] = config['analysis.live'].getboolean('chunked_system_fit')
+
     globals()['experiment_folder'] = config['app.folders']['experiment_folder']
 
 if __name__ == '__main__':
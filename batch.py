@@ -0,0 +1,282 @@
+import CONFIG
+CONFIG.load_config()
+
+import argparse
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from experiments.AcquisitionService import AcquisitionService
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Run acquisitions without the user interface.')
+    parser.add_argument('--detector', default='Photodiode', choices=['Photodiode', 'Powermeter'])
+    parser.add_argument('--polarimeter-only', action='store_true')
+    parser.add_argument('--folder', default=CONFIG.experiment_folder)
+    parser.add_argument('--profile', action='store_true', help='write a cProfile capture of each measurement or experiment')
+    parser.add_argument('--fast', action='store_true', help='fast polarimetry at the [analyzer.fast_mode] angles')
+    parser.add_argument('--adaptive', action='store_true', help='average measurements until the [analyzer.adaptive_averaging] target uncertainty')
+
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    snap_parser = subparsers.add_parser('snap', help='acquire a single measurement')
+    snap_parser.add_argument('--path', default=None)
+
+    subparsers.add_parser('calibrate', help='measure the photodiode dark offset')
+
+    hwp_mapping_parser = subparsers.add_parser('hwp-mapping', help='polarization mapping with the HWP')
+    hwp_mapping_parser.add_argument('--hwp-steps', type=int, default=CONFIG.hwp_mapping_steps)
+
+    hqwp_mapping_parser = subparsers.add_parser('hqwp-mapping', help='polarization mapping with the HWP and QWP')
+    hqwp_mapping_parser.add_argument('--hwp-steps', type=int, default=CONFIG.hwp_mapping_steps)
+    hqwp_mapping_parser.add_argument('--qwp-steps', type=int, default=CONFIG.qwp_mapping_steps)
+
+    optimal_design_parser = subparsers.add_parser('optimal-design', help='sparse HQWP mapping at the D-optimal cells for a prior estimate')
+    optimal_design_parser.add_argument('prior_filepath', help='system_parameters.json of a previous map')
+    optimal_design_parser.add_argument('--points', type=int, default=CONFIG.optimal_design_number_of_points)
+
+    hwp_sweep_parser = subparsers.add_parser('hwp-sweep', help='polarization mapping with a continuous HWP sweep')
+    hwp_sweep_parser.add_argument('--start', type=float, default=CONFIG.hwp_sweep_start_in_deg, help='start HWP angle in degrees')
+    hwp_sweep_parser.add_argument('--stop', type=float, default=CONFIG.hwp_sweep_stop_in_deg, help='stop HWP angle in degrees')
+    hwp_sweep_parser.add_argument('--velocity', type=float, default=CONFIG.hwp_sweep_velocity_in_deg_per_s, help='HWP velocity in deg/s')
+    hwp_sweep_parser.add_argument('--bin-width', type=float, default=CONFIG.hwp_sweep_bin_width_in_deg, help='HWP bin width in degrees')
+
+    compensation_test_parser = subparsers.add_parser('compensation-test', help='replay a compensation file')
+    compensation_test_parser.add_argument('compensation_filepath')
+
+    closed_loop_parser = subparsers.add_parser('closed-loop', help='closed-loop compensation from a compensation file')
+    closed_loop_parser.add_argument('compensation_filepath')
+    closed_loop_parser.add_argument('--hwp', type=float, nargs='*', default=None, help='target HWP angles, defaults to those of the file')
+    closed_loop_parser.add_argument('--optimize-hwp', action='store_true', help='also move the HWP (Nelder-Mead instead of a QWP line search)')
+
+    time_lapse_parser = subparsers.add_parser('time-lapse', help='fixed-cadence time lapse')
+    time_lapse_parser.add_argument('--duration', type=float, default=CONFIG.time_lapse_duration_in_minutes, help='duration in minutes')
+    time_lapse_parser.add_argument('--interval', type=float, default=CONFIG.time_lapse_interval_in_seconds, help='interval in seconds')
+
+    resume_parser = subparsers.add_parser('resume', help='resume an interrupted mapping')
+    resume_parser.add_argument('mapping_folder')
+
+    subparsers.add_parser('velocity-search', help='search the fastest analyzer velocity that still yields clean triggers')
+
+    campaign_parser = subparsers.add_parser('campaign', help='run a JSON list of {"name": ..., "parameters": {...}} jobs')
+    campaign_parser.add_argument('campaign_filepath')
+
+    catalog_parser = subparsers.add_parser('catalog', help='index the data folder and list the matching runs')
+    catalog_parser.add_argument('--database', default=None, help='defaults to catalog.sqlite in the data folder')
+    catalog_parser.add_argument('--no-scan', action='store_true', help='query the existing index without rescanning')
+    catalog_parser.add_argument('--type', default=None, help='run type, e.g. HQWP_mapping')
+    catalog_parser.add_argument('--catalog-detector', default=None, choices=['photodiode', 'powermeter'])
+    catalog_parser.add_argument('--since', type=datetime.fromisoformat, default=None, help='ISO date, e.g. 2025-09-01')
+    catalog_parser.add_argument('--until', type=datetime.fromisoformat, default=None, help='ISO date, e.g. 2025-10-01')
+    catalog_parser.add_argument('--complete', action='store_true', help='only completed mappings')
+
+    drift_parser = subparsers.add_parser('drift', help='fit the system parameters of a chronological series of HQWP maps')
+    drift_parser.add_argument('map_folders', nargs='*', help='defaults to every HQWP map in the catalog of the data folder')
+    drift_parser.add_argument('--output', default=None, help='defaults to system_drift.csv in the data folder')
+    drift_parser.add_argument('--starts', type=int, default=16, help='number of starts of the first, cold fit')
+    drift_parser.add_argument('--chunked', action='store_true', help='fit each map out of core, for dense maps')
+
+    orchestrate_parser = subparsers.add_parser('orchestrate', help='run a campaign across several setups, each in its own process')
+    orchestrate_parser.add_argument('campaign_filepath', help='JSON list of jobs, each with an optional "setup", otherwise sent to the least busy setup')
+    orchestrate_parser.add_argument('--setup', action='append', required=True, metavar='NAME=CONFIG', help='setup name and its config file, repeated per setup')
+
+    analyze_parser = subparsers.add_parser('analyze', help='watch the data folder and fit each new measurement and completed map')
+    analyze_parser.add_argument('--catch-up', action='store_true', default=CONFIG.live_analysis_catch_up, help='also analyze the files already in the folder')
+    analyze_parser.add_argument('--chunked', action='store_true', default=CONFIG.live_analysis_chunked_system_fit, help='fit completed maps out of core, for dense maps')
+
+    serve_parser = subparsers.add_parser('serve', help='serve the HTTP/JSON API without the user interface')
+    serve_parser.add_argument('--port', type=int, default=8080)
+
+    return parser.parse_args()
+
+def campaign_jobs(arguments):
+    match arguments.command:
+        case 'hwp-mapping':
+            return [('HWP mapping', {'root_folder': arguments.folder, 'hwp_mapping_steps': arguments.hwp_steps})]
+        case 'hqwp-mapping':
+            return [('HWP and QWP mapping', {'root_folder': arguments.folder, 'hwp_mapping_steps': arguments.hwp_steps, 'qwp_mapping_steps': arguments.qwp_steps})]
+        case 'optimal-design':
+            return [('Optimal HQWP design', {'root_folder': arguments.folder, 'prior_filepath': arguments.prior_filepath, 'number_of_points': arguments.points})]
+        case 'hwp-sweep':
+            return [('HWP sweep', {'root_folder': arguments.folder, 'start_in_deg': arguments.start, 'stop_in_deg': arguments.stop, 'velocity_in_deg_per_s': arguments.velocity, 'bin_width_in_deg': arguments.bin_width})]
+        case 'compensation-test':
+            return [('Compensation test', {'root_folder': arguments.folder, 'compensation_filepath': arguments.compensation_filepath})]
+        case 'closed-loop':
+            return [('Closed-loop compensation', {'root_folder': arguments.folder, 'compensation_filepath': arguments.compensation_filepath, 'hwp_angles': arguments.hwp, 'optimize_hwp': arguments.optimize_hwp})]
+        case 'time-lapse':
+            return [('Time lapse', {'root_folder': arguments.folder, 'duration_minutes': arguments.duration, 'interval_in_seconds': arguments.interval})]
+        case 'resume':
+            return [('Resume mapping', {'folder': arguments.mapping_folder})]
+        case 'velocity-search':
+            return [('Analyzer velocity search', {})]
+        case 'campaign':
+            with open(arguments.campaign_filepath, 'r') as file:
+                campaign = json.load(file)
+
+            jobs = []
+            for job in campaign:
+                parameters = job.get('parameters', {})
+                if job['name'] not in ('Resume mapping', 'Analyzer velocity search'):
+                    parameters.setdefault('root_folder', arguments.folder)
+                jobs.extend([(job['name'], parameters)] * job.get('repeat', 1))
+
+            return jobs
+
+def wait_for_queue(service):
+    last_report = 0
+    while service.experiment_queue.is_busy():
+        time.sleep(0.5)
+
+        current_job = service.experiment_queue.current_job
+        if current_job is not None and time.monotonic() - last_report > 30:
+            print(f"Job {current_job.job_id} ({current_job.name}): {100*service.progress:.1f}%")
+            last_report = time.monotonic()
+
+def serve(service, port):
+    from nicegui import app, ui
+    from experiments.HttpApi import register_routes
+
+    register_routes(app, service)
+    ui.run(port=port, title='Polarization Control API', show=False, reload=False)
+
+def catalog(arguments):
+    from experiments.DataCatalog import DataCatalog
+
+    with DataCatalog(arguments.folder, arguments.database) as data_catalog:
+        if not arguments.no_scan:
+            print(json.dumps(data_catalog.scan()))
+
+        since = arguments.since.replace(tzinfo=timezone.utc) if arguments.since is not None else None
+        until = arguments.until.replace(tzinfo=timezone.utc) if arguments.until is not None else None
+        for run in data_catalog.runs(arguments.type, arguments.catalog_detector, since, until, True if arguments.complete else None):
+            print(data_catalog.describe(run))
+
+def drift(arguments):
+    from processing.drift import track_drift
+
+    map_folders = arguments.map_folders
+    if not map_folders:
+        from experiments.DataCatalog import DataCatalog
+
+        with DataCatalog(arguments.folder) as data_catalog:
+            data_catalog.scan()
+            runs = [run for run in data_catalog.runs('HQWP_mapping') if run['complete'] != 0]
+        map_folders = [os.path.join(arguments.folder, run['folder']) for run in runs]
+
+    output = arguments.output or os.path.join(arguments.folder, 'system_drift.csv')
+    rows = track_drift(map_folders, output, max_intensity=CONFIG.detector_max_intensity, number_of_starts=arguments.starts, chunked=arguments.chunked)
+    print(f"{len(rows)} maps in {output}")
+
+def analyze(arguments):
+    from experiments.AnalysisService import AnalysisService
+
+    analysis_service = AnalysisService(arguments.folder, max_intensity=CONFIG.detector_max_intensity, number_of_starts=CONFIG.live_analysis_system_fit_starts, catch_up=arguments.catch_up, chunked=arguments.chunked)
+    print(f"Watching {analysis_service.root_folder}")
+    analysis_service.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        analysis_service.stop()
+
+def orchestrate(arguments):
+    from experiments.Orchestrator import Orchestrator
+
+    setups = dict(setup.split('=', 1) for setup in arguments.setup)
+    with open(arguments.campaign_filepath, 'r') as file:
+        campaign = json.load(file)
+
+    def save_latest_measurement(setup, measurement_data, analog_data, parameters):
+        # The workers save their runs, the parent keeps the latest measurement of each setup for monitoring.
+        path = os.path.join(arguments.folder, f'{setup}_latest.npz')
+        np.savez(path + '.tmp.npz', measurement_data=measurement_data, analog_data=analog_data, parameters=json.dumps(parameters))
+        os.replace(path + '.tmp.npz', path)
+        print(f"{setup}: ellipticity {parameters['ellipticity']:.4f}, alpha_max {parameters['alpha_max']:.2f}, NRMSE {parameters['nrmse']:.3g}")
+
+    os.makedirs(arguments.folder, exist_ok=True)
+    orchestrator = Orchestrator(setups)
+    orchestrator.measurement_listeners.append(save_latest_measurement)
+    try:
+        for setup, error in orchestrator.connect(arguments.detector, polarimeter_only=arguments.polarimeter_only).items():
+            if error is not None:
+                print(f"ERROR: {setup}: {error}")
+                return
+
+        for job in campaign:
+            parameters = job.get('parameters', {})
+            if job['name'] not in ('Resume mapping', 'Analyzer velocity search'):
+                parameters.setdefault('root_folder', arguments.folder)
+            for _ in range(job.get('repeat', 1)):
+                setup, description = orchestrator.submit(job['name'], setup=job.get('setup'), **parameters)
+                print(f"{setup}: job {description['id']} ({description['name']}) queued")
+
+        while orchestrator.is_busy():
+            time.sleep(1)
+    except KeyboardInterrupt:
+        orchestrator.broadcast('cancel_all')
+        while orchestrator.is_busy():
+            time.sleep(1)
+    finally:
+        for setup, jobs in orchestrator.broadcast('jobs').items():
+            for description in jobs:
+                print(f"{setup}: job {description['id']} ({description['name']}): {description['status']} {description['error']}")
+        orchestrator.stop()
+
+def main():
+    arguments = parse_arguments()
+
+    if arguments.command == 'catalog':
+        catalog(arguments)
+        return
+    if arguments.command == 'drift':
+        drift(arguments)
+        return
+    if arguments.command == 'analyze':
+        analyze(arguments)
+        return
+    if arguments.command == 'orchestrate':
+        orchestrate(arguments)
+        return
+
+    service = AcquisitionService()
+
+    if arguments.command == 'serve':
+        serve(service, arguments.port)
+        return
+
+    error = service.connect(arguments.detector, polarimeter_only=arguments.polarimeter_only)
+    if error is not None:
+        print(f"ERROR: {error}")
+        return
+    if arguments.fast:
+        service.analyzer.fast_mode = True
+    if arguments.adaptive:
+        service.analyzer.adaptive_averaging = True
+
+    try:
+        if arguments.command == 'snap':
+            print(json.dumps(service.snap(arguments.path, profile=arguments.profile)))
+            return
+        if arguments.command == 'calibrate':
+            print(json.dumps(service.calibrate()))
+            return
+
+        for name, parameters in campaign_jobs(arguments):
+            service.submit(name, profile=arguments.profile, **parameters)
+
+        wait_for_queue(service)
+    except KeyboardInterrupt:
+        service.experiment_queue.cancel_all()
+        wait_for_queue(service)
+    finally:
+        for job in service.experiment_queue.jobs():
+            description = job.describe()
+            print(f"Job {description['id']} ({description['name']}): {description['status']} {description['error']}")
+        service.disconnect()
+
+if __name__ == '__main__':
+    main()
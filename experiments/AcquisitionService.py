@@ -0,0 +1,556 @@
+import CONFIG
+import instrumentation
+
+import csv
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from hardware.Analyzer import Analyzer, UnsupportedDetectorError, PowermeterNotFoundError
+from hardware.Compensator import Compensator
+from hardware.SessionRecording import open_session, close_session
+from experiments.ExperimentQueue import ExperimentQueue
+from experiments.MappingManifest import MappingManifest
+from experiments.FixedCadenceScheduler import FixedCadenceScheduler
+from experiments.TimeSeriesStore import TimeSeriesStore
+from experiments.ClosedLoopCompensator import ClosedLoopCompensator, predicted_qwp_angles
+from processing.processing import compute_polarization_parameters, compute_polarization_parameters_linear
+from processing.sweep import SWEEP_LOG_FILENAME, SWEEP_COLUMNS, rebin_hwp_sweep
+from processing.design import SYSTEM_PARAMETER_NAMES, cell_information, plan_d_optimal, expected_covariance
+
+
+class HardwareNotConnectedError(Exception):
+    pass
+
+class UnknownExperimentError(Exception):
+    pass
+
+class HardwareBusyError(Exception):
+    pass
+
+def create_experiment_folder(root_folder, suffix):
+    folder = f"{root_folder}/{datetime.now().strftime('%Y%m%dT%H%M%SZ')}_{suffix}"
+    Path(folder).mkdir(parents=True, exist_ok=True)
+
+    return folder
+
+def plan_hwp_mapping(hwp_mapping_steps):
+    hwp_mapping_step_size = int(90/(hwp_mapping_steps-1))
+
+    return [{'name': f"{ii:03d}", 'hwp': ii*hwp_mapping_step_size} for ii in range(hwp_mapping_steps)]
+
+def plan_hqwp_mapping(hwp_mapping_steps, qwp_mapping_steps):
+    hwp_mapping_step_size = int(90/(hwp_mapping_steps-1))
+    qwp_mapping_step_size = int(180/(qwp_mapping_steps-1))
+
+    points = []
+    for ii in range(hwp_mapping_steps):
+        for jj in range(qwp_mapping_steps):
+            points.append({'name': f"HWP-{ii:03d}_QWP-{jj:03d}", 'hwp': ii*hwp_mapping_step_size, 'qwp': jj*qwp_mapping_step_size})
+
+    return points
+
+def plan_compensation_test(compensation_filepath):
+    data = np.load(compensation_filepath)
+
+    HWP_angles = data['hwp']
+    QWP_angles = data['qwp_1']
+
+    return [{'name': f"HWP-{ii:03d}", 'hwp': float(HWP_angles[ii]), 'qwp': float(QWP_angles[ii])} for ii in range(len(HWP_angles))]
+
+def plan_optimal_hqwp_mapping(prior_parameters, number_of_points, analyzer_angles, noise_std):
+    hwp_angles = np.arange(0, 90 + 1E-9, CONFIG.optimal_design_hwp_candidate_step_in_deg)
+    qwp_angles = np.arange(0, 180 + 1E-9, CONFIG.optimal_design_qwp_candidate_step_in_deg)
+
+    cells, cell_informations = cell_information(hwp_angles, qwp_angles, analyzer_angles, prior_parameters)
+    selected = plan_d_optimal(cell_informations, number_of_points)
+    covariance = expected_covariance(cell_informations, selected, noise_std)
+
+    # Names keep the candidate grid indices, points are sorted by HWP so the HWP moves as little as possible.
+    points = []
+    for index in sorted(selected, key=lambda index: cells[index]):
+        hwp, qwp = cells[index]
+        points.append({'name': f"HWP-{index // len(qwp_angles):03d}_QWP-{index % len(qwp_angles):03d}", 'hwp': float(hwp), 'qwp': float(qwp)})
+
+    return points, covariance
+
+def quality_failures(result):
+    if result is None:
+        return ['invalid_data']
+
+    failures = []
+    if result['missed_triggers'] > CONFIG.mapping_quality_max_missed_triggers:
+        failures.append('missed_triggers')
+    if not result['fit_success'] or result['ellipticity'] < 0:
+        failures.append('fit_failure')
+    elif result['nrmse'] > CONFIG.mapping_quality_max_nrmse:
+        failures.append('nrmse')
+
+    return failures
+
+class AcquisitionService:
+    def __init__(self, config_path='config.ini'):
+        self.config_path = config_path
+        self.analyzer = None
+        self.compensator = None
+        self.experiment_queue = ExperimentQueue()
+        self.progress = 0
+        self.last_polarization_parameters = None
+        self.measurement_listeners = []
+        # Held by every snap and calibration, the API, the UI and the experiments share one DAQ task and analyzer stage.
+        self.hardware_lock = threading.Lock()
+
+        self.experiments = {
+            'HWP mapping': self.hwp_mapping_job,
+            'HWP and QWP mapping': self.hqwp_mapping_job,
+            'Optimal HQWP design': self.optimal_design_job,
+            'Compensation test': self.compensation_test_job,
+            'Closed-loop compensation': self.closed_loop_compensation_job,
+            'HWP sweep': self.hwp_sweep_job,
+            'Time lapse': self.time_lapse_job,
+            'Resume mapping': self.resume_mapping_job,
+            'Analyzer velocity search': self.velocity_search_job
+        }
+
+    def is_connected(self):
+        return self.analyzer is not None
+
+    def connect(self, detector, polarimeter_only=False):
+        CONFIG.load_config(self.config_path)
+        open_session()
+
+        error = None
+
+        try:
+            self.analyzer = Analyzer(detector)
+        except PowermeterNotFoundError:
+            error = 'Powermeter not found.'
+        except UnsupportedDetectorError:
+            error = f'Detector {detector} is not supported.'
+
+        if not polarimeter_only:
+            self.compensator = Compensator()
+
+        return error
+
+    def disconnect(self):
+        self.experiment_queue.cancel_all()
+
+        if self.compensator is not None:
+            self.compensator.close()
+            self.compensator = None
+        if self.analyzer is not None:
+            self.analyzer.close()
+            self.analyzer = None
+        close_session()
+
+    def status(self):
+        current_job = self.experiment_queue.current_job
+
+        return {
+            'connected': self.is_connected(),
+            'detector': self.analyzer.detector if self.is_connected() else None,
+            'compensator': self.compensator is not None,
+            'busy': self.experiment_queue.is_busy(),
+            'paused': self.experiment_queue.is_paused(),
+            'current_job': current_job.describe() if current_job is not None else None,
+            'progress': self.progress,
+            'last_polarization_parameters': self.last_polarization_parameters
+        }
+
+    def snap(self, path=None, profile=False, notify_listeners=True, blocking=True):
+        if profile:
+            with instrumentation.profile(self.profile_path('snap')):
+                return self.snap(path, notify_listeners=notify_listeners, blocking=blocking)
+
+        if not self.is_connected():
+            raise HardwareNotConnectedError
+
+        if not self.hardware_lock.acquire(blocking=blocking):
+            raise HardwareBusyError
+        try:
+            return self.__snap(path, notify_listeners)
+        finally:
+            self.hardware_lock.release()
+
+    def __snap(self, path, notify_listeners):
+        instrumentation.start_run()
+        analyzer = self.analyzer
+
+        acquisition_started = time.time()
+        with instrumentation.span('snap'):
+            analyzer.snap()
+        acquisition_ended = time.time()
+
+        if not (analyzer.analog_data_valid or analyzer.detector == 'powermeter'):
+            return None
+
+        uncertainty = None
+        with instrumentation.span('compute_polarization_parameters'):
+            if analyzer.fast_mode:
+                ellipticity, e_max, alpha_max, fitted_intensity, nrmse, uncertainty = compute_polarization_parameters_linear(
+                    np.deg2rad(analyzer.measurement_data[0]),
+                    analyzer.measurement_data[1]
+                    )
+            else:
+                ellipticity, e_max, alpha_max, fitted_intensity, nrmse = compute_polarization_parameters(
+                    np.deg2rad(analyzer.measurement_data[0]),
+                    analyzer.measurement_data[1],
+                    max_intensity=CONFIG.detector_max_intensity
+                    )
+        self.last_polarization_parameters = {
+            'ellipticity': float(ellipticity),
+            'e_max': float(e_max),
+            'alpha_max': float(alpha_max),
+            'nrmse': float(nrmse)
+        }
+        if uncertainty is not None:
+            self.last_polarization_parameters['ellipticity_std'] = uncertainty['ellipticity']
+            self.last_polarization_parameters['alpha_max_std'] = uncertainty['alpha_max']
+        elif analyzer.ellipticity_std is not None:
+            self.last_polarization_parameters['ellipticity_std'] = analyzer.ellipticity_std
+        if analyzer.adaptive_averaging:
+            self.last_polarization_parameters['revolutions'] = analyzer.revolutions
+            self.last_polarization_parameters['dropped_revolutions'] = analyzer.dropped_revolutions
+
+        if notify_listeners and self.measurement_listeners:
+            with instrumentation.span('render'):
+                for listener in self.measurement_listeners:
+                    listener(analyzer, fitted_intensity, self.last_polarization_parameters)
+
+        if path is not None:
+            timing_spans = instrumentation.run_spans()
+            with instrumentation.span('save'):
+                analyzer.save(path, timing_spans=timing_spans)
+
+        return dict(
+            self.last_polarization_parameters,
+            missed_triggers=int(analyzer.missed_triggers),
+            reconstructed_triggers=int(analyzer.reconstructed_triggers),
+            fit_success=fitted_intensity is not None,
+            acquisition_started=acquisition_started,
+            acquisition_ended=acquisition_ended
+        )
+
+    def calibrate(self, blocking=True):
+        if not self.is_connected() or self.analyzer.detector != 'photodiode':
+            raise HardwareNotConnectedError('calibration requires the photodiode')
+
+        photodiode = self.analyzer.photodiode
+        if not self.hardware_lock.acquire(blocking=blocking):
+            raise HardwareBusyError
+        try:
+            photodiode.calibrate()
+        finally:
+            self.hardware_lock.release()
+
+        return {
+            'mean': float(photodiode.calibration_mean),
+            'std': float(photodiode.calibration_std),
+            'standard_error': float(photodiode.calibration_standard_error),
+            'timestamp': photodiode.calibration_timestamp
+        }
+
+    def profile_path(self, name):
+        return os.path.join(CONFIG.experiment_folder, 'profiles', f"{datetime.now().strftime('%Y%m%dT%H%M%SZ')}_{name.replace(' ', '_')}.prof")
+
+    def submit(self, name, profile=False, **parameters):
+        if name not in self.experiments:
+            raise UnknownExperimentError(name)
+
+        function = self.experiments[name]
+        if profile:
+            function = self.profiled(name, function)
+
+        return self.experiment_queue.submit(name, function, **parameters)
+
+    def profiled(self, name, function):
+        def profiled_function(**parameters):
+            with instrumentation.profile(self.profile_path(name)):
+                function(**parameters)
+
+        return profiled_function
+
+    def perform_mapping(self, manifest):
+        if self.compensator is None:
+            raise HardwareNotConnectedError('mapping requires the compensator')
+
+        self.compensator.hwp_rotation_stage.set_position(0, absolute=True)
+        self.current_hwp_angle = 0
+        # The retry limits apply to this run, the attempts of earlier runs stay in the manifest quality log.
+        retry_budget = CONFIG.mapping_quality_retry_budget
+        failed_points = []
+
+        for point in manifest.points_to_measure():
+            self.experiment_queue.checkpoint()
+
+            self.move_to_point(point)
+            passed = self.acquire_point(manifest, point)
+            retries = 0
+            while not passed and CONFIG.mapping_quality_retry_mode == 'immediate' and retry_budget > 0 and retries < CONFIG.mapping_quality_max_retries_per_point:
+                retry_budget -= 1
+                retries += 1
+                passed = self.acquire_point(manifest, point)
+            if not passed and CONFIG.mapping_quality_retry_mode == 'final_sweep':
+                failed_points.append(point)
+
+            self.progress = manifest.progress()
+
+        # Final sweep: failing points are re-measured after the map, one pass per allowed retry.
+        for _ in range(CONFIG.mapping_quality_max_retries_per_point):
+            if not failed_points or retry_budget <= 0:
+                break
+
+            retried_points = failed_points[:retry_budget]
+            failed_points = failed_points[retry_budget:]
+            retry_budget -= len(retried_points)
+            for point in retried_points:
+                self.experiment_queue.checkpoint()
+
+                self.move_to_point(point)
+                if not self.acquire_point(manifest, point):
+                    failed_points.append(point)
+
+                self.progress = manifest.progress()
+
+        failed_names = manifest.failed_quality_points()
+        if failed_names:
+            print(f"WARNING: {len(failed_names)} points did not pass the quality gates: {', '.join(failed_names)}")
+
+    def move_to_point(self, point):
+        if point['hwp'] != self.current_hwp_angle:
+            print(point['hwp'])
+            self.compensator.hwp_rotation_stage.set_position(point['hwp'], absolute=True)
+            self.current_hwp_angle = point['hwp']
+        if 'qwp' in point:
+            self.compensator.qwp_rotation_stage.set_position(point['qwp'], absolute=True)
+
+    def acquire_point(self, manifest, point):
+        result = self.snap(manifest.point_path(point))
+        failures = quality_failures(result)
+        manifest.record_quality(point, result, failures)
+
+        # Points whose data was saved are completed even if they fail the gates, their quality log tells them apart.
+        if result is None:
+            print(f"WARNING: unable to acquire {point['name']}, it is left for a later resume.")
+        else:
+            manifest.mark_completed(point, self.compensator.get_state() | self.analyzer.get_state() | {'quality_passed': not failures})
+            if failures:
+                print(f"WARNING: {point['name']} failed the quality gates ({', '.join(failures)}).")
+
+        return not failures
+
+    def perform_time_lapse(self, folder, duration_minutes, interval_in_seconds):
+        scheduler = FixedCadenceScheduler(interval_in_seconds, 60*duration_minutes, sleep=self.experiment_queue.sleep)
+        store = TimeSeriesStore(
+            f"{folder}/{datetime.now().strftime('%Y%m%dT%H%M%SZ')}_time_lapse",
+            int(360/CONFIG.trigger_out_interval_in_deg) if self.analyzer.detector == 'photodiode' else CONFIG.powermeter_number_of_measurements
+        )
+
+        try:
+            for slot, slot_time in scheduler:
+                self.experiment_queue.checkpoint()
+
+                result = self.snap()
+                if result is not None:
+                    # The record keeps when the acquisition actually started, late slots included, and its slot time.
+                    store.append(
+                        result['acquisition_started'],
+                        slot,
+                        self.analyzer.measurement_data,
+                        self.last_polarization_parameters['ellipticity'],
+                        self.last_polarization_parameters['e_max'],
+                        self.last_polarization_parameters['alpha_max'],
+                        self.last_polarization_parameters['nrmse'],
+                        missed_triggers=self.analyzer.missed_triggers,
+                        scheduled=slot_time
+                    )
+
+                self.progress = scheduler.progress(slot)
+        finally:
+            store.close()
+
+        if scheduler.missed_slots:
+            print(f"WARNING: time lapse missed {len(scheduler.missed_slots)} of {scheduler.number_of_slots} slots.")
+
+    def perform_hwp_sweep(self, folder, start_in_deg, stop_in_deg, velocity_in_deg_per_s):
+        hwp_rotation_stage = self.compensator.hwp_rotation_stage
+        hwp_rotation_stage.set_position(start_in_deg, absolute=True)
+        velocity, acceleration = hwp_rotation_stage.get_velocity_params()
+
+        with open(f"{folder}/{SWEEP_LOG_FILENAME}", 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=SWEEP_COLUMNS)
+            writer.writeheader()
+
+            hwp_rotation_stage.set_velocity_params(velocity_in_deg_per_s, acceleration)
+            try:
+                hwp_rotation_stage.start_move(stop_in_deg)
+                revolution = 0
+                while hwp_rotation_stage.is_moving():
+                    self.experiment_queue.checkpoint()
+
+                    # The HWP moves at constant velocity, so its positions at the start and end of the acquisition are
+                    # interpolated between the positions read before and after the snap, which also fits and saves.
+                    name = f"REV-{revolution:05d}"
+                    revolution += 1
+                    read_before, position_before = time.time(), hwp_rotation_stage.get_position()
+                    result = self.snap(f"{folder}/{name}")
+                    read_after, position_after = time.time(), hwp_rotation_stage.get_position()
+
+                    if result is not None:
+                        started, ended = result['acquisition_started'], result['acquisition_ended']
+                        hwp_start, hwp_end = np.interp([started, ended], [read_before, read_after], [position_before, position_after])
+                        writer.writerow({
+                            'name': name,
+                            'started': started,
+                            'ended': ended,
+                            'hwp_start': float(hwp_start),
+                            'hwp_end': float(hwp_end),
+                            'hwp': float(hwp_start + hwp_end) / 2,
+                            'ellipticity': result['ellipticity'],
+                            'e_max': result['e_max'],
+                            'alpha_max': result['alpha_max'],
+                            'nrmse': result['nrmse'],
+                            'missed_triggers': result['missed_triggers']
+                        })
+                        file.flush()
+
+                    self.progress = min(abs(position_after - start_in_deg) / abs(stop_in_deg - start_in_deg), 1)
+            finally:
+                if hwp_rotation_stage.is_moving():
+                    hwp_rotation_stage.stop()
+                hwp_rotation_stage.set_velocity_params(velocity, acceleration)
+
+    def mapping_job(self, root_folder, suffix, parameters, points):
+        self.progress = 0
+
+        folder = create_experiment_folder(root_folder, suffix)
+        manifest = MappingManifest.create(folder, suffix, parameters | {'detector': self.analyzer.detector}, points)
+
+        self.perform_mapping(manifest)
+
+    def hwp_mapping_job(self, root_folder, hwp_mapping_steps):
+        self.mapping_job(root_folder, 'HWP_mapping', {'hwp_mapping_steps': hwp_mapping_steps}, plan_hwp_mapping(hwp_mapping_steps))
+
+    def hqwp_mapping_job(self, root_folder, hwp_mapping_steps, qwp_mapping_steps):
+        self.mapping_job(
+            root_folder,
+            'HQWP_mapping',
+            {'hwp_mapping_steps': hwp_mapping_steps, 'qwp_mapping_steps': qwp_mapping_steps},
+            plan_hqwp_mapping(hwp_mapping_steps, qwp_mapping_steps)
+        )
+
+    def optimal_design_job(self, root_folder, prior_filepath, number_of_points=None):
+        # The prior is a system_parameters.json (live analysis), its RMSE is used as the expected noise if present.
+        with open(prior_filepath, 'r') as file:
+            prior = json.load(file)
+        prior_parameters = prior['parameters']
+        noise_std = prior.get('rmse', CONFIG.optimal_design_noise_std)
+        number_of_points = CONFIG.optimal_design_number_of_points if number_of_points is None else number_of_points
+
+        points, covariance = plan_optimal_hqwp_mapping(prior_parameters, number_of_points, self.analyzer.measurement_angles(), noise_std)
+        expected_std = dict(zip(SYSTEM_PARAMETER_NAMES, (float(value) for value in np.sqrt(np.diag(covariance)))))
+        print(f"Expected parameter standard deviations with {len(points)} points: {expected_std}")
+
+        self.mapping_job(
+            root_folder,
+            'HQWP_design',
+            {
+                'number_of_points': number_of_points,
+                'prior_filepath': prior_filepath,
+                'prior_parameters': prior_parameters,
+                'noise_std': noise_std,
+                'expected_std': expected_std,
+                'expected_covariance': covariance.tolist()
+            },
+            points
+        )
+
+    def compensation_test_job(self, root_folder, compensation_filepath):
+        self.mapping_job(root_folder, 'compensation_test', {'compensation_filepath': compensation_filepath}, plan_compensation_test(compensation_filepath))
+
+    def measure_at(self, folder, hwp, qwp):
+        self.compensator.hwp_rotation_stage.set_position(hwp, absolute=True)
+        self.compensator.qwp_rotation_stage.set_position(qwp, absolute=True)
+
+        return self.snap(f"{folder}/{datetime.now().strftime('%Y%m%dT%H%M%S_%fZ')}")
+
+    def closed_loop_compensation_job(self, root_folder, compensation_filepath, hwp_angles=None, optimize_hwp=False):
+        if self.compensator is None:
+            raise HardwareNotConnectedError('compensation requires the compensator')
+
+        self.progress = 0
+
+        folder = create_experiment_folder(root_folder, 'closed_loop_compensation')
+        target_hwp_angles, target_qwp_angles = predicted_qwp_angles(compensation_filepath, hwp_angles)
+        closed_loop_compensator = ClosedLoopCompensator(
+            lambda hwp, qwp: self.measure_at(folder, hwp, qwp),
+            f"{folder}/evaluations.csv",
+            CONFIG.closed_loop_search_half_width_in_deg,
+            CONFIG.closed_loop_tolerance_in_deg,
+            CONFIG.closed_loop_max_evaluations,
+            target_ellipticity=CONFIG.closed_loop_target_ellipticity,
+            hwp_step=CONFIG.closed_loop_hwp_step_in_deg,
+            checkpoint=self.experiment_queue.checkpoint
+        )
+
+        try:
+            for ii, (hwp, qwp) in enumerate(zip(target_hwp_angles, target_qwp_angles)):
+                best_hwp, best_qwp, ellipticity = closed_loop_compensator.compensate(ii, float(hwp), float(qwp), optimize_hwp=optimize_hwp)
+                print(f"HWP {hwp:.2f}: QWP {qwp:.2f} -> {best_qwp:.2f} (HWP {best_hwp:.2f}), ellipticity {ellipticity:.4f}")
+                self.progress = (ii+1) / len(target_hwp_angles)
+        finally:
+            # Same hwp/qwp_1 layout as the compensation file, so the result can be replayed by a compensation test.
+            if closed_loop_compensator.evaluations:
+                closed_loop_compensator.save(f"{folder}/closed_loop_compensation.npz")
+
+    def hwp_sweep_job(self, root_folder, start_in_deg=None, stop_in_deg=None, velocity_in_deg_per_s=None, bin_width_in_deg=None):
+        if self.compensator is None:
+            raise HardwareNotConnectedError('sweep requires the compensator')
+
+        self.progress = 0
+        start_in_deg = CONFIG.hwp_sweep_start_in_deg if start_in_deg is None else start_in_deg
+        stop_in_deg = CONFIG.hwp_sweep_stop_in_deg if stop_in_deg is None else stop_in_deg
+        velocity_in_deg_per_s = CONFIG.hwp_sweep_velocity_in_deg_per_s if velocity_in_deg_per_s is None else velocity_in_deg_per_s
+        bin_width_in_deg = CONFIG.hwp_sweep_bin_width_in_deg if bin_width_in_deg is None else bin_width_in_deg
+
+        folder = create_experiment_folder(root_folder, 'HWP_sweep')
+        try:
+            self.perform_hwp_sweep(folder, start_in_deg, stop_in_deg, velocity_in_deg_per_s)
+        finally:
+            binned = rebin_hwp_sweep(folder, bin_width_in_deg, max_intensity=CONFIG.detector_max_intensity, fast_mode=self.analyzer.fast_mode)
+            if binned is not None:
+                np.savez(f"{folder}/hwp_sweep_binned.npz", bin_width_in_deg=bin_width_in_deg, **binned)
+
+    def resume_mapping_job(self, folder):
+        self.progress = 0
+
+        manifest = MappingManifest.load(folder)
+        manifest.validate(self.analyzer.detector)
+
+        if not manifest.points_to_measure():
+            print(f"{folder} is already complete.")
+            return
+
+        self.analyzer.home()
+        self.compensator.home()
+
+        self.perform_mapping(manifest)
+
+    def time_lapse_job(self, root_folder, duration_minutes, interval_in_seconds):
+        self.progress = 0
+
+        Path(root_folder).mkdir(parents=True, exist_ok=True)
+        self.perform_time_lapse(root_folder, duration_minutes, interval_in_seconds)
+
+    def velocity_search_job(self):
+        self.progress = 0
+
+        self.analyzer.search_fastest_velocity(checkpoint=self.experiment_queue.checkpoint)
+
+        self.progress = 1
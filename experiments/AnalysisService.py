@@ -0,0 +1,223 @@
+import csv
+import json
+import os
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+
+from experiments.MappingManifest import MappingManifest
+from processing.processing import compute_polarization_parameters, compute_polarization_parameters_linear, compute_system_parameters, compute_system_parameters_multistart, system_fit_residuals, canonical_system_parameters, load_hqwp_map, fit_hqwp_map_chunked
+
+
+SUMMARY_FILENAME = 'analysis.csv'
+SYSTEM_PARAMETERS_FILENAME = 'system_parameters.json'
+SUMMARY_COLUMNS = ['name', 'hwp', 'qwp', 'mtime', 'size', 'ellipticity', 'e_max', 'alpha_max', 'nrmse', 'fit_success']
+
+def fit_trace(path, max_intensity):
+    with np.load(path) as data:
+        measurement_data = data['measurement_data']
+        fast_mode = bool(data['fast_mode']) if 'fast_mode' in data.files else False
+
+    if fast_mode:
+        ellipticity, e_max, alpha_max, fitted_intensity, nrmse, _ = compute_polarization_parameters_linear(np.deg2rad(measurement_data[0]), measurement_data[1])
+    else:
+        ellipticity, e_max, alpha_max, fitted_intensity, nrmse = compute_polarization_parameters(np.deg2rad(measurement_data[0]), measurement_data[1], max_intensity=max_intensity)
+
+    return {
+        'ellipticity': float(ellipticity),
+        'e_max': float(e_max),
+        'alpha_max': float(alpha_max),
+        'nrmse': float(nrmse),
+        'fit_success': fitted_intensity is not None
+    }
+
+def fit_completed_map(folder, max_intensity, number_of_starts, chunked=False):
+    # Runs in a worker process so the per-trace fits of the next run are not held up.
+    if chunked and MappingManifest.load(folder).experiment == 'HQWP_mapping':
+        parameters, rmse, nrmse, number_of_samples = fit_hqwp_map_chunked(folder, max_intensity=max_intensity)
+        starts = 1
+    else:
+        primes, aggregated_intensities = load_hqwp_map(folder)
+        try:
+            parameters = compute_system_parameters(primes, aggregated_intensities, max_intensity=max_intensity)
+            starts = 1
+        except RuntimeError:
+            parameters, _ = compute_system_parameters_multistart(primes, aggregated_intensities, number_of_starts=number_of_starts, max_intensity=max_intensity)
+            starts = number_of_starts
+        rmse, nrmse = system_fit_residuals(primes, aggregated_intensities, parameters)
+        number_of_samples = len(aggregated_intensities)
+
+    result = {
+        'fitted': datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ'),
+        'parameters': [float(value) for value in parameters],
+        'canonical_parameters': [float(value) for value in canonical_system_parameters(*parameters)],
+        'rmse': float(rmse),
+        'nrmse': float(nrmse),
+        'number_of_samples': number_of_samples,
+        'number_of_starts': starts
+    }
+
+    temporary_path = os.path.join(folder, SYSTEM_PARAMETERS_FILENAME + '.tmp')
+    with open(temporary_path, 'w') as file:
+        json.dump(result, file, indent=1)
+    os.replace(temporary_path, os.path.join(folder, SYSTEM_PARAMETERS_FILENAME))
+
+    return result
+
+class AnalysisService:
+    def __init__(self, root_folder, max_intensity=10, number_of_starts=16, catch_up=False, chunked=False):
+        self.root_folder = os.path.abspath(root_folder)
+        self.max_intensity = max_intensity
+        self.number_of_starts = number_of_starts
+        self.catch_up = catch_up
+        self.chunked = chunked
+
+        self.summaries = {}
+        self.system_fits = {}
+        self.__pending = set()
+        self.__lock = threading.Lock()
+        self.__stop_event = threading.Event()
+        self.__executor = None
+        self.__worker = None
+
+    def start(self):
+        self.__stop_event.clear()
+        self.__executor = ProcessPoolExecutor(max_workers=1)
+        self.__worker = threading.Thread(target=self.run, daemon=True)
+        self.__worker.start()
+
+    def stop(self):
+        self.__stop_event.set()
+        if self.__worker is not None:
+            self.__worker.join()
+            self.__worker = None
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=True)
+            self.__executor = None
+
+    def run(self):
+        from watchfiles import watch, Change
+
+        if self.__executor is None:
+            self.__executor = ProcessPoolExecutor(max_workers=1)
+
+        if self.catch_up:
+            self.handle(self.root_folder)
+
+        # Timeouts yield an empty batch, so files that were still being written are retried within a few seconds.
+        for changes in watch(self.root_folder, stop_event=self.__stop_event, recursive=True, rust_timeout=2000, yield_on_timeout=True):
+            paths = {path for change, path in changes if change != Change.deleted} | self.__pending
+            self.__pending = set()
+            for path in sorted(paths):
+                self.handle(path)
+
+    def handle(self, path):
+        # Files written before the watch of a new run folder was in place only show up as the folder itself.
+        if os.path.isdir(path):
+            for folder, _, filenames in os.walk(path):
+                for filename in sorted(filenames):
+                    self.handle(os.path.join(folder, filename))
+            return
+
+        folder, filename = os.path.split(path)
+        if filename.endswith('.npz'):
+            self.analyze_trace(folder, filename[:-len('.npz')])
+        elif filename == MappingManifest.FILENAME:
+            self.check_map(folder)
+
+    def summary(self, folder):
+        with self.__lock:
+            if folder not in self.summaries:
+                self.summaries[folder] = self.__read_summary(folder)
+
+            return self.summaries[folder]
+
+    def __read_summary(self, folder):
+        path = os.path.join(folder, SUMMARY_FILENAME)
+        if not os.path.isfile(path):
+            return {}
+
+        with open(path, 'r', newline='') as file:
+            return {row['name']: row for row in csv.DictReader(file)}
+
+    def __write_summary(self, folder, rows):
+        # Rows are kept in acquisition order, rewritten whole so a re-measured point replaces its previous fit.
+        temporary_path = os.path.join(folder, SUMMARY_FILENAME + '.tmp')
+        with open(temporary_path, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=SUMMARY_COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows.values())
+        os.replace(temporary_path, os.path.join(folder, SUMMARY_FILENAME))
+
+    def analyze_trace(self, folder, name):
+        path = os.path.join(folder, name + '.npz')
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        rows = self.summary(folder)
+        previous = rows.get(name)
+        if previous is not None and (float(previous['mtime']), int(previous['size'])) == (stat.st_mtime, stat.st_size):
+            return previous
+
+        try:
+            row = fit_trace(path, self.max_intensity)
+        except KeyError:
+            # Compensation files and other archives without measurement data.
+            return None
+        except (OSError, EOFError, ValueError, zipfile.BadZipFile):
+            self.__pending.add(path)
+            return None
+
+        row = {'name': name, 'hwp': None, 'qwp': None, 'mtime': stat.st_mtime, 'size': stat.st_size} | row
+        manifest = self.__load_manifest(folder)
+        if manifest is not None:
+            point = next((point for point in manifest.points if point['name'] == name), None)
+            if point is not None:
+                row['hwp'], row['qwp'] = point.get('hwp'), point.get('qwp')
+
+        with self.__lock:
+            rows[name] = row
+            self.__write_summary(folder, rows)
+
+        if manifest is not None:
+            self.check_map(folder, manifest)
+
+        return row
+
+    def __load_manifest(self, folder):
+        try:
+            return MappingManifest.load(folder)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def check_map(self, folder, manifest=None):
+        if manifest is None:
+            manifest = self.__load_manifest(folder)
+        if manifest is None or manifest.experiment not in ('HQWP_mapping', 'HQWP_design') or not manifest.is_complete():
+            return
+
+        # A map is fitted once, or again if points were re-measured after its fit.
+        fitted_path = os.path.join(folder, SYSTEM_PARAMETERS_FILENAME)
+        manifest_mtime = os.stat(os.path.join(folder, MappingManifest.FILENAME)).st_mtime
+        if os.path.isfile(fitted_path) and os.stat(fitted_path).st_mtime >= manifest_mtime:
+            return
+        if folder in self.system_fits and not self.system_fits[folder].done():
+            return
+
+        future = self.__executor.submit(fit_completed_map, folder, self.max_intensity, self.number_of_starts, self.chunked)
+        future.add_done_callback(lambda future: self.__report_system_fit(folder, future))
+        self.system_fits[folder] = future
+
+    def __report_system_fit(self, folder, future):
+        error = future.exception()
+        if error is not None:
+            print(f"ERROR: system fit of {folder} failed with {error!r}.")
+            return
+
+        result = future.result()
+        print(f"{folder}: system parameters {result['canonical_parameters']} (NRMSE {result['nrmse']:.4f})")
@@ -0,0 +1,115 @@
+import csv
+from datetime import datetime, timezone
+
+import numpy as np
+from scipy.optimize import minimize, minimize_scalar
+
+
+class _TargetReached(Exception):
+    pass
+
+class _EvaluationsExhausted(Exception):
+    pass
+
+class ClosedLoopCompensator:
+    LOG_FIELDS = ['timestamp', 'target', 'evaluation', 'hwp', 'qwp', 'ellipticity', 'alpha_max', 'nrmse']
+
+    def __init__(self, measure, log_path, search_half_width, tolerance, max_evaluations, target_ellipticity=0, hwp_step=None, checkpoint=None):
+        # measure(hwp, qwp) moves the waveplates, snaps and returns the snap result (None if invalid).
+        self.measure = measure
+        self.log_path = log_path
+        self.search_half_width = search_half_width
+        self.tolerance = tolerance
+        self.max_evaluations = max_evaluations
+        self.target_ellipticity = target_ellipticity
+        self.hwp_step = hwp_step
+        self.checkpoint = checkpoint
+
+        self.evaluations = []
+        with open(self.log_path, 'w', newline='') as file:
+            csv.DictWriter(file, fieldnames=self.LOG_FIELDS).writeheader()
+
+    def evaluate(self, target, hwp, qwp):
+        if self.checkpoint is not None:
+            self.checkpoint()
+
+        result = self.measure(hwp, qwp)
+        # Invalid snaps and failed fits are scored as fully elliptical.
+        if result is None or not result['fit_success']:
+            ellipticity, alpha_max, nrmse = 1.0, np.nan, np.nan
+        else:
+            ellipticity, alpha_max, nrmse = result['ellipticity'], result['alpha_max'], result['nrmse']
+
+        evaluation = {
+            'timestamp': datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S.%fZ'),
+            'target': target,
+            'evaluation': sum(1 for previous in self.evaluations if previous['target'] == target),
+            'hwp': float(hwp),
+            'qwp': float(qwp),
+            'ellipticity': float(ellipticity),
+            'alpha_max': float(alpha_max),
+            'nrmse': float(nrmse)
+        }
+        self.evaluations.append(evaluation)
+        with open(self.log_path, 'a', newline='') as file:
+            csv.DictWriter(file, fieldnames=self.LOG_FIELDS).writerow(evaluation)
+
+        if evaluation['ellipticity'] <= self.target_ellipticity:
+            raise _TargetReached
+        # The optimizers count iterations, not snaps, so the snap budget is enforced here.
+        if evaluation['evaluation'] + 1 >= self.max_evaluations:
+            raise _EvaluationsExhausted
+
+        return evaluation['ellipticity']
+
+    def compensate(self, target, hwp, predicted_qwp, optimize_hwp=False):
+        try:
+            # The prediction is measured first, the search only runs if it misses the target.
+            predicted_ellipticity = self.evaluate(target, hwp, predicted_qwp)
+
+            if optimize_hwp:
+                # Nelder-Mead over small HWP and QWP moves around the prediction, which is the first simplex vertex
+                # and is not measured again. Ellipticity differences below half the target are not resolved.
+                simplex = np.array([[hwp, predicted_qwp], [hwp + self.hwp_step, predicted_qwp], [hwp, predicted_qwp + self.search_half_width/2]])
+                minimize(
+                    lambda angles: predicted_ellipticity if np.array_equal(angles, simplex[0]) else self.evaluate(target, *angles),
+                    [hwp, predicted_qwp],
+                    method='Nelder-Mead',
+                    options=dict(initial_simplex=simplex, xatol=self.tolerance, fatol=self.target_ellipticity/2, maxfev=self.max_evaluations)
+                )
+            else:
+                # Bounded Brent search of the QWP angle, the HWP stays at the target.
+                minimize_scalar(
+                    lambda qwp: self.evaluate(target, hwp, qwp),
+                    bounds=(predicted_qwp - self.search_half_width, predicted_qwp + self.search_half_width),
+                    method='bounded',
+                    options=dict(xatol=self.tolerance, maxiter=self.max_evaluations)
+                )
+        except (_TargetReached, _EvaluationsExhausted):
+            pass
+
+        # The best measured point is kept, the optimizer's final estimate was not necessarily measured.
+        best = min((evaluation for evaluation in self.evaluations if evaluation['target'] == target), key=lambda evaluation: evaluation['ellipticity'])
+
+        return best['hwp'], best['qwp'], best['ellipticity']
+
+    def results(self):
+        targets = sorted({evaluation['target'] for evaluation in self.evaluations})
+        best = [min((evaluation for evaluation in self.evaluations if evaluation['target'] == target), key=lambda evaluation: evaluation['ellipticity']) for target in targets]
+
+        return {
+            'hwp': np.array([evaluation['hwp'] for evaluation in best]),
+            'qwp_1': np.array([evaluation['qwp'] for evaluation in best]),
+            'ellipticity': np.array([evaluation['ellipticity'] for evaluation in best]),
+            'evaluations': np.array([sum(1 for evaluation in self.evaluations if evaluation['target'] == target) for target in targets])
+        }
+
+    def save(self, path):
+        np.savez(path, **self.results())
+
+def predicted_qwp_angles(compensation_filepath, hwp_angles=None):
+    data = np.load(compensation_filepath)
+    if hwp_angles is None:
+        return data['hwp'], data['qwp_1']
+
+    return np.asarray(hwp_angles, dtype=float), np.interp(hwp_angles, data['hwp'], data['qwp_1'])
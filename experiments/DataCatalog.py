@@ -0,0 +1,351 @@
+import json
+import os
+import re
+import sqlite3
+import zipfile
+from datetime import datetime, timezone
+
+import numpy as np
+
+from experiments.MappingManifest import MappingManifest
+from experiments.TimeSeriesStore import TimeSeriesStore
+
+
+RUN_FOLDER_PATTERN = re.compile(r'^(\d{8}T\d{6}Z)_(.+)$')
+HQWP_FILE_PATTERN = re.compile(r'^HWP-(\d{3})(?:_QWP-(\d{3}))?$')
+HWP_FILE_PATTERN = re.compile(r'^(\d{3})$')
+TIMESTAMP_FILE_PATTERN = re.compile(r'^(\d{8}T\d{6}Z)')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    folder TEXT PRIMARY KEY,
+    run_type TEXT,
+    started REAL,
+    detector TEXT,
+    hwp_steps INTEGER,
+    qwp_steps INTEGER,
+    number_of_points INTEGER,
+    number_of_files INTEGER,
+    complete INTEGER,
+    manifest_mtime REAL,
+    number_of_records INTEGER,
+    first_timestamp REAL,
+    last_timestamp REAL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    folder TEXT,
+    name TEXT,
+    mtime REAL,
+    size INTEGER,
+    acquired REAL,
+    detector TEXT,
+    hwp_index INTEGER,
+    qwp_index INTEGER,
+    hwp REAL,
+    qwp REAL,
+    number_of_angles INTEGER,
+    analog_samples INTEGER,
+    calibration_mean REAL,
+    calibration_std REAL,
+    calibration_timestamp REAL,
+    has_timing_spans INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_by_type ON runs (run_type, started);
+CREATE INDEX IF NOT EXISTS runs_by_detector ON runs (detector, started);
+CREATE INDEX IF NOT EXISTS files_by_folder ON files (folder, hwp_index, qwp_index);
+"""
+
+# Columns added to the runs table after catalogs were first created.
+RUN_COLUMNS_ADDED = {'number_of_records': 'INTEGER', 'first_timestamp': 'REAL', 'last_timestamp': 'REAL'}
+RUN_COLUMNS = ['folder', 'run_type', 'started', 'detector', 'hwp_steps', 'qwp_steps', 'number_of_points', 'number_of_files', 'complete', 'manifest_mtime'] + list(RUN_COLUMNS_ADDED)
+
+def parse_timestamp(text):
+    timestamp_format = '%Y%m%dT%H%M%S.%fZ' if '.' in text else '%Y%m%dT%H%M%SZ'
+
+    return datetime.strptime(text, timestamp_format).replace(tzinfo=timezone.utc).timestamp()
+
+def read_npz_shapes(path):
+    # Only the .npy headers are read, the arrays themselves stay on disk.
+    shapes = {}
+    with zipfile.ZipFile(path) as archive:
+        for member in archive.namelist():
+            if not member.endswith('.npy'):
+                continue
+            with archive.open(member) as file:
+                if np.lib.format.read_magic(file) == (1, 0):
+                    shape, _, _ = np.lib.format.read_array_header_1_0(file)
+                else:
+                    shape, _, _ = np.lib.format.read_array_header_2_0(file)
+            shapes[member[:-len('.npy')]] = shape
+
+    return shapes
+
+def read_npz_scalar(data, key):
+    if key not in data.files:
+        return None
+
+    value = float(data[key])
+    return None if np.isnan(value) else value
+
+class DataCatalog:
+    DEFAULT_FILENAME = 'catalog.sqlite'
+
+    def __init__(self, root_folder, database_path=None):
+        self.root_folder = os.path.abspath(root_folder)
+        self.database_path = database_path if database_path is not None else os.path.join(self.root_folder, self.DEFAULT_FILENAME)
+
+        self.connection = sqlite3.connect(self.database_path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+        existing_columns = {row['name'] for row in self.connection.execute('PRAGMA table_info(runs)')}
+        for column, column_type in RUN_COLUMNS_ADDED.items():
+            if column not in existing_columns:
+                self.connection.execute(f'ALTER TABLE runs ADD COLUMN {column} {column_type}')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def scan(self):
+        known_files = {row['path']: (row['mtime'], row['size']) for row in self.connection.execute('SELECT path, mtime, size FROM files')}
+        known_stores = {row['folder']: row['number_of_records'] for row in self.connection.execute('SELECT folder, number_of_records FROM runs WHERE number_of_records IS NOT NULL')}
+        seen_files = set()
+        seen_stores = set()
+        changed_folders = set()
+        changed_stores = 0
+
+        for folder, _, filenames in os.walk(self.root_folder):
+            relative_folder = os.path.relpath(folder, self.root_folder)
+            manifest = self.__load_manifest(folder)
+            manifest_points = {point['name']: point for point in manifest.points} if manifest is not None else {}
+
+            for filename in filenames:
+                if filename.endswith('.bin') and filename[:-len('.bin')] + '.json' in filenames:
+                    # Time lapse stores are runs of their own, next to the other runs in the data folder.
+                    store = os.path.normpath(os.path.join(relative_folder, filename[:-len('.bin')]))
+                    try:
+                        if self.__index_store(store, known_stores.get(store)):
+                            changed_stores += 1
+                        seen_stores.add(store)
+                    except (OSError, ValueError, KeyError):
+                        print(f"WARNING: unable to index {store}.")
+                    continue
+                if not filename.endswith('.npz'):
+                    continue
+
+                path = os.path.join(relative_folder, filename)
+                stat = os.stat(os.path.join(folder, filename))
+                seen_files.add(path)
+                if known_files.get(path) == (stat.st_mtime, stat.st_size):
+                    continue
+
+                try:
+                    record = self.__index_file(folder, filename, manifest, manifest_points)
+                except (OSError, ValueError, zipfile.BadZipFile):
+                    print(f"WARNING: unable to index {path}.")
+                    continue
+
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO files VALUES (:path, :folder, :name, :mtime, :size, :acquired, :detector, :hwp_index, :qwp_index, :hwp, :qwp, '
+                    ':number_of_angles, :analog_samples, :calibration_mean, :calibration_std, :calibration_timestamp, :has_timing_spans)',
+                    record | {'path': path, 'folder': relative_folder, 'mtime': stat.st_mtime, 'size': stat.st_size}
+                )
+                changed_folders.add(relative_folder)
+
+            manifest_path = os.path.join(folder, MappingManifest.FILENAME)
+            if os.path.isfile(manifest_path):
+                stored = self.connection.execute('SELECT manifest_mtime FROM runs WHERE folder = ?', (relative_folder,)).fetchone()
+                if stored is None or stored['manifest_mtime'] != os.stat(manifest_path).st_mtime:
+                    changed_folders.add(relative_folder)
+
+        removed_files = set(known_files) - seen_files
+        for path in removed_files:
+            changed_folders.add(self.connection.execute('SELECT folder FROM files WHERE path = ?', (path,)).fetchone()['folder'])
+            self.connection.execute('DELETE FROM files WHERE path = ?', (path,))
+
+        for relative_folder in changed_folders:
+            self.__index_run(relative_folder)
+
+        removed_stores = set(known_stores) - seen_stores
+        for store in removed_stores:
+            self.connection.execute('DELETE FROM runs WHERE folder = ?', (store,))
+
+        self.connection.commit()
+
+        return {
+            'indexed_folders': len(changed_folders),
+            'removed_files': len(removed_files),
+            'files': len(seen_files),
+            'indexed_time_lapses': changed_stores,
+            'removed_time_lapses': len(removed_stores),
+            'time_lapses': len(seen_stores)
+        }
+
+    def __insert_run(self, run):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO runs ({}) VALUES ({})'.format(', '.join(RUN_COLUMNS), ', '.join(':' + column for column in RUN_COLUMNS)),
+            {column: None for column in RUN_COLUMNS} | run
+        )
+
+    def __index_store(self, store, known_number_of_records):
+        # Records are only appended, so the record count tells whether the store changed. Only the header, the
+        # first and the last record are read.
+        path = os.path.join(self.root_folder, store)
+        records = TimeSeriesStore.read(path)
+        if known_number_of_records == len(records):
+            return False
+
+        match = RUN_FOLDER_PATTERN.match(os.path.basename(store))
+        first_timestamp = float(records[0]['timestamp']) if len(records) > 0 else None
+        self.__insert_run({
+            'folder': store,
+            'run_type': 'time_lapse',
+            'started': parse_timestamp(match.group(1)) if match is not None else first_timestamp,
+            'number_of_files': 0,
+            'number_of_records': len(records),
+            'first_timestamp': first_timestamp,
+            'last_timestamp': float(records[-1]['timestamp']) if len(records) > 0 else None
+        })
+
+        return True
+
+    def __load_manifest(self, folder):
+        if not os.path.isfile(os.path.join(folder, MappingManifest.FILENAME)):
+            return None
+
+        try:
+            return MappingManifest.load(folder)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def __index_file(self, folder, filename, manifest, manifest_points):
+        name = filename[:-len('.npz')]
+        path = os.path.join(folder, filename)
+        shapes = read_npz_shapes(path)
+
+        record = {
+            'name': name,
+            'acquired': None,
+            'detector': 'photodiode' if 'analog_data' in shapes else 'powermeter',
+            'hwp_index': None,
+            'qwp_index': None,
+            'hwp': None,
+            'qwp': None,
+            'number_of_angles': shapes['measurement_data'][-1] if 'measurement_data' in shapes else None,
+            'analog_samples': shapes['analog_data'][-1] if 'analog_data' in shapes else None,
+            'calibration_mean': None,
+            'calibration_std': None,
+            'calibration_timestamp': None,
+            'has_timing_spans': 'timing_spans' in shapes
+        }
+
+        if (match := HQWP_FILE_PATTERN.match(name)) is not None:
+            record['hwp_index'] = int(match.group(1))
+            record['qwp_index'] = int(match.group(2)) if match.group(2) is not None else None
+        elif (match := HWP_FILE_PATTERN.match(name)) is not None:
+            record['hwp_index'] = int(match.group(1))
+        elif (match := TIMESTAMP_FILE_PATTERN.match(name)) is not None:
+            record['acquired'] = parse_timestamp(match.group(1))
+
+        if manifest is not None:
+            point = manifest_points.get(name)
+            if point is not None:
+                record['hwp'] = point.get('hwp')
+                record['qwp'] = point.get('qwp')
+            completed = manifest.completed.get(name)
+            if completed is not None and record['acquired'] is None:
+                record['acquired'] = parse_timestamp(completed['timestamp'])
+
+        if record['detector'] == 'photodiode':
+            with np.load(path) as data:
+                record['calibration_mean'] = read_npz_scalar(data, 'calibration_mean')
+                record['calibration_std'] = read_npz_scalar(data, 'calibration_std')
+                record['calibration_timestamp'] = read_npz_scalar(data, 'calibration_timestamp')
+
+        return record
+
+    def __index_run(self, relative_folder):
+        files = self.connection.execute(
+            'SELECT COUNT(*) AS number_of_files, MAX(hwp_index) AS hwp_max, MAX(qwp_index) AS qwp_max, MIN(acquired) AS first_acquired, MIN(detector) AS detector '
+            'FROM files WHERE folder = ?', (relative_folder,)
+        ).fetchone()
+
+        if files['number_of_files'] == 0:
+            self.connection.execute('DELETE FROM runs WHERE folder = ? AND number_of_records IS NULL', (relative_folder,))
+            return
+
+        folder = os.path.join(self.root_folder, relative_folder)
+        match = RUN_FOLDER_PATTERN.match(os.path.basename(relative_folder))
+        run = {
+            'folder': relative_folder,
+            'run_type': match.group(2) if match is not None else None,
+            'started': parse_timestamp(match.group(1)) if match is not None else files['first_acquired'],
+            'detector': files['detector'],
+            'hwp_steps': files['hwp_max'] + 1 if files['hwp_max'] is not None else None,
+            'qwp_steps': files['qwp_max'] + 1 if files['qwp_max'] is not None else None,
+            'number_of_points': None,
+            'number_of_files': files['number_of_files'],
+            'complete': None,
+            'manifest_mtime': None
+        }
+
+        manifest = self.__load_manifest(folder)
+        if manifest is not None:
+            run['run_type'] = manifest.experiment
+            run['detector'] = manifest.parameters.get('detector', run['detector'])
+            run['hwp_steps'] = manifest.parameters.get('hwp_mapping_steps', run['hwp_steps'])
+            run['qwp_steps'] = manifest.parameters.get('qwp_mapping_steps', run['qwp_steps'])
+            run['number_of_points'] = len(manifest.points)
+            run['complete'] = manifest.is_complete()
+            run['manifest_mtime'] = os.stat(os.path.join(folder, MappingManifest.FILENAME)).st_mtime
+        elif run['run_type'] is None and files['first_acquired'] is not None:
+            run['run_type'] = 'time_lapse'
+
+        self.__insert_run(run)
+
+    def runs(self, run_type=None, detector=None, since=None, until=None, complete=None):
+        clauses = []
+        arguments = []
+        if run_type is not None:
+            clauses.append('run_type = ?')
+            arguments.append(run_type)
+        if detector is not None:
+            clauses.append('detector = ?')
+            arguments.append(detector.lower())
+        if since is not None:
+            clauses.append('started >= ?')
+            arguments.append(since.timestamp())
+        if until is not None:
+            clauses.append('started < ?')
+            arguments.append(until.timestamp())
+        if complete is not None:
+            clauses.append('complete = ?')
+            arguments.append(int(complete))
+
+        query = 'SELECT * FROM runs'
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        query += ' ORDER BY started'
+
+        return [dict(row) for row in self.connection.execute(query, arguments)]
+
+    def files(self, folder):
+        rows = self.connection.execute('SELECT * FROM files WHERE folder = ? ORDER BY hwp_index, qwp_index, acquired, name', (folder,))
+
+        return [dict(row) | {'fullpath': os.path.join(self.root_folder, row['path'])} for row in rows]
+
+    def latest(self, run_type, detector=None):
+        runs = self.runs(run_type=run_type, detector=detector)
+
+        return runs[-1] if runs else None
+
+    def describe(self, run):
+        return json.dumps(run | {'started': datetime.fromtimestamp(run['started'], tz=timezone.utc).strftime('%Y-%m-%d %H:%M') if run['started'] is not None else None})
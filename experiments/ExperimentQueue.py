@@ -0,0 +1,158 @@
+import threading
+import time
+from collections import deque
+from itertools import count
+
+
+class ExperimentCancelledError(Exception):
+    pass
+
+class Job:
+    def __init__(self, job_id, name, function, parameters):
+        self.job_id = job_id
+        self.name = name
+        self.function = function
+        self.parameters = parameters
+        self.status = 'queued'
+        self.error = None
+        self.start_time = None
+        self.end_time = None
+
+    def describe(self):
+        return {
+            'id': self.job_id,
+            'name': self.name,
+            'parameters': ', '.join(f'{key}={value}' for key, value in self.parameters.items()),
+            'status': self.status,
+            'error': self.error or ''
+        }
+
+class ExperimentQueue:
+    def __init__(self):
+        self.current_job = None
+        self.history = []
+
+        self.__jobs = deque()
+        self.__job_ids = count(1)
+        self.__condition = threading.Condition()
+        self.__resumed = threading.Event()
+        self.__resumed.set()
+        self.__cancel_current = threading.Event()
+        self.__stopped = False
+
+        self.__worker = threading.Thread(target=self.__run, daemon=True)
+        self.__worker.start()
+
+    def submit(self, name, function, **parameters):
+        with self.__condition:
+            job = Job(next(self.__job_ids), name, function, parameters)
+            self.__jobs.append(job)
+            self.__condition.notify()
+
+        return job
+
+    def jobs(self):
+        with self.__condition:
+            pending = list(self.__jobs)
+            current = [self.current_job] if self.current_job is not None else []
+
+            return self.history + current + pending
+
+    def is_busy(self):
+        with self.__condition:
+            return self.current_job is not None or len(self.__jobs) > 0
+
+    def is_paused(self):
+        return not self.__resumed.is_set()
+
+    def pause(self):
+        self.__resumed.clear()
+
+    def resume(self):
+        self.__resumed.set()
+
+    def cancel(self, job_id=None):
+        with self.__condition:
+            if self.current_job is not None and job_id in (None, self.current_job.job_id):
+                self.__cancel_current.set()
+                return
+
+            for job in self.__jobs:
+                if job.job_id == job_id:
+                    self.__jobs.remove(job)
+                    job.status = 'cancelled'
+                    self.history.append(job)
+                    return
+
+    def cancel_all(self):
+        with self.__condition:
+            while self.__jobs:
+                job = self.__jobs.popleft()
+                job.status = 'cancelled'
+                self.history.append(job)
+
+            if self.current_job is not None:
+                self.__cancel_current.set()
+
+    def clear_history(self):
+        with self.__condition:
+            self.history = []
+
+    def checkpoint(self):
+        while not self.__resumed.wait(timeout=0.1):
+            if self.__cancel_current.is_set():
+                break
+
+        if self.__cancel_current.is_set():
+            raise ExperimentCancelledError
+
+    def sleep(self, seconds):
+        deadline = time.monotonic() + seconds
+        while (remaining := deadline - time.monotonic()) > 0:
+            if self.__cancel_current.wait(timeout=min(remaining, 0.1)):
+                break
+
+        self.checkpoint()
+
+    def stop(self):
+        self.cancel_all()
+        self.__resumed.set()
+
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify()
+
+        self.__worker.join()
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not self.__jobs and not self.__stopped:
+                    self.__condition.wait()
+
+                if self.__stopped:
+                    return
+
+                self.current_job = self.__jobs.popleft()
+                self.__cancel_current.clear()
+
+            job = self.current_job
+            job.status = 'running'
+            job.start_time = time.time()
+
+            try:
+                self.checkpoint()
+                job.function(**job.parameters)
+                job.status = 'done'
+            except ExperimentCancelledError:
+                job.status = 'cancelled'
+            except Exception as exception:
+                job.status = 'failed'
+                job.error = repr(exception)
+                print('ERROR: experiment {} (job {}) failed with {}.'.format(job.name, job.job_id, job.error))
+
+            job.end_time = time.time()
+
+            with self.__condition:
+                self.history.append(job)
+                self.current_job = None
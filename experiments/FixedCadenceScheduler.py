@@ -0,0 +1,34 @@
+import time
+
+
+class FixedCadenceScheduler:
+    def __init__(self, interval_in_seconds, duration_in_seconds, sleep=time.sleep):
+        self.interval_in_seconds = interval_in_seconds
+        self.number_of_slots = max(1, int(duration_in_seconds // interval_in_seconds))
+        self.missed_slots = []
+        self.sleep = sleep
+
+    def __iter__(self):
+        start_monotonic = time.monotonic()
+        start_time = time.time()
+
+        slot = 0
+        while slot < self.number_of_slots:
+            deadline = start_monotonic + slot * self.interval_in_seconds
+            lateness = time.monotonic() - deadline
+
+            if lateness < 0:
+                self.sleep(-lateness)
+            elif lateness >= self.interval_in_seconds:
+                number_of_missed_slots = min(int(lateness // self.interval_in_seconds), self.number_of_slots - slot)
+                missed_slots = list(range(slot, slot + number_of_missed_slots))
+                self.missed_slots.extend(missed_slots)
+                print('WARNING: time lapse missed slot(s) {}.'.format(', '.join(str(missed_slot) for missed_slot in missed_slots)))
+                slot += number_of_missed_slots
+                continue
+
+            yield slot, start_time + slot * self.interval_in_seconds
+            slot += 1
+
+    def progress(self, slot):
+        return (slot + 1) / self.number_of_slots
@@ -0,0 +1,131 @@
+import math
+from typing import Optional
+
+from fastapi import HTTPException
+from pydantic import BaseModel
+
+import instrumentation
+from experiments.AcquisitionService import HardwareNotConnectedError, HardwareBusyError, UnknownExperimentError
+
+
+class ConnectRequest(BaseModel):
+    detector: str = 'Photodiode'
+    polarimeter_only: bool = False
+
+class SnapRequest(BaseModel):
+    path: Optional[str] = None
+    profile: bool = False
+
+class ExperimentRequest(BaseModel):
+    name: str
+    parameters: dict = {}
+    profile: bool = False
+
+def json_safe(content):
+    if isinstance(content, dict):
+        return {key: json_safe(value) for key, value in content.items()}
+    if isinstance(content, list):
+        return [json_safe(value) for value in content]
+    if isinstance(content, float) and not math.isfinite(content):
+        return None
+
+    return content
+
+def register_routes(app, service, prefix='/api'):
+    def require_idle():
+        if service.experiment_queue.is_busy():
+            raise HTTPException(status_code=409, detail='An experiment is running.')
+
+    @app.get(prefix + '/status')
+    def status():
+        return json_safe(service.status())
+
+    @app.post(prefix + '/connect')
+    def connect(request: ConnectRequest):
+        if service.is_connected():
+            raise HTTPException(status_code=409, detail='Hardware is already connected.')
+
+        error = service.connect(request.detector, polarimeter_only=request.polarimeter_only)
+        if error is not None:
+            raise HTTPException(status_code=503, detail=error)
+
+        return json_safe(service.status())
+
+    @app.post(prefix + '/disconnect')
+    def disconnect():
+        require_idle()
+        service.disconnect()
+
+        return json_safe(service.status())
+
+    @app.post(prefix + '/snap')
+    def snap(request: SnapRequest):
+        require_idle()
+
+        # The UI listeners render into the NiceGUI client, which is not available from the API threadpool.
+        try:
+            result = service.snap(request.path, profile=request.profile, notify_listeners=False, blocking=False)
+        except HardwareNotConnectedError:
+            raise HTTPException(status_code=409, detail='Hardware is not connected.')
+        except HardwareBusyError:
+            raise HTTPException(status_code=409, detail='A measurement or calibration is running.')
+
+        if result is None:
+            raise HTTPException(status_code=504, detail='Unable to acquire data, check DAQ timeout if using Photodiode.')
+
+        return json_safe(result)
+
+    @app.post(prefix + '/calibrate')
+    def calibrate():
+        require_idle()
+
+        try:
+            return json_safe(service.calibrate(blocking=False))
+        except HardwareNotConnectedError:
+            raise HTTPException(status_code=409, detail='Calibration requires a connected photodiode.')
+        except HardwareBusyError:
+            raise HTTPException(status_code=409, detail='A measurement or calibration is running.')
+
+    @app.get(prefix + '/timing')
+    def timing():
+        return instrumentation.percentiles()
+
+    @app.get(prefix + '/experiments')
+    def experiments():
+        return [job.describe() for job in service.experiment_queue.jobs()]
+
+    @app.post(prefix + '/experiments')
+    def submit(request: ExperimentRequest):
+        if not service.is_connected():
+            raise HTTPException(status_code=409, detail='Hardware is not connected.')
+
+        try:
+            job = service.submit(request.name, profile=request.profile, **request.parameters)
+        except UnknownExperimentError:
+            raise HTTPException(status_code=404, detail=f'Unknown experiment {request.name}, expected one of {list(service.experiments)}.')
+
+        return job.describe()
+
+    @app.post(prefix + '/experiments/{job_id}/cancel')
+    def cancel(job_id: int):
+        service.experiment_queue.cancel(job_id)
+
+        return [job.describe() for job in service.experiment_queue.jobs()]
+
+    @app.post(prefix + '/queue/pause')
+    def pause():
+        service.experiment_queue.pause()
+
+        return json_safe(service.status())
+
+    @app.post(prefix + '/queue/resume')
+    def resume():
+        service.experiment_queue.resume()
+
+        return json_safe(service.status())
+
+    @app.post(prefix + '/queue/cancel')
+    def cancel_all():
+        service.experiment_queue.cancel_all()
+
+        return json_safe(service.status())
@@ -0,0 +1,114 @@
+import json
+import os
+from datetime import datetime, timezone
+
+
+class ManifestNotFoundError(Exception):
+    pass
+
+class ManifestMismatchError(Exception):
+    pass
+
+class MappingManifest:
+    FILENAME = 'manifest.json'
+
+    def __init__(self, folder, experiment, parameters, points, completed=None, created=None, quality=None):
+        self.folder = folder
+        self.experiment = experiment
+        self.parameters = parameters
+        self.points = points
+        self.completed = completed if completed is not None else {}
+        self.created = created if created is not None else datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        self.quality = quality if quality is not None else {}
+
+    @classmethod
+    def create(cls, folder, experiment, parameters, points):
+        manifest = cls(folder, experiment, parameters, points)
+        manifest.save()
+
+        return manifest
+
+    @classmethod
+    def load(cls, folder):
+        path = os.path.join(folder, cls.FILENAME)
+        if not os.path.isfile(path):
+            raise ManifestNotFoundError(path)
+
+        with open(path, 'r') as file:
+            content = json.load(file)
+
+        return cls(
+            folder,
+            content['experiment'],
+            content['parameters'],
+            content['points'],
+            completed=content['completed'],
+            created=content['created'],
+            quality=content.get('quality')
+        )
+
+    def save(self):
+        path = os.path.join(self.folder, self.FILENAME)
+        temporary_path = path + '.tmp'
+
+        with open(temporary_path, 'w') as file:
+            json.dump({
+                'experiment': self.experiment,
+                'created': self.created,
+                'parameters': self.parameters,
+                'points': self.points,
+                'completed': self.completed,
+                'quality': self.quality
+            }, file, indent=1)
+
+        os.replace(temporary_path, path)
+
+    def point_path(self, point):
+        return os.path.join(self.folder, point['name'])
+
+    def mark_completed(self, point, hardware_state):
+        self.completed[point['name']] = dict(
+            hardware_state,
+            timestamp=datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S.%fZ')
+        )
+        self.save()
+
+    def record_quality(self, point, result, failures):
+        attempt = {
+            'timestamp': datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S.%fZ'),
+            'passed': not failures,
+            'failures': failures
+        }
+        if result is not None:
+            attempt |= {key: result[key] for key in ('ellipticity', 'nrmse', 'missed_triggers')}
+
+        self.quality.setdefault(point['name'], []).append(attempt)
+        self.save()
+
+    def failed_quality_points(self):
+        return [name for name, attempts in self.quality.items() if attempts and not attempts[-1]['passed']]
+
+    def validate(self, detector):
+        if self.parameters.get('detector') != detector:
+            raise ManifestMismatchError('run acquired with {}, current detector is {}'.format(self.parameters.get('detector'), detector))
+
+        for name in list(self.completed):
+            if not os.path.isfile(os.path.join(self.folder, name + '.npz')):
+                print('WARNING: {} is marked as completed but its data file is missing, it will be acquired again.'.format(name))
+                del self.completed[name]
+
+        self.save()
+
+    def missing_points(self):
+        return [point for point in self.points if point['name'] not in self.completed]
+
+    def points_to_measure(self):
+        # Missing points, and completed points whose last attempt failed the quality gates.
+        failed = set(self.failed_quality_points())
+        return [point for point in self.points if point['name'] not in self.completed or point['name'] in failed]
+
+    def progress(self):
+        return len(self.completed) / len(self.points)
+
+    def is_complete(self):
+        return len(self.completed) == len(self.points)
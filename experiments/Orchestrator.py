@@ -0,0 +1,274 @@
+import CONFIG
+
+import multiprocessing
+import threading
+from concurrent.futures import Future
+from itertools import count
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SetupWorkerError(Exception):
+    pass
+
+class UnknownSetupError(Exception):
+    pass
+
+class SharedArrayRing:
+    # Fixed slots of float64 values in one shared memory block. Each slot starts with its sequence number and the
+    # shapes of the measurement and analog arrays, so the reader can tell when a slot was overwritten meanwhile.
+    HEADER_LENGTH = 5
+
+    def __init__(self, number_of_slots, slot_length, name=None):
+        self.number_of_slots = number_of_slots
+        self.slot_length = slot_length
+        self.owner = name is None
+
+        self.memory = shared_memory.SharedMemory(name=name, create=self.owner, size=8 * number_of_slots * (self.HEADER_LENGTH + slot_length))
+        self.buffer = np.ndarray((number_of_slots, self.HEADER_LENGTH + slot_length), dtype=np.float64, buffer=self.memory.buf)
+        self.sequence = count()
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def write(self, measurement_data, analog_data):
+        if analog_data is None or measurement_data.size + analog_data.size > self.slot_length:
+            analog_data = np.zeros((0, 0))
+
+        sequence = next(self.sequence)
+        slot = self.buffer[sequence % self.number_of_slots]
+        measurement_end = self.HEADER_LENGTH + measurement_data.size
+
+        slot[0] = -1
+        slot[1:self.HEADER_LENGTH] = (*measurement_data.shape, *analog_data.shape)
+        slot[self.HEADER_LENGTH:measurement_end] = measurement_data.ravel()
+        slot[measurement_end:measurement_end + analog_data.size] = analog_data.ravel()
+        slot[0] = sequence
+
+        return sequence
+
+    def read(self, sequence):
+        # The sequence is checked before the header is trusted and again after the copy, a slot being rewritten
+        # meanwhile reads as overwritten instead of as arrays of the wrong shape.
+        slot = self.buffer[sequence % self.number_of_slots]
+        if slot[0] != sequence:
+            return None
+
+        header = slot[1:self.HEADER_LENGTH].copy()
+        if np.any(header < 0) or not np.all(np.isfinite(header)):
+            return None
+        measurement_shape = tuple(int(value) for value in header[0:2])
+        analog_shape = tuple(int(value) for value in header[2:4])
+        measurement_end = self.HEADER_LENGTH + int(np.prod(measurement_shape))
+        analog_end = measurement_end + int(np.prod(analog_shape))
+        if analog_end > self.HEADER_LENGTH + self.slot_length:
+            return None
+
+        measurement_data = slot[self.HEADER_LENGTH:measurement_end].copy()
+        analog_data = slot[measurement_end:analog_end].copy()
+
+        if slot[0] != sequence:
+            return None
+
+        return measurement_data.reshape(measurement_shape), analog_data.reshape(analog_shape)
+
+    def close(self):
+        del self.buffer
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+def run_setup_worker(setup, config_path, commands, results, ring_slots, ring_slot_length):
+    # Runs in the setup's own process, with its own AcquisitionService, experiment queue and hardware.
+    CONFIG.load_config(config_path)
+
+    from experiments.AcquisitionService import AcquisitionService
+
+    service = AcquisitionService(config_path)
+    ring = SharedArrayRing(ring_slots, ring_slot_length)
+
+    def publish(analyzer, fitted_intensity, polarization_parameters):
+        sequence = ring.write(analyzer.measurement_data, analyzer.analog_data)
+        results.put(('measurement', setup, None, {'sequence': sequence, 'parameters': polarization_parameters}))
+
+    service.measurement_listeners.append(publish)
+
+    handlers = {
+        'connect': service.connect,
+        'disconnect': service.disconnect,
+        'snap': service.snap,
+        'calibrate': service.calibrate,
+        'status': service.status,
+        'submit': lambda name, parameters: service.submit(name, **parameters).describe(),
+        'jobs': lambda: [job.describe() for job in service.experiment_queue.jobs()],
+        'pause': service.experiment_queue.pause,
+        'resume': service.experiment_queue.resume,
+        'cancel': service.experiment_queue.cancel,
+        'cancel_all': service.experiment_queue.cancel_all
+    }
+
+    results.put(('ready', setup, None, ring.name))
+    try:
+        while True:
+            command, request_id, arguments = commands.get()
+            if command == 'stop':
+                break
+
+            try:
+                results.put(('reply', setup, request_id, handlers[command](**arguments)))
+            except Exception as error:
+                results.put(('error', setup, request_id, f'{type(error).__name__}: {error}'))
+    finally:
+        service.disconnect()
+        results.put(('stopped', setup, None, None))
+        ring.close()
+
+class Orchestrator:
+    def __init__(self, setups, ring_slots=8, ring_slot_length=2*(360 + 200000), start_timeout=60):
+        # setups maps each setup name to its config file (serial numbers, channels, resources).
+        self.setups = dict(setups)
+        self.measurement_listeners = []
+        self.ring_slots = ring_slots
+        self.ring_slot_length = ring_slot_length
+
+        context = multiprocessing.get_context('spawn')
+        self.__results = context.Queue()
+        self.__commands = {setup: context.Queue() for setup in self.setups}
+        self.__rings = {}
+        self.__ready = {setup: threading.Event() for setup in self.setups}
+        self.__stopped = {setup: threading.Event() for setup in self.setups}
+        self.__pending = {}
+        self.__request_ids = count()
+        self.__lock = threading.Lock()
+
+        self.__processes = {
+            setup: context.Process(
+                target=run_setup_worker,
+                args=(setup, config_path, self.__commands[setup], self.__results, ring_slots, ring_slot_length),
+                name=f'setup-{setup}',
+                daemon=True
+            )
+            for setup, config_path in self.setups.items()
+        }
+        for process in self.__processes.values():
+            process.start()
+
+        self.__listener = threading.Thread(target=self.__listen, daemon=True)
+        self.__listener.start()
+
+        for setup, ready in self.__ready.items():
+            if not ready.wait(timeout=start_timeout):
+                self.stop()
+                raise SetupWorkerError(f'setup {setup} did not start')
+
+    def __listen(self):
+        while not all(stopped.is_set() for stopped in self.__stopped.values()):
+            try:
+                message = self.__results.get()
+            except Exception as error:
+                # Without the result queue no reply can arrive anymore.
+                self.__fail_pending(SetupWorkerError(f'result queue failed with {type(error).__name__}: {error}'))
+                return
+
+            try:
+                self.__handle(*message)
+            except Exception as error:
+                _, setup, request_id, _ = message
+                with self.__lock:
+                    future = self.__pending.pop(request_id, None) if request_id is not None else None
+                if future is not None:
+                    future.set_exception(SetupWorkerError(f'{setup}: {type(error).__name__}: {error}'))
+                else:
+                    print(f"WARNING: message {message[0]} of {setup} could not be handled ({type(error).__name__}: {error}).")
+
+        self.__fail_pending(SetupWorkerError('orchestrator stopped'))
+
+    def __fail_pending(self, error):
+        with self.__lock:
+            pending, self.__pending = self.__pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    def __handle(self, kind, setup, request_id, content):
+        match kind:
+            case 'ready':
+                self.__rings[setup] = SharedArrayRing(self.ring_slots, self.ring_slot_length, name=content)
+                self.__ready[setup].set()
+            case 'measurement':
+                arrays = self.__rings[setup].read(content['sequence'])
+                if arrays is None:
+                    print(f"WARNING: measurement {content['sequence']} of {setup} was overwritten before it was read.")
+                    return
+                for listener in self.measurement_listeners:
+                    listener(setup, *arrays, content['parameters'])
+            case 'reply' | 'error':
+                with self.__lock:
+                    future = self.__pending.pop(request_id, None)
+                if future is None:
+                    return
+                if kind == 'reply':
+                    future.set_result(content)
+                else:
+                    future.set_exception(SetupWorkerError(f'{setup}: {content}'))
+            case 'stopped':
+                if setup in self.__rings:
+                    self.__rings.pop(setup).close()
+                self.__stopped[setup].set()
+
+    def request(self, setup, command, **arguments):
+        if setup not in self.setups:
+            raise UnknownSetupError(setup)
+
+        future = Future()
+        with self.__lock:
+            request_id = next(self.__request_ids)
+            self.__pending[request_id] = future
+        self.__commands[setup].put((command, request_id, arguments))
+
+        return future
+
+    def call(self, setup, command, timeout=None, **arguments):
+        return self.request(setup, command, **arguments).result(timeout=timeout)
+
+    def broadcast(self, command, timeout=None, **arguments):
+        # Commands run concurrently on every setup, the replies are collected afterwards.
+        futures = {setup: self.request(setup, command, **arguments) for setup in self.setups}
+
+        return {setup: future.result(timeout=timeout) for setup, future in futures.items()}
+
+    def connect(self, detector, polarimeter_only=False):
+        return self.broadcast('connect', detector=detector, polarimeter_only=polarimeter_only)
+
+    def status(self):
+        return self.broadcast('status')
+
+    def submit(self, name, setup=None, **parameters):
+        if setup is None:
+            setup = self.least_busy_setup()
+
+        return setup, self.call(setup, 'submit', name=name, parameters=parameters)
+
+    def least_busy_setup(self):
+        pending_jobs = {
+            setup: sum(1 for job in jobs if job['status'] in ('queued', 'running'))
+            for setup, jobs in self.broadcast('jobs').items()
+        }
+
+        return min(pending_jobs, key=pending_jobs.get)
+
+    def is_busy(self):
+        return any(status['busy'] for status in self.status().values())
+
+    def stop(self):
+        for setup, commands in self.__commands.items():
+            if self.__processes[setup].is_alive():
+                commands.put(('stop', None, {}))
+
+        for setup, process in self.__processes.items():
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+                self.__stopped[setup].set()
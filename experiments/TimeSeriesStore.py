@@ -0,0 +1,97 @@
+import json
+import os
+
+import numpy as np
+
+
+class TimeSeriesStore:
+    FIELDS = [
+        ('timestamp', 'f8'),
+        ('scheduled', 'f8'),
+        ('slot', 'i8'),
+        ('ellipticity', 'f8'),
+        ('e_max', 'f8'),
+        ('alpha_max', 'f8'),
+        ('nrmse', 'f8'),
+        ('missed_triggers', 'i4')
+    ]
+
+    def __init__(self, path, number_of_angles):
+        self.path = path
+        self.number_of_angles = number_of_angles
+        self.dtype = self.record_dtype(number_of_angles)
+
+        if os.path.isfile(self.header_path(path)):
+            header = self.read_header(path)
+            if header['number_of_angles'] != number_of_angles:
+                raise ValueError('{} was created with a different number of angles'.format(path))
+            if header['fields'] != [name for name, _ in self.FIELDS]:
+                raise ValueError('{} was created with different fields'.format(path))
+        else:
+            with open(self.header_path(path), 'w') as file:
+                json.dump({'number_of_angles': number_of_angles, 'fields': [name for name, _ in self.FIELDS]}, file)
+
+        self.__file = open(path + '.bin', 'ab')
+
+    @classmethod
+    def record_dtype(cls, number_of_angles, fields=None):
+        # Stores written before a field was added are read with the fields of their header.
+        types = dict(cls.FIELDS)
+        fields = [(name, types[name]) for name in fields] if fields is not None else cls.FIELDS
+
+        return np.dtype(fields + [
+            ('angles', 'f8', (number_of_angles,)),
+            ('intensity', 'f8', (number_of_angles,))
+        ])
+
+    @staticmethod
+    def header_path(path):
+        return path + '.json'
+
+    @staticmethod
+    def read_header(path):
+        with open(TimeSeriesStore.header_path(path), 'r') as file:
+            return json.load(file)
+
+    @classmethod
+    def read(cls, path):
+        header = cls.read_header(path)
+        dtype = cls.record_dtype(header['number_of_angles'], header.get('fields'))
+        number_of_records = os.path.getsize(path + '.bin') // dtype.itemsize
+
+        if number_of_records == 0:
+            return np.zeros(0, dtype=dtype)
+
+        return np.memmap(path + '.bin', dtype=dtype, mode='r', shape=(number_of_records,))
+
+    @staticmethod
+    def missed_slots(records):
+        slots = np.asarray(records['slot'])
+        if len(slots) == 0:
+            return np.zeros(0, dtype=int)
+
+        return np.setdiff1d(np.arange(slots[0], slots[-1] + 1), slots)
+
+    def append(self, timestamp, slot, measurement_data, ellipticity, e_max, alpha_max, nrmse, missed_triggers=0, scheduled=np.nan):
+        record = np.zeros(1, dtype=self.dtype)
+        record['timestamp'] = timestamp
+        record['scheduled'] = scheduled
+        record['slot'] = slot
+        record['ellipticity'] = ellipticity
+        record['e_max'] = e_max
+        record['alpha_max'] = alpha_max
+        record['nrmse'] = nrmse
+        record['missed_triggers'] = missed_triggers
+
+        number_of_points = min(measurement_data.shape[1], self.number_of_angles)
+        record['angles'] = np.nan
+        record['intensity'] = np.nan
+        record['angles'][0, :number_of_points] = measurement_data[0, :number_of_points]
+        record['intensity'][0, :number_of_points] = measurement_data[1, :number_of_points]
+
+        self.__file.write(record.tobytes())
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+
+    def close(self):
+        self.__file.close()
@@ -1,10 +1,18 @@
 import CONFIG
 CONFIG.load_config()
 
+import processing.processing
 from processing.processing import compute_polarization_parameters, compute_system_parameters, phi_motor_for_linear_polarization
+from experiments.TimeSeriesStore import TimeSeriesStore
 
+import argparse
+import hashlib
+import inspect
+import json
 import numpy as np
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from plotly.subplots import make_subplots
 import plotly.graph_objects as go
 
@@ -121,12 +129,12 @@ BEFORE_AFTER_SIZES = [
     3
 ]
 
-def pd_vs_pm():
+def pd_vs_pm(show=True):
     first_legend=True
     fig = make_subplots(rows=1, cols=len(PD_VS_PM_SUBFOLDERS), horizontal_spacing=0.07)
     for ii, subfolder in enumerate(PD_VS_PM_SUBFOLDERS):
         folder = os.path.join(ROOT_FOLDER, subfolder)
-        files = os.listdir(folder)
+        files = [ff for ff in os.listdir(folder) if ff.endswith('.npz')]
         pd_ellipticity = []
         pm_ellipticity = []
         for file in files:
@@ -204,14 +212,16 @@ def pd_vs_pm():
         title_font=dict(size=20),
         row=1, col=1
     )
-    fig.show()
-    # fig.write_image(r'pd_vs_pm.pdf', width=1000, height=800)
+    if show:
+        fig.show()
 
-def hwp_only():
+    return fig
+
+def hwp_only(show=True):
     fig = go.Figure()
     for ii, subfolder in enumerate(HWP_ONLY_SUBFOLDERS):
         folder = os.path.join(ROOT_FOLDER, subfolder)
-        files = os.listdir(folder)
+        files = [ff for ff in os.listdir(folder) if ff.endswith('.npz')]
         polarization_angle = []
         ellipticity = []
         for file in files:
@@ -281,8 +291,10 @@ def hwp_only():
             x=1
         )
     )
-    fig.show()
-    fig.write_image(r'hwp_only.pdf', width=500, height=400)
+    if show:
+        fig.show()
+
+    return fig
 
 def create_map(folder):
     hwp_motor_angles = np.linspace(0, 90, HQWP_NUM_HWP)
@@ -341,7 +353,7 @@ def create_map(folder):
 
     return ellipticity, theta_motor, phi_motor_solution_1, phi_motor_solution_2, ellipticity_along_fit, polarization_angle_along_fit
 
-def hqwp():
+def hqwp(show=True):
     fig = make_subplots(
         rows=len(HQWP_SUBFOLDERS),
         cols=1,shared_xaxes=True,
@@ -460,14 +472,16 @@ def hqwp():
             ) for annotation in fig.layout.annotations
         ]
     )
-    fig.show()
-    fig.write_image(r'hwp_qwp_map.pdf', width=500, height=400)
+    if show:
+        fig.show()
 
-def before_after():
+    return fig
+
+def before_after(show=True):
     fig = go.Figure()
     for ii, subfolder in enumerate(BEFORE_AFTER_SUBFOLDERS):
         folder = os.path.join(ROOT_FOLDER, subfolder)
-        files = os.listdir(folder)
+        files = [ff for ff in os.listdir(folder) if ff.endswith('.npz')]
         polarization_angle = []
         ellipticity = []
         for file in files:
@@ -550,23 +564,36 @@ def before_after():
             x=1
         )
     )
-    fig.show()
-    fig.write_image(r'before_after.pdf', width=500, height=400)
+    if show:
+        fig.show()
+
+    return fig
 
-def time_lapse():
+def time_lapse(show=True):
     time_lapse_folder = os.path.join(ROOT_FOLDER, REVISION_SUBFOLDER, TIME_LAPSE_SUBFOLDER)
-    files = os.listdir(time_lapse_folder)
-    dt_0 = datetime.strptime(files[0].split('.')[0], "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
-    epoch = datetime(1970, 1, 1, tzinfo=dt_0.tzinfo)
-    time_lapse_ellipticity = []
-    time_points = []
-    for file in files:
-        dt = datetime.strptime(file.split('.')[0], "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
-        time_points.append(epoch + (dt - dt_0))
-        fullpath = os.path.join(time_lapse_folder, file)
-        data = np.load(fullpath)['measurement_data']
-        ee, _, _, _, _ = compute_polarization_parameters(np.deg2rad(data[0,:]), data[1,:], max_intensity=CONFIG.detector_max_intensity)
-        time_lapse_ellipticity.append(ee)
+    stores = sorted(ff[:-len('.bin')] for ff in os.listdir(time_lapse_folder) if ff.endswith('_time_lapse.bin'))
+    if stores:
+        records = TimeSeriesStore.read(os.path.join(time_lapse_folder, stores[-1]))
+        dt_0 = datetime.fromtimestamp(records['timestamp'][0], tz=timezone.utc)
+        epoch = datetime(1970, 1, 1, tzinfo=dt_0.tzinfo)
+        time_points = [epoch + (datetime.fromtimestamp(tt, tz=timezone.utc) - dt_0) for tt in records['timestamp']]
+        time_lapse_ellipticity = np.array(records['ellipticity'])
+        missed_slots = TimeSeriesStore.missed_slots(records)
+        if len(missed_slots) > 0:
+            print(f"Missed slots: {missed_slots}")
+    else:
+        files = [ff for ff in os.listdir(time_lapse_folder) if ff.endswith('.npz')]
+        dt_0 = datetime.strptime(files[0].split('.')[0], "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+        epoch = datetime(1970, 1, 1, tzinfo=dt_0.tzinfo)
+        time_lapse_ellipticity = []
+        time_points = []
+        for file in files:
+            dt = datetime.strptime(file.split('.')[0], "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+            time_points.append(epoch + (dt - dt_0))
+            fullpath = os.path.join(time_lapse_folder, file)
+            data = np.load(fullpath)['measurement_data']
+            ee, _, _, _, _ = compute_polarization_parameters(np.deg2rad(data[0,:]), data[1,:], max_intensity=CONFIG.detector_max_intensity)
+            time_lapse_ellipticity.append(ee)
     
     print(f"Average Ellipticity: {np.mean(time_lapse_ellipticity):.4f}")
     print(f"Ellipticity Std Dev: {np.std(time_lapse_ellipticity):.4f}")
@@ -622,12 +649,125 @@ def time_lapse():
             x=1
         )
     )
-    fig.show()
-    # fig.write_image(r'time_lapse.pdf', width=1000, height=800)
+    if show:
+        fig.show()
+
+    return fig
+
+FIGURES = {
+    'pd_vs_pm': dict(function=pd_vs_pm, helpers=[], inputs=PD_VS_PM_SUBFOLDERS, outputs=['pd_vs_pm.pdf'], width=1000, height=800,
+                     parameters=[QWP_STATES, UPPER_HALF_Y_RANGE_FACTOR, LOWER_HALF_Y_RANGE_FACTOR, Y_RANGE_STEP]),
+    'hwp_only': dict(function=hwp_only, helpers=[], inputs=HWP_ONLY_SUBFOLDERS, outputs=['hwp_only.pdf'], width=500, height=400,
+                     parameters=[HWP_MEAS_LOC, HWP_MEAS_COL, HWP_MEAS_COL_OPA]),
+    'hqwp': dict(function=hqwp, helpers=[create_map], inputs=HQWP_SUBFOLDERS, outputs=['hwp_qwp_map.pdf', COMPENSATION_FILENAME+'.npz'], width=500, height=400,
+                 parameters=[HWP_MEAS_LOC, HQWP_NUM_HWP, HQWP_NUM_QWP, NUM_POL]),
+    'before_after': dict(function=before_after, helpers=[], inputs=BEFORE_AFTER_SUBFOLDERS, outputs=['before_after.pdf'], width=500, height=400,
+                         parameters=[BEFORE_AFTER_LABELS, BEFORE_AFTER_SYMBOLS, BEFORE_AFTER_DASHES, BEFORE_AFTER_COL, BEFORE_AFTER_COL_T, BEFORE_AFTER_SIZES]),
+    'time_lapse': dict(function=time_lapse, helpers=[TimeSeriesStore], inputs=[os.path.join(REVISION_SUBFOLDER, TIME_LAPSE_SUBFOLDER)], outputs=['time_lapse.pdf'], width=1000, height=800,
+                       parameters=[HWP_MEAS_COL])
+}
+BUILD_CACHE_FILENAME = '.figures_cache.json'
+
+def figure_fingerprint(name):
+    figure = FIGURES[name]
+    digest = hashlib.sha256()
+
+    # Every figure fits its data with processing.processing, so the whole module (fit models included) is hashed.
+    for function in [figure['function']] + figure['helpers'] + [processing.processing]:
+        digest.update(inspect.getsource(function).encode())
+    digest.update(repr(figure['parameters']).encode())
+    digest.update(repr([CONFIG.detector_max_intensity, CONFIG.c4, CONFIG.c5]).encode())
+
+    # Input files are identified by their size and modification time, they are not re-read.
+    for subfolder in figure['inputs']:
+        for folder, _, filenames in sorted(os.walk(os.path.join(ROOT_FOLDER, subfolder))):
+            for filename in sorted(filenames):
+                stat = os.stat(os.path.join(folder, filename))
+                digest.update(f"{os.path.relpath(os.path.join(folder, filename), ROOT_FOLDER)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+
+    return digest.hexdigest()
+
+def load_build_cache():
+    if not os.path.isfile(BUILD_CACHE_FILENAME):
+        return {}
+
+    with open(BUILD_CACHE_FILENAME, 'r') as file:
+        return json.load(file)
+
+def save_build_cache(cache):
+    with open(BUILD_CACHE_FILENAME, 'w') as file:
+        json.dump(cache, file, indent=1)
+
+def start_renderer():
+    # Kaleido 1.x can keep one browser alive per process instead of launching it for every write_image.
+    try:
+        import kaleido
+        kaleido.start_sync_server(silence_warnings=True)
+    except (ImportError, AttributeError, RuntimeError):
+        pass
+
+def build_figure(name):
+    start = time.perf_counter()
+    figure = FIGURES[name]
+
+    fig = figure['function'](show=False)
+    fig.write_image(figure['outputs'][0], width=figure['width'], height=figure['height'])
+
+    return name, time.perf_counter() - start
+
+def build(names, jobs=None, force=False):
+    cache = load_build_cache()
+    fingerprints = {name: figure_fingerprint(name) for name in names}
+
+    outdated = [
+        name for name in names
+        if force or cache.get(name) != fingerprints[name] or not all(os.path.isfile(output) for output in FIGURES[name]['outputs'])
+    ]
+    for name in set(names) - set(outdated):
+        print(f"{name}: up to date")
+
+    if not outdated:
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs or min(len(outdated), os.cpu_count()), initializer=start_renderer) as executor:
+        futures = {executor.submit(build_figure, name): name for name in outdated}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                _, duration = future.result()
+            except Exception as error:
+                print(f"{name}: failed ({error!r})")
+                continue
+
+            print(f"{name}: built in {duration:.1f} s")
+            cache[name] = fingerprints[name]
+            save_build_cache(cache)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Build the manuscript figures.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    build_parser = subparsers.add_parser('build', help='rebuild the figures whose inputs or code changed')
+    build_parser.add_argument('names', nargs='*', help='figures to build, all by default: {}'.format(', '.join(FIGURES)))
+    build_parser.add_argument('--jobs', type=int, default=None, help='number of worker processes')
+    build_parser.add_argument('--force', action='store_true', help='rebuild even if up to date')
+
+    show_parser = subparsers.add_parser('show', help='open a figure interactively')
+    show_parser.add_argument('name', choices=list(FIGURES))
+
+    arguments = parser.parse_args()
+    if arguments.command == 'build' and not set(arguments.names) <= set(FIGURES):
+        parser.error('unknown figure(s): {}'.format(', '.join(set(arguments.names) - set(FIGURES))))
+
+    return arguments
 
 if __name__ == '__main__':
-    # pd_vs_pm()
-    # hwp_only()
-    hqwp()
-    # before_after()
-    # time_lapse()
\ No newline at end of file
+    arguments = parse_arguments()
+
+    match arguments.command:
+        case 'show':
+            FIGURES[arguments.name]['function']()
+        case 'build':
+            build(arguments.names or list(FIGURES), jobs=arguments.jobs, force=arguments.force)
+        case _:
+            build(list(FIGURES))
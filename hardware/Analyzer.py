@@ -1,11 +1,11 @@
 import CONFIG
+import instrumentation
 
 import time
 import numpy as np
 
-from hardware.RotationStage import RotationStage
-from hardware.Photodiode import Photodiode
-from hardware.Powermeter import Powermeter
+from hardware.SessionRecording import open_device
+from processing.processing import fast_polarimetry_angles, compute_polarization_parameters_linear
 
 
 class UnsupportedDetectorError(Exception):
@@ -16,40 +16,247 @@ class PowermeterNotFoundError(Exception):
 
 class Analyzer:
     def __init__(self, detector):
-        self.rotation_stage = RotationStage('KBD101', CONFIG.polarimeter_kcube)
+        self.rotation_stage = open_device('analyzer_stage', 'hardware.RotationStage', 'RotationStage', 'KBD101', CONFIG.polarimeter_kcube)
         self.detector = detector.lower()
         self.measurement_data = None
+        self.fast_mode = CONFIG.fast_mode_enabled
+        self.adaptive_averaging = CONFIG.adaptive_averaging_enabled
+        self.revolutions = 1
+        self.dropped_revolutions = 0
+        self.ellipticity_std = None
+        self.missed_triggers = 0
+        self.reconstructed_triggers = 0
 
         match self.detector:
             case 'photodiode':
-                self.photodiode = Photodiode()
+                self.photodiode = open_device('photodiode', 'hardware.Photodiode', 'Photodiode')
             case 'powermeter':
                 try:
-                    self.powermeter = Powermeter()
+                    self.powermeter = open_device('powermeter', 'hardware.Powermeter', 'Powermeter')
                 except:
                     raise PowermeterNotFoundError
             case _:
                 raise UnsupportedDetectorError
-    def snap(self):
+
+        device_velocity, device_acceleration = self.rotation_stage.get_velocity_params()
+        self.set_measurement_motion(
+            CONFIG.analyzer_measurement_velocity_in_deg_per_s or device_velocity,
+            CONFIG.analyzer_measurement_acceleration_in_deg_per_s2 or device_acceleration
+        )
+
+    def set_measurement_motion(self, velocity, acceleration):
+        self.rotation_stage.set_velocity_params(velocity, acceleration)
+        self.measurement_velocity = velocity
+        self.measurement_acceleration = acceleration
+
+        if self.detector == 'photodiode':
+            self.photodiode.set_revolution_duration(self.revolution_duration())
+        if self.detector == 'photodiode' and CONFIG.analyzer_auto_size_capture:
+            self.photodiode.set_samples_per_channel(self.capture_samples())
+
+    def revolution_duration(self):
+        distance = 360
+        velocity = self.measurement_velocity
+        acceleration = self.measurement_acceleration
+
+        if distance >= velocity**2 / acceleration:
+            return distance / velocity + velocity / acceleration
+
+        return 2 * (distance / acceleration)**0.5
+
+    def capture_samples(self):
+        return int(np.ceil(self.revolution_duration() * CONFIG.nidaqmx_clock_rate * CONFIG.analyzer_capture_margin)) + CONFIG.nidaqmx_number_of_samples_averaged_per_trigger
+
+    def max_velocity_for_sampling(self):
+        # Each trigger interval must hold the averaged samples plus one, and be longer than the trigger pulse.
+        sampling_limit = CONFIG.nidaqmx_clock_rate * CONFIG.trigger_out_interval_in_deg / (CONFIG.nidaqmx_number_of_samples_averaged_per_trigger + 1)
+        pulse_limit = CONFIG.trigger_out_interval_in_deg / (2 * CONFIG.trigger_out_pulse_width_in_us * 1E-6)
+
+        return min(sampling_limit, pulse_limit)
+
+    def is_clean_at(self, velocity, acceleration, checkpoint=None):
+        self.set_measurement_motion(velocity, acceleration)
+
+        for _ in range(CONFIG.analyzer_velocity_search_repetitions):
+            if checkpoint is not None:
+                checkpoint()
+
+            self.snap_revolution()
+            if not self.analog_data_valid or self.missed_triggers != 0 or self.reconstructed_triggers != 0:
+                return False
+
+        return True
+
+    def search_fastest_velocity(self, checkpoint=None):
+        if self.detector != 'photodiode':
+            raise UnsupportedDetectorError
+
+        acceleration = self.measurement_acceleration
+        initial_velocity = self.measurement_velocity
+        low = CONFIG.analyzer_velocity_search_min_in_deg_per_s
+        high = min(CONFIG.analyzer_velocity_search_max_in_deg_per_s, self.max_velocity_for_sampling())
+
+        try:
+            if self.is_clean_at(high, acceleration, checkpoint):
+                return high
+
+            if not self.is_clean_at(low, acceleration, checkpoint):
+                print('ERROR: no clean revolution at {} deg/s, keeping {} deg/s.'.format(low, initial_velocity))
+                self.set_measurement_motion(initial_velocity, acceleration)
+                return None
+
+            while high - low > CONFIG.analyzer_velocity_search_tolerance_in_deg_per_s:
+                velocity = (low + high) / 2
+                if self.is_clean_at(velocity, acceleration, checkpoint):
+                    low = velocity
+                else:
+                    high = velocity
+        except BaseException:
+            self.set_measurement_motion(initial_velocity, acceleration)
+            raise
+
+        self.set_measurement_motion(low, acceleration)
+        print('Fastest clean analyzer velocity: {:.1f} deg/s ({:.2f} s per revolution).'.format(low, self.revolution_duration()))
+
+        return low
+
+    def measurement_angles(self):
+        # Nominal analyzer angles of one measurement, in degrees.
+        if self.fast_mode:
+            angles = fast_polarimetry_angles(CONFIG.fast_mode_number_of_angles)
+            return np.concatenate([angles + 180*ii for ii in range(CONFIG.fast_mode_repeats)]) % 360
+        if self.detector == 'photodiode':
+            return np.arange(0, 360, CONFIG.trigger_out_interval_in_deg)
+
+        return np.linspace(0, 360, num=CONFIG.powermeter_number_of_measurements, endpoint=False)
+
+    def next_revolution_position(self):
         current_rotation_stage_position = self.rotation_stage.get_position()
         if current_rotation_stage_position < 0:
-            next_motor_position = 0
+            return 0
+
+        return (current_rotation_stage_position // 360 + 1) * 360
+
+    def snap_fast(self):
+        angles = fast_polarimetry_angles(CONFIG.fast_mode_number_of_angles)
+        positions = np.concatenate([angles + 180*ii for ii in range(CONFIG.fast_mode_repeats)])
+        # Same angle origin as a revolution, whose angle 0 is the first stage trigger. The revolution starts from
+        # analyzer_start_position only to run up to it.
+        next_motor_position = self.next_revolution_position() + CONFIG.trigger_out_start_position
+
+        self.measurement_data = np.zeros((2, len(positions)))
+        self.measurement_data[0] = positions % 360
+
+        match self.detector:
+            case 'photodiode':
+                with self.photodiode.static_reader(CONFIG.fast_mode_samples_per_angle) as read:
+                    for ii, position in enumerate(positions):
+                        with instrumentation.span('analyzer_move'):
+                            self.rotation_stage.set_position(next_motor_position+position, absolute=True)
+                        with instrumentation.span('photodiode_read'):
+                            self.measurement_data[1, ii] = read()
+
+                self.analog_data = np.zeros((2, 0))
+                self.analog_data_valid = True
+            case 'powermeter':
+                for ii, position in enumerate(positions):
+                    with instrumentation.span('analyzer_move'):
+                        self.rotation_stage.set_position(next_motor_position+position, absolute=True)
+                    with instrumentation.span('powermeter_stabilization'):
+                        time.sleep(CONFIG.powermeter_stabilization_in_seconds)
+                    with instrumentation.span('powermeter_read'):
+                        self.measurement_data[1, ii] = self.powermeter.measure_once()
+
+                self.analog_data = None
+                self.analog_data_valid = False
+
+        self.missed_triggers = 0
+        self.reconstructed_triggers = 0
+
+    def snap(self):
+        if self.adaptive_averaging:
+            self.snap_averaged()
+            return
+
+        self.snap_once()
+        self.revolutions = 1
+        self.dropped_revolutions = 0
+        self.ellipticity_std = None
+
+    def snap_once(self):
+        if self.fast_mode:
+            self.snap_fast()
         else:
-            next_motor_position = (current_rotation_stage_position // 360 + 1) * 360
+            self.snap_revolution()
+
+    def snap_averaged(self):
+        # Revolutions are averaged angle by angle until the ellipticity uncertainty of the linear fit reaches the
+        # target. Invalid revolutions, and revolutions whose number of angles differs from the first one, are dropped
+        # but still count toward max_revolutions.
+        intensity_sum = None
+        missed_triggers = 0
+        reconstructed_triggers = 0
+        self.revolutions = 0
+        self.dropped_revolutions = 0
+        self.ellipticity_std = None
+
+        for _ in range(CONFIG.adaptive_averaging_max_revolutions):
+            self.snap_once()
+            if self.detector == 'photodiode' and not self.analog_data_valid:
+                self.dropped_revolutions += 1
+                continue
+
+            if intensity_sum is None:
+                angles = self.measurement_data[0].copy()
+                intensity_sum = np.zeros_like(angles)
+            elif self.measurement_data.shape[1] != len(angles):
+                self.dropped_revolutions += 1
+                continue
+
+            intensity_sum += self.measurement_data[1]
+            missed_triggers += self.missed_triggers
+            reconstructed_triggers += self.reconstructed_triggers
+            self.revolutions += 1
+
+            if self.revolutions >= CONFIG.adaptive_averaging_min_revolutions:
+                *_, uncertainty = compute_polarization_parameters_linear(np.deg2rad(angles), intensity_sum / self.revolutions)
+                self.ellipticity_std = uncertainty['ellipticity']
+                if self.ellipticity_std <= CONFIG.adaptive_averaging_target_ellipticity_std:
+                    break
+
+        if self.dropped_revolutions:
+            print(f'WARNING: {self.dropped_revolutions} of {self.revolutions + self.dropped_revolutions} revolutions were dropped from the average.')
+        if intensity_sum is None:
+            return
+
+        self.measurement_data = np.vstack((angles, intensity_sum / self.revolutions))
+        self.missed_triggers = missed_triggers
+        self.reconstructed_triggers = reconstructed_triggers
+        if self.detector == 'photodiode':
+            self.analog_data_valid = True
+
+    def snap_revolution(self):
+        next_motor_position = self.next_revolution_position()
 
         match self.detector:
             case 'photodiode':
-                self.photodiode.arm_daq()
-                time.sleep(CONFIG.nidaqmx_arm_sleep_in_seconds)
+                with instrumentation.span('arm_daq'):
+                    self.photodiode.arm_daq()
+                with instrumentation.span('arm_wait'):
+                    self.photodiode.wait_until_armed()
                 next_motor_position += 360 + CONFIG.analyzer_start_position
-                self.rotation_stage.set_position(next_motor_position, absolute=True)
-                self.photodiode.disarm_daq()
+                with instrumentation.span('analyzer_move'):
+                    self.rotation_stage.set_position(next_motor_position, absolute=True)
+                with instrumentation.span('disarm_daq'):
+                    self.photodiode.disarm_daq()
                 if self.photodiode.analog_data is not None:
-                    self.measurement_data = self.photodiode.get_signal_at_triggers()
+                    with instrumentation.span('get_signal_at_triggers'):
+                        self.measurement_data = self.photodiode.get_signal_at_triggers()
 
                 self.analog_data = self.photodiode.analog_data
                 self.analog_data_valid = self.photodiode.analog_data_valid
                 self.missed_triggers = int(360/CONFIG.trigger_out_interval_in_deg) - self.measurement_data.shape[1]
+                self.reconstructed_triggers = self.photodiode.reconstructed_triggers
             case 'powermeter':
                 motor_step = int(360/CONFIG.powermeter_number_of_measurements)
 
@@ -57,14 +264,39 @@ class Analyzer:
                 self.measurement_data[0] = np.linspace(0, 360, num=self.measurement_data.shape[1], endpoint=False)
 
                 for ii in range(CONFIG.powermeter_number_of_measurements):
-                    self.rotation_stage.set_position(next_motor_position+ii*motor_step, absolute=True)
-                    time.sleep(CONFIG.powermeter_stabilization_in_seconds)
-                    self.measurement_data[1, ii] = self.powermeter.measure_once()
+                    with instrumentation.span('analyzer_move'):
+                        self.rotation_stage.set_position(next_motor_position+ii*motor_step, absolute=True)
+                    with instrumentation.span('powermeter_stabilization'):
+                        time.sleep(CONFIG.powermeter_stabilization_in_seconds)
+                    with instrumentation.span('powermeter_read'):
+                        self.measurement_data[1, ii] = self.powermeter.measure_once()
 
                 self.analog_data = None
                 self.analog_data_valid = False
+                self.missed_triggers = 0
+                self.reconstructed_triggers = 0
+
+    def home(self):
+        self.rotation_stage.home()
+
+    def get_state(self):
+        state = {
+            'detector': self.detector,
+            'analyzer_position': self.rotation_stage.get_position()
+        }
+
+        if self.detector == 'photodiode':
+            state['analog_data_valid'] = bool(self.analog_data_valid)
+            state['missed_triggers'] = int(self.missed_triggers)
+            state['reconstructed_triggers'] = int(self.reconstructed_triggers)
+            state['calibration_mean'] = float(self.photodiode.calibration_mean)
+
+        return state
+
+    def save(self, path, timing_spans=None):
+        if timing_spans is None:
+            timing_spans = instrumentation.run_spans()
 
-    def save(self, path):
         match self.detector:
             case 'photodiode':
                 np.savez(
@@ -72,12 +304,21 @@ class Analyzer:
                     analog_data=self.analog_data,
                     measurement_data=self.measurement_data,
                     calibration_mean=self.photodiode.calibration_mean,
-                    calibration_std=self.photodiode.calibration_std
+                    calibration_std=self.photodiode.calibration_std,
+                    calibration_timestamp=self.photodiode.calibration_timestamp or np.nan,
+                    timing_spans=timing_spans,
+                    fast_mode=self.fast_mode,
+                    revolutions=self.revolutions,
+                    dropped_revolutions=self.dropped_revolutions,
+                    reconstructed_triggers=self.reconstructed_triggers
                     )
             case 'powermeter':
                 np.savez(
                     path, 
-                    measurement_data=self.measurement_data
+                    measurement_data=self.measurement_data,
+                    timing_spans=timing_spans,
+                    fast_mode=self.fast_mode,
+                    revolutions=self.revolutions
                     )
 
     def close(self):
@@ -86,5 +327,8 @@ class Analyzer:
         try:
             self.photodiode.disarm_daq()
             self.photodiode.set_bias_voltage(0)
+            if self.photodiode.tuner is not None:
+                self.photodiode.tuner.save()
+            self.photodiode.close()
         except:
             pass
\ No newline at end of file
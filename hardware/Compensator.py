@@ -1,13 +1,23 @@
 import CONFIG
 
-from hardware.RotationStage import RotationStage
+from hardware.SessionRecording import open_device
 
 
 class Compensator:
     def __init__(self):
-        self.hwp_rotation_stage = RotationStage('kdc101', CONFIG.hwp_kcube)
-        self.qwp_rotation_stage = RotationStage('kdc101', CONFIG.qwp_kcube)
+        self.hwp_rotation_stage = open_device('hwp_stage', 'hardware.RotationStage', 'RotationStage', 'kdc101', CONFIG.hwp_kcube)
+        self.qwp_rotation_stage = open_device('qwp_stage', 'hardware.RotationStage', 'RotationStage', 'kdc101', CONFIG.qwp_kcube)
                 
+    def home(self):
+        self.hwp_rotation_stage.home()
+        self.qwp_rotation_stage.home()
+
+    def get_state(self):
+        return {
+            'hwp_position': self.hwp_rotation_stage.get_position(),
+            'qwp_position': self.qwp_rotation_stage.get_position()
+        }
+
     def close(self):
         self.qwp_rotation_stage.close()
         self.hwp_rotation_stage.close()
\ No newline at end of file
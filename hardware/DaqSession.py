@@ -0,0 +1,109 @@
+import CONFIG
+
+from contextlib import contextmanager
+from threading import Event, Lock, Thread
+
+import nidaqmx
+from nidaqmx.constants import TaskMode
+
+
+class DaqSession:
+    def __init__(self, configure_ai_task, acquire, bias_voltage_applied=None):
+        self.__configure_ai_task = configure_ai_task
+        self.__acquire = acquire
+        self.__bias_voltage_applied = bias_voltage_applied
+        self.__closed = False
+
+        self.ai_task = self.__create_ai_task()
+        self.__arm_request = Event()
+        self.__acquisition_done = Event()
+        self.__acquisition_done.set()
+        self.__ai_worker = Thread(target=self.__run_ai, daemon=True)
+        self.__ai_worker.start()
+
+        self.ao_task = nidaqmx.Task()
+        self.ao_task.ao_channels.add_ao_voltage_chan(CONFIG.nidaqmx_ao_photodiode_bias, min_val=0, max_val=10)
+        self.ao_task.control(TaskMode.TASK_VERIFY)
+        self.ao_task.start()
+        self.__ao_lock = Lock()
+        self.__pending_bias_voltage = None
+        self.__bias_request = Event()
+        self.__ao_worker = Thread(target=self.__run_ao, daemon=True)
+        self.__ao_worker.start()
+
+    def __create_ai_task(self):
+        task = nidaqmx.Task()
+        self.__configure_ai_task(task)
+        task.control(TaskMode.TASK_VERIFY)
+        task.control(TaskMode.TASK_COMMIT)
+
+        return task
+
+    def reconfigure_ai(self):
+        self.wait()
+        self.ai_task.close()
+        self.ai_task = self.__create_ai_task()
+
+    @contextmanager
+    def released_ai(self):
+        self.wait()
+        self.ai_task.control(TaskMode.TASK_UNRESERVE)
+        try:
+            yield
+        finally:
+            self.ai_task.control(TaskMode.TASK_COMMIT)
+
+    def arm(self):
+        self.__acquisition_done.clear()
+        self.__arm_request.set()
+
+    def wait(self):
+        self.__acquisition_done.wait()
+
+    def __run_ai(self):
+        while True:
+            self.__arm_request.wait()
+            self.__arm_request.clear()
+            if self.__closed:
+                return
+
+            try:
+                self.__acquire(self.ai_task)
+            finally:
+                self.__acquisition_done.set()
+
+    def write_bias_voltage(self, voltage):
+        with self.__ao_lock:
+            self.__pending_bias_voltage = None
+            self.ao_task.write(voltage)
+
+    def request_bias_voltage(self, voltage):
+        with self.__ao_lock:
+            self.__pending_bias_voltage = voltage
+        self.__bias_request.set()
+
+    def __run_ao(self):
+        while True:
+            self.__bias_request.wait()
+            self.__bias_request.clear()
+            if self.__closed:
+                return
+
+            with self.__ao_lock:
+                voltage = self.__pending_bias_voltage
+                self.__pending_bias_voltage = None
+                if voltage is not None:
+                    self.ao_task.write(voltage)
+            if voltage is not None and self.__bias_voltage_applied is not None:
+                self.__bias_voltage_applied(voltage)
+
+    def close(self):
+        self.wait()
+        self.__closed = True
+        self.__arm_request.set()
+        self.__bias_request.set()
+        self.__ai_worker.join()
+        self.__ao_worker.join()
+
+        self.ai_task.close()
+        self.ao_task.close()
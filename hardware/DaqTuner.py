@@ -0,0 +1,77 @@
+import CONFIG
+
+import json
+import os
+from collections import deque
+
+import numpy as np
+
+
+def daq_setup_name():
+    # Files shared by several setups are keyed by the analyzer stage and the DAQ device.
+    return '{}_{}'.format(CONFIG.polarimeter_kcube, CONFIG.nidaqmx_ai_photodiode_signal.split('/')[0])
+
+class DaqTuner:
+    def __init__(self):
+        self.setup = daq_setup_name()
+        self.arm_latencies = deque(maxlen=CONFIG.nidaqmx_autotune_history_length)
+        # Read durations are kept relative to the revolution duration, so the timeout follows the analyzer velocity.
+        self.read_ratios = deque(maxlen=CONFIG.nidaqmx_autotune_history_length)
+        self.__unsaved_observations = 0
+
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(CONFIG.nidaqmx_autotune_file):
+            return
+
+        with open(CONFIG.nidaqmx_autotune_file, 'r') as file:
+            setups = json.load(file)
+
+        if self.setup in setups:
+            self.arm_latencies.extend(setups[self.setup]['arm_latencies'])
+            self.read_ratios.extend(setups[self.setup].get('read_ratios', []))
+
+    def save(self):
+        setups = {}
+        if os.path.isfile(CONFIG.nidaqmx_autotune_file):
+            with open(CONFIG.nidaqmx_autotune_file, 'r') as file:
+                setups = json.load(file)
+
+        setups[self.setup] = {
+            'arm_latencies': list(self.arm_latencies),
+            'read_ratios': list(self.read_ratios),
+            'arm_delay_in_seconds': self.arm_delay()
+        }
+
+        with open(CONFIG.nidaqmx_autotune_file, 'w') as file:
+            json.dump(setups, file, indent=1)
+
+        self.__unsaved_observations = 0
+
+    def observe(self, arm_latency, read_duration, revolution_duration):
+        self.arm_latencies.append(arm_latency)
+        if revolution_duration:
+            self.read_ratios.append(read_duration / revolution_duration)
+
+        self.__unsaved_observations += 1
+        if self.__unsaved_observations >= 10:
+            self.save()
+
+    def observe_failure(self):
+        # A missed acquisition invalidates the read statistics until enough new ones are observed.
+        self.read_ratios.clear()
+
+    def arm_delay(self):
+        if len(self.arm_latencies) < CONFIG.nidaqmx_autotune_min_samples:
+            return CONFIG.nidaqmx_arm_sleep_in_seconds
+
+        return min(CONFIG.nidaqmx_arm_sleep_in_seconds, float(np.percentile(self.arm_latencies, 99)) * CONFIG.nidaqmx_autotune_safety_factor)
+
+    def ai_timeout(self, revolution_duration):
+        if not revolution_duration or len(self.read_ratios) < CONFIG.nidaqmx_autotune_min_samples:
+            return CONFIG.ai_timeout_in_seconds
+
+        tuned_timeout = float(np.percentile(self.read_ratios, 99)) * revolution_duration * CONFIG.nidaqmx_autotune_safety_factor + CONFIG.nidaqmx_autotune_timeout_margin_in_seconds
+
+        return min(CONFIG.ai_timeout_in_seconds, tuned_timeout)
@@ -1,69 +1,279 @@
 import CONFIG
+import instrumentation
 
+import json
+import os
+import time
 import numpy as np
-from threading import Thread
+from threading import Event
+from contextlib import contextmanager
 
 import nidaqmx
+from nidaqmx.constants import AcquisitionType, Edge
 
+from hardware.DaqSession import DaqSession
+from hardware.DaqTuner import DaqTuner, daq_setup_name
+from processing.processing import update_running_statistics
+from processing.triggers import extract_signal_at_triggers
+
+
+class UnsupportedAcquisitionModeError(Exception):
+    pass
 
 class Photodiode:
     def __init__(self):
-        self.analog_data = np.zeros((2, CONFIG.nidaqmx_samples_per_channel))
+        self.session = None
+        self.acquisition_mode = CONFIG.nidaqmx_acquisition_mode
+        self.number_of_triggers = int(360/CONFIG.trigger_out_interval_in_deg)
+
+        match self.acquisition_mode:
+            case 'software_edges':
+                self.set_samples_per_channel(CONFIG.nidaqmx_samples_per_channel)
+            case 'external_clock':
+                self.samples_per_channel = self.number_of_triggers
+                self.analog_data = np.zeros((1, self.samples_per_channel))
+            case 'retriggerable':
+                self.samples_per_channel = self.number_of_triggers * CONFIG.nidaqmx_number_of_samples_averaged_per_trigger
+                self.analog_data = np.zeros((1, self.samples_per_channel))
+            case _:
+                raise UnsupportedAcquisitionModeError(self.acquisition_mode)
+
         self.analog_data_valid = False
         self.data_at_triggers = None
-        self.calibration_mean = 0
-        self.calibration_std = 0
+        self.sample_angles = None
+        self.reconstructed_triggers = 0
+        self.revolution_duration = None
+        self.bias_voltage = 0
+        self.setup = daq_setup_name()
+        self.calibration_progress = 0
+        self.calibrations = {}
+        self.clear_calibration()
+        self.load_calibration()
+        self.armed_event = Event()
+        self.tuner = DaqTuner() if CONFIG.nidaqmx_autotune_enabled else None
+        self.session = DaqSession(self.__configure_ai_task, self.__read_ai_channels, self.__apply_bias_voltage)
 
     def arm_daq(self):
-        self.ai_thread = Thread(target=self.__read_ai_channels)
-        self.ai_thread.start()
+        self.armed_event.clear()
+        self.arm_time = time.perf_counter()
+        self.session.arm()
+
+    def set_samples_per_channel(self, samples_per_channel):
+        # Only the software-timed capture depends on the rotation speed.
+        if self.acquisition_mode != 'software_edges':
+            return
+
+        self.samples_per_channel = samples_per_channel
+        self.analog_data = np.zeros((2, self.samples_per_channel))
+
+        if self.session is not None:
+            self.session.reconfigure_ai()
+
+    def set_revolution_duration(self, revolution_duration):
+        # The tuned read timeout scales with the revolution duration at the current velocity.
+        self.revolution_duration = revolution_duration
+
+    def wait_until_armed(self):
+        if self.tuner is None:
+            time.sleep(CONFIG.nidaqmx_arm_sleep_in_seconds)
+            return True
+
+        if self.armed_event.wait(timeout=self.tuner.arm_delay()):
+            return True
+
+        print('WARNING: DAQ not armed within the tuned delay, waiting up to arm_sleep_in_seconds.')
+        return self.armed_event.wait(timeout=CONFIG.nidaqmx_arm_sleep_in_seconds)
+
+    def ai_timeout(self):
+        if self.tuner is None:
+            return CONFIG.ai_timeout_in_seconds
+
+        return self.tuner.ai_timeout(self.revolution_duration)
 
     def disarm_daq(self):
+        self.session.wait()
+
+    def calibrate(self):
+        chunk_samples = int(CONFIG.nidaqmx_clock_rate*CONFIG.nidaqmx_calibration_chunk_duration_in_seconds)
+        maximum_samples = int(CONFIG.nidaqmx_clock_rate*CONFIG.nidaqmx_calibration_duration_in_seconds)
+
+        count, mean, m2 = 0, 0, 0
+        standard_error = np.inf
+        self.calibration_progress = 0
+
+        with self.session.released_ai(), nidaqmx.Task() as task:
+            task.ai_channels.add_ai_voltage_chan(CONFIG.nidaqmx_ai_photodiode_signal)
+            task.timing.cfg_samp_clk_timing(rate=CONFIG.nidaqmx_clock_rate, sample_mode=AcquisitionType.CONTINUOUS, samps_per_chan=4*chunk_samples)
+            task.start()
+
+            while count < maximum_samples:
+                chunk = task.read(number_of_samples_per_channel=chunk_samples, timeout=2*CONFIG.nidaqmx_calibration_chunk_duration_in_seconds)
+                count, mean, m2 = update_running_statistics(count, mean, m2, chunk)
+                standard_error = (m2 / (count - 1) / count)**0.5
+
+                # Progress is the larger of the elapsed fraction and the fraction of samples needed to reach the target.
+                self.calibration_progress = min(1, max(count / maximum_samples, (CONFIG.nidaqmx_calibration_target_standard_error_in_volts / standard_error)**2))
+                if count >= 2*chunk_samples and standard_error <= CONFIG.nidaqmx_calibration_target_standard_error_in_volts:
+                    break
+
+        self.calibration_mean = mean
+        self.calibration_std = (m2 / (count - 1))**0.5
+        self.calibration_standard_error = standard_error
+        self.calibration_timestamp = time.time()
+        self.calibration_progress = 1
+
+        self.save_calibration(count)
+
+    def save_calibration(self, count):
+        calibrations = self.__read_calibration_file()
+        calibrations.setdefault(self.setup, {})[str(self.bias_voltage)] = {
+            'mean': float(self.calibration_mean),
+            'std': float(self.calibration_std),
+            'standard_error': float(self.calibration_standard_error),
+            'count': int(count),
+            'timestamp': self.calibration_timestamp
+        }
+
+        with open(CONFIG.nidaqmx_calibration_file, 'w') as file:
+            json.dump(calibrations, file, indent=1)
+        self.calibrations = calibrations[self.setup]
+
+    def load_calibration(self):
+        self.calibrations = self.__read_calibration_file().get(self.setup, {})
+
+        return self.select_calibration()
+
+    def select_calibration(self):
+        # Looks up the cached calibrations, the file is only read on connection.
+        calibration = self.calibrations.get(str(self.bias_voltage))
+        if calibration is None or time.time() - calibration['timestamp'] > 3600*CONFIG.nidaqmx_calibration_expiry_in_hours:
+            # The offset of another bias voltage must not be subtracted.
+            self.clear_calibration()
+            return False
+
+        self.calibration_mean = calibration['mean']
+        self.calibration_std = calibration['std']
+        self.calibration_standard_error = calibration['standard_error']
+        self.calibration_timestamp = calibration['timestamp']
+
+        return True
+
+    def clear_calibration(self):
+        self.calibration_mean = 0
+        self.calibration_std = 0
+        self.calibration_standard_error = None
+        self.calibration_timestamp = None
+
+    def __read_calibration_file(self):
+        if not os.path.isfile(CONFIG.nidaqmx_calibration_file):
+            return {}
+
+        with open(CONFIG.nidaqmx_calibration_file, 'r') as file:
+            return json.load(file)
+
+    def __read_ai_channels(self, task):
+        task.start()
+        armed_time = time.perf_counter()
+        self.armed_event.set()
         try:
-            self.ai_thread.join()
+            with instrumentation.span('daq_read'):
+                self.analog_data[:] = task.read(number_of_samples_per_channel=self.samples_per_channel, timeout=self.ai_timeout())
+            self.analog_data_valid = True
+            if self.tuner is not None:
+                self.tuner.observe(armed_time - self.arm_time, time.perf_counter() - armed_time, self.revolution_duration)
         except:
-            pass
+            self.analog_data_valid = False
+            if self.tuner is not None:
+                self.tuner.observe_failure()
+        finally:
+            task.stop()
 
-    def calibrate(self):
-        calibration_samples = int(CONFIG.nidaqmx_clock_rate*CONFIG.nidaqmx_calibration_duration_in_seconds)
-
-        with nidaqmx.Task() as task:
-            task.ai_channels.add_ai_voltage_chan(CONFIG.nidaqmx_ai_rotation_stage_trigger + ', ' + CONFIG.nidaqmx_ai_photodiode_signal)
-            task.timing.cfg_samp_clk_timing(rate=CONFIG.nidaqmx_clock_rate, samps_per_chan=calibration_samples)
-            data = np.zeros((2, calibration_samples))
-            data[:] = task.read(number_of_samples_per_channel=calibration_samples, timeout=2*CONFIG.nidaqmx_calibration_duration_in_seconds)
-
-        self.calibration_mean = np.mean(data[1, :])
-        self.calibration_std = np.std(data[1, :])
-
-    def __read_ai_channels(self):
-        with nidaqmx.Task() as task:
-            task.ai_channels.add_ai_voltage_chan(CONFIG.nidaqmx_ai_rotation_stage_trigger + ', ' + CONFIG.nidaqmx_ai_photodiode_signal)
-            task.timing.cfg_samp_clk_timing(rate=CONFIG.nidaqmx_clock_rate, samps_per_chan=CONFIG.nidaqmx_samples_per_channel)
-            task.triggers.start_trigger.cfg_dig_edge_start_trig(CONFIG.nidaqmx_trigger_source)
-            try:
-                self.analog_data[:] = task.read(number_of_samples_per_channel=CONFIG.nidaqmx_samples_per_channel, timeout=CONFIG.ai_timeout_in_seconds)
-                self.analog_data_valid = True
-            except:
-                self.analog_data_valid = False
+    def __configure_ai_task(self, task):
+        match self.acquisition_mode:
+            case 'software_edges':
+                task.ai_channels.add_ai_voltage_chan(CONFIG.nidaqmx_ai_rotation_stage_trigger + ', ' + CONFIG.nidaqmx_ai_photodiode_signal)
+                task.timing.cfg_samp_clk_timing(rate=CONFIG.nidaqmx_clock_rate, samps_per_chan=self.samples_per_channel)
+                task.triggers.start_trigger.cfg_dig_edge_start_trig(CONFIG.nidaqmx_trigger_source)
+            case 'external_clock':
+                task.ai_channels.add_ai_voltage_chan(CONFIG.nidaqmx_ai_photodiode_signal)
+                task.timing.cfg_samp_clk_timing(
+                    rate=CONFIG.nidaqmx_clock_rate,
+                    source=CONFIG.nidaqmx_trigger_source,
+                    active_edge=Edge.RISING,
+                    sample_mode=AcquisitionType.FINITE,
+                    samps_per_chan=self.samples_per_channel
+                )
+            case 'retriggerable':
+                task.ai_channels.add_ai_voltage_chan(CONFIG.nidaqmx_ai_photodiode_signal)
+                task.timing.cfg_samp_clk_timing(
+                    rate=CONFIG.nidaqmx_clock_rate,
+                    sample_mode=AcquisitionType.FINITE,
+                    samps_per_chan=CONFIG.nidaqmx_number_of_samples_averaged_per_trigger
+                )
+                task.triggers.start_trigger.cfg_dig_edge_start_trig(CONFIG.nidaqmx_trigger_source)
+                task.triggers.start_trigger.retriggerable = True
+                # The FINITE buffer defaults to samps_per_chan, one trigger's samples, and would overflow before the
+                # revolution is read. It has to hold every trigger of the revolution.
+                task.in_stream.input_buf_size = self.samples_per_channel
 
     def set_bias_voltage(self, voltage):
-        with nidaqmx.Task() as task:
-            task.ao_channels.add_ao_voltage_chan(CONFIG.nidaqmx_ao_photodiode_bias, min_val=0, max_val=10)
-            task.write(voltage, auto_start=True)
+        self.session.write_bias_voltage(voltage)
+        self.__apply_bias_voltage(voltage)
+
+    def request_bias_voltage(self, voltage):
+        # Slider updates are coalesced, only the latest requested voltage is written, and its calibration is selected
+        # once it is.
+        self.session.request_bias_voltage(voltage)
+
+    def __apply_bias_voltage(self, voltage):
+        self.bias_voltage = voltage
+        self.select_calibration()
+
+    def close(self):
+        self.session.close()
+
+    @contextmanager
+    def static_reader(self, samples_per_read):
+        # Finite reads of the photodiode at rest, the snap task is released meanwhile.
+        with self.session.released_ai(), nidaqmx.Task() as task:
+            task.ai_channels.add_ai_voltage_chan(CONFIG.nidaqmx_ai_photodiode_signal)
+            task.timing.cfg_samp_clk_timing(rate=CONFIG.nidaqmx_clock_rate, sample_mode=AcquisitionType.FINITE, samps_per_chan=samples_per_read)
+
+            def read():
+                task.start()
+                try:
+                    samples = np.asarray(task.read(number_of_samples_per_channel=samples_per_read, timeout=self.ai_timeout()))
+                finally:
+                    task.stop()
+
+                return np.mean(samples) - self.calibration_mean
+
+            yield read
 
     def get_signal_at_triggers(self):
-        rotation_stage_trigger_signal = self.analog_data[0]
-        trigger_indices = np.flatnonzero( (rotation_stage_trigger_signal[:-1] < 2.5 ) & (rotation_stage_trigger_signal[1:] > 2.5 ) ) + 1
-        trigger_indices = np.insert(trigger_indices, 0, 0)
-        number_of_triggers = len(trigger_indices)
+        if self.acquisition_mode != 'software_edges':
+            return self.get_hardware_timed_signal()
+
+        data_at_triggers, self.sample_angles, self.reconstructed_triggers = extract_signal_at_triggers(
+            self.analog_data[0],
+            self.analog_data[1],
+            CONFIG.trigger_out_interval_in_deg,
+            CONFIG.nidaqmx_number_of_samples_averaged_per_trigger,
+            CONFIG.nidaqmx_trigger_low_threshold_in_volts,
+            CONFIG.nidaqmx_trigger_high_threshold_in_volts,
+            reconstruct=CONFIG.nidaqmx_trigger_reconstruct_missing
+        )
+
+        data_at_triggers[1,:] -= self.calibration_mean
+        return data_at_triggers
 
-        data_at_triggers = np.zeros((2, number_of_triggers))
-        data_at_triggers[0] = np.linspace(0, 360, num=number_of_triggers, endpoint=False)
+    def get_hardware_timed_signal(self):
+        self.sample_angles = None
+        self.reconstructed_triggers = 0
 
-        for ii in range(CONFIG.nidaqmx_number_of_samples_averaged_per_trigger):
-            data_at_triggers[1,:] += self.analog_data[1, trigger_indices + ii]
-        data_at_triggers[1,:] /= CONFIG.nidaqmx_number_of_samples_averaged_per_trigger
+        data_at_triggers = np.zeros((2, self.number_of_triggers))
+        data_at_triggers[0] = np.arange(self.number_of_triggers) * CONFIG.trigger_out_interval_in_deg
+        data_at_triggers[1] = self.analog_data[0].reshape(self.number_of_triggers, -1).mean(axis=1)
 
         data_at_triggers[1,:] -= self.calibration_mean
         return data_at_triggers
\ No newline at end of file
@@ -111,6 +111,29 @@ class RotationStage:
         while self.__controller.IsDeviceBusy:
             time.sleep(CONFIG.kcube_polling_interval_in_ms/1000)
 
+    def start_move(self, position):
+        # A wait timeout of 0 returns as soon as the move is started, is_moving() tells when it is done.
+        self.__controller.MoveTo(Decimal(position), 0)
+
+    def is_moving(self):
+        return self.__controller.IsDeviceBusy
+
+    def stop(self):
+        self.__controller.StopImmediate()
+
+    def get_velocity_params(self):
+        velocity_params = self.__controller.GetVelocityParams()
+        return float(str(velocity_params.MaxVelocity)), float(str(velocity_params.Acceleration))
+
+    def set_velocity_params(self, max_velocity, acceleration):
+        self.__controller.SetVelocityParams(Decimal(max_velocity), Decimal(acceleration))
+
+    def home(self):
+        self.__controller.Home(CONFIG.home_timeout_in_ms)
+
+        if self.controller_model.lower() == 'kbd101':
+            self.__configure_for_analysis()
+
     def get_position(self):
         return float(str(self.__controller.DevicePosition))
 
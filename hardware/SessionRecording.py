@@ -0,0 +1,238 @@
+import CONFIG
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from importlib import import_module
+
+import numpy as np
+
+
+class ReplayMismatchError(Exception):
+    pass
+
+class ReplayedDeviceError(Exception):
+    pass
+
+class UnsupportedSessionModeError(Exception):
+    pass
+
+# Methods that return a context manager yielding a read function, the reads are recorded as '<method>.read'.
+READER_METHODS = {'static_reader'}
+
+def is_recordable(value):
+    return value is None or isinstance(value, (bool, int, float, str, np.ndarray, np.generic))
+
+class SessionRecorder:
+    EVENTS_FILENAME = 'session.jsonl'
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(os.path.join(self.folder, 'arrays'), exist_ok=True)
+
+        self.start_time = time.perf_counter()
+        self.__number_of_arrays = 0
+        self.__lock = threading.Lock()
+        self.__file = open(os.path.join(self.folder, self.EVENTS_FILENAME), 'w')
+
+    def encode(self, value):
+        if isinstance(value, np.ndarray):
+            # Arrays (DAQ reads) go to their own .npy, the event keeps the file name.
+            path = f"arrays/{self.__number_of_arrays:06d}.npy"
+            self.__number_of_arrays += 1
+            np.save(os.path.join(self.folder, path), value)
+            return {'__array__': path}
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, (list, tuple)):
+            return [self.encode(item) for item in value]
+
+        return value if is_recordable(value) else None
+
+    def record(self, device, method, started, duration, result=None, state=None, error=None):
+        with self.__lock:
+            event = {
+                'device': device,
+                'method': method,
+                'started': started - self.start_time,
+                'duration': duration,
+                'result': self.encode(result),
+                'state': {name: self.encode(value) for name, value in (state or {}).items()},
+                'error': error
+            }
+            self.__file.write(json.dumps(event) + '\n')
+            self.__file.flush()
+
+    def close(self):
+        with self.__lock:
+            self.__file.close()
+
+class SessionPlayer:
+    def __init__(self, folder, speed=1):
+        # speed scales the recorded device durations, 0 replays as fast as possible.
+        self.folder = folder
+        self.speed = speed
+        self.skipped_events = 0
+        self.__lock = threading.Lock()
+
+        self.events = {}
+        with open(os.path.join(self.folder, SessionRecorder.EVENTS_FILENAME), 'r') as file:
+            for line in file:
+                event = json.loads(line)
+                self.events.setdefault(event['device'], []).append(event)
+        self.__positions = {device: 0 for device in self.events}
+
+    def decode(self, value):
+        if isinstance(value, dict) and '__array__' in value:
+            return np.load(os.path.join(self.folder, value['__array__']))
+        if isinstance(value, list):
+            return [self.decode(item) for item in value]
+
+        return value
+
+    def next_event(self, device, method):
+        # Events are consumed in order per device. Polling calls (positions, busy flags) may be called a different
+        # number of times than during the recording, so non-matching events are skipped up to the next match.
+        with self.__lock:
+            events = self.events.get(device, [])
+            position = self.__positions.get(device, 0)
+            for index in range(position, len(events)):
+                if events[index]['method'] == method:
+                    self.skipped_events += index - position
+                    self.__positions[device] = index + 1
+                    return events[index]
+
+        raise ReplayMismatchError(f'no recorded {device}.{method} call left')
+
+    def play(self, device, method):
+        event = self.next_event(device, method)
+        if self.speed > 0:
+            time.sleep(event['duration'] / self.speed)
+
+        return event
+
+class RecordingProxy:
+    def __init__(self, device, target, recorder):
+        self._device = device
+        self._target = target
+        self._recorder = recorder
+        self._state = self.__read_state()
+
+        recorder.record(device, '__init__', time.perf_counter(), 0, state=self._state)
+
+    def __read_state(self):
+        # Arrays are copied, the devices refill them in place (the DAQ read writes into analog_data).
+        return {name: value.copy() if isinstance(value, np.ndarray) else value for name, value in vars(self._target).items() if not name.startswith('_')}
+
+    def __changed_state(self):
+        state = self.__read_state()
+        changed = {}
+        for name, value in state.items():
+            previous = self._state.get(name)
+            if isinstance(value, np.ndarray) or isinstance(previous, np.ndarray):
+                if not (isinstance(value, np.ndarray) and isinstance(previous, np.ndarray) and value.shape == previous.shape and np.array_equal(value, previous)):
+                    changed[name] = value
+            elif type(value) != type(previous) or value != previous:
+                changed[name] = value
+        self._state = state
+
+        return changed
+
+    def __call_recorded(self, method, function, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        except Exception as error:
+            self._recorder.record(self._device, method, started, time.perf_counter() - started, state=self.__changed_state(), error=f'{type(error).__name__}: {error}')
+            raise
+        self._recorder.record(self._device, method, started, time.perf_counter() - started, result=result, state=self.__changed_state())
+
+        return result
+
+    @contextmanager
+    def __recorded_reader(self, method, *args, **kwargs):
+        with getattr(self._target, method)(*args, **kwargs) as read:
+            yield lambda: self.__call_recorded(method + '.read', read)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if not callable(attribute):
+            return attribute
+        if name in READER_METHODS:
+            return lambda *args, **kwargs: self.__recorded_reader(name, *args, **kwargs)
+
+        return lambda *args, **kwargs: self.__call_recorded(name, attribute, *args, **kwargs)
+
+class ReplayDevice:
+    def __init__(self, device, player):
+        self._device = device
+        self._player = player
+
+        try:
+            self.__apply(player.next_event(device, '__init__'))
+        except ReplayMismatchError:
+            raise ReplayedDeviceError(f'{device} was not connected in the recorded session')
+
+    def __apply(self, event):
+        for name, value in event['state'].items():
+            setattr(self, name, self._player.decode(value))
+        if event['error'] is not None:
+            raise ReplayedDeviceError(event['error'])
+
+        return self._player.decode(event['result'])
+
+    def __replay(self, method):
+        return self.__apply(self._player.play(self._device, method))
+
+    @contextmanager
+    def __replayed_reader(self, method):
+        yield lambda: self.__replay(method + '.read')
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in READER_METHODS:
+            return lambda *args, **kwargs: self.__replayed_reader(name)
+
+        return lambda *args, **kwargs: self.__replay(name)
+
+_session = None
+
+def open_session():
+    global _session
+
+    close_session()
+    match CONFIG.session_mode:
+        case 'live':
+            _session = None
+        case 'record':
+            _session = SessionRecorder(os.path.join(CONFIG.session_folder, datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')))
+        case 'replay':
+            _session = SessionPlayer(CONFIG.session_folder, speed=CONFIG.session_replay_speed)
+        case _:
+            raise UnsupportedSessionModeError(CONFIG.session_mode)
+
+    return _session
+
+def close_session():
+    global _session
+
+    if isinstance(_session, SessionRecorder):
+        _session.close()
+    elif isinstance(_session, SessionPlayer) and _session.skipped_events:
+        print(f'WARNING: {_session.skipped_events} recorded device calls were skipped during the replay.')
+    _session = None
+
+def open_device(device, module_name, class_name, *args):
+    # The device module is only imported for live and recorded sessions, so a replay needs none of the drivers.
+    if isinstance(_session, SessionPlayer):
+        return ReplayDevice(device, _session)
+
+    target = getattr(import_module(module_name), class_name)(*args)
+    if isinstance(_session, SessionRecorder):
+        return RecordingProxy(device, target, _session)
+
+    return target
@@ -0,0 +1,71 @@
+import cProfile
+import pstats
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+HISTORY_LENGTH = 1000
+SPAN_DTYPE = np.dtype([('name', 'U64'), ('start', 'f8'), ('duration', 'f8')])
+
+_lock = threading.Lock()
+_history = defaultdict(lambda: deque(maxlen=HISTORY_LENGTH))
+_run_spans = []
+_run_start = time.perf_counter()
+
+def record(name, start, duration):
+    with _lock:
+        _history[name].append(duration)
+        _run_spans.append((name, start - _run_start, duration))
+
+@contextmanager
+def span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, start, time.perf_counter() - start)
+
+def start_run():
+    global _run_start
+
+    with _lock:
+        _run_spans.clear()
+        _run_start = time.perf_counter()
+
+def run_spans():
+    with _lock:
+        return np.array(_run_spans, dtype=SPAN_DTYPE)
+
+def percentiles(quantiles=(50, 90, 99)):
+    with _lock:
+        history = {name: np.array(durations) for name, durations in _history.items()}
+
+    summary = {}
+    for name, durations in history.items():
+        summary[name] = {'count': len(durations)}
+        for quantile, value in zip(quantiles, np.percentile(durations, quantiles)):
+            summary[name][f'p{quantile}'] = float(value)
+
+    return summary
+
+def reset():
+    with _lock:
+        _history.clear()
+        _run_spans.clear()
+
+@contextmanager
+def profile(path):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
@@ -1,7 +1,8 @@
 import CONFIG
 CONFIG.load_config()
 
-import time
+import instrumentation
+
 from datetime import datetime
 from pathlib import Path
 
@@ -9,12 +10,19 @@ import numpy as np
 import plotly.graph_objects as go
 
 from contextlib import contextmanager
-from nicegui import run, ui
+from nicegui import app, run, ui
 from plotly.subplots import make_subplots
 
-from hardware.Analyzer import Analyzer, UnsupportedDetectorError, PowermeterNotFoundError
-from hardware.Compensator import Compensator
-from processing.processing import compute_polarization_parameters
+from experiments.AcquisitionService import AcquisitionService
+from experiments.HttpApi import register_routes
+
+COMPENSATION_FILEPATH = r"...\YYYYMMDDTHHMMSSZ_HQWP_mapping_compensation.npz"
+
+service = AcquisitionService()
+experiment_queue = service.experiment_queue
+experiment_queue_busy = False
+
+register_routes(app, service)
 
 def set_all_elements_enable_state(elements_list, enable, ignore_first=False):
     if ignore_first:
@@ -37,46 +45,37 @@ def disable_all_while_busy(elements_list):
         set_all_elements_enable_state(elements_list, enable=True)
 
 def hardware_initialization():
-    CONFIG.load_config()
+    error = service.connect(measurement_method_toggle.value, polarimeter_only=polarimeter_checkbox.value)
+    set_fast_mode()
+    set_adaptive_averaging()
 
-    detector = measurement_method_toggle.value
+    return error
 
-    analyzer = None
-    compensator = None
-    error = None
+def set_fast_mode():
+    if service.is_connected():
+        service.analyzer.fast_mode = fast_mode_checkbox.value
 
-    try:
-        analyzer = Analyzer(detector)
-    except PowermeterNotFoundError:
-        error = 'Powermeter not found.'
-    except UnsupportedDetectorError:
-        error = f'Detector {detector} is not supported.'
-
-    if polarimeter_checkbox.value == False:
-        compensator = Compensator()
-
-    return analyzer, compensator, error
+def set_adaptive_averaging():
+    if service.is_connected():
+        service.analyzer.adaptive_averaging = adaptive_averaging_checkbox.value
 
 def hardware_deinitialization():
     if measurement_method_toggle.value == 'Photodiode':
         bias_slide.value = 0
         clear_calibration()
-    if compensator is not None:
-        compensator.close()
-    analyzer.close()
+    service.disconnect()
 
 async def connect_hardware():
-    global analyzer
-    global compensator
-
     set_all_elements_enable_state(elements_list, enable=False)
     loading_spinner.visible = True
 
     if connect_switch.value:
-        analyzer, compensator, error = await run.io_bound(hardware_initialization)
+        error = await run.io_bound(hardware_initialization)
 
         if error is None:
             connect_switch.text = 'Disconnect hardware'
+            if measurement_method_toggle.value == 'Photodiode':
+                update_calibration_label()
         else:
             ui.notify(error, type='negative')
             connect_switch.value = False
@@ -93,38 +92,28 @@ async def connect_hardware():
     connect_switch.enable()
 
 def set_bias_voltage():
-    analyzer.photodiode.set_bias_voltage(bias_slide.value)
-
-def perform_single_measurement(path=None):
-    global analyzer
+    service.analyzer.photodiode.request_bias_voltage(bias_slide.value)
 
-    analyzer.snap()
-
-    if analyzer.analog_data_valid or measurement_method_toggle.value == 'Powermeter':
-        degree_of_polarization, angle, degree_of_polarization_fit, _ = compute_polarization_parameters(
-            np.deg2rad(analyzer.measurement_data[0]),
-            analyzer.measurement_data[1],
-            max_intensity=CONFIG.detector_max_intensity
-            )
-    else:
-        degree_of_polarization = -1
-        degree_of_polarization_fit = None
-        return False
+def render_measurement(analyzer, degree_of_polarization_fit, polarization_parameters):
+    degree_of_polarization = polarization_parameters['ellipticity']
+    angle = polarization_parameters['alpha_max']
 
     if analyzer.analog_data_valid and measurement_method_toggle.value == 'Photodiode':
         analog_signal_figure.data = []
+        if analyzer.analog_data.shape[0] == 2:
+            analog_signal_figure.add_trace(go.Scatter(
+                x=np.arange(analyzer.analog_data.shape[1]),
+                y=analyzer.analog_data[0],
+                name='Detected {} triggers'.format(analyzer.measurement_data.shape[1]),
+                line={'color': CONFIG.c1 + '1.0)'}
+                ), row=1, col=1)
         analog_signal_figure.add_trace(go.Scatter(
             x=np.arange(analyzer.analog_data.shape[1]),
-            y=analyzer.analog_data[0],
-            name='Detected {} triggers'.format(analyzer.measurement_data.shape[1]),
-            line={'color': CONFIG.c1 + '1.0)'}
-            ), row=1, col=1)
-        analog_signal_figure.add_trace(go.Scatter(
-            x=np.arange(analyzer.analog_data.shape[1]),
-            y=analyzer.analog_data[1],
+            y=analyzer.analog_data[-1],
             line={'color': CONFIG.c0 + '1.0)'},
             showlegend=False
             ), row=2, col=1)
+        analog_signal_figure.update_layout(xaxis_range=[0, analyzer.analog_data.shape[1]])
         analog_signal_plot.update()
 
     processed_signal_figure.data = []
@@ -164,77 +153,73 @@ def perform_single_measurement(path=None):
             line={'color': CONFIG.c2 + '1.0)'},
             showlegend=False
             ), row=1, col=2)
-        
-        fit_success = True
-    else:
-        fit_success = False
-    
-    processed_signal_plot.update()
-
-    if path is not None:
-        analyzer.save(path)
-
-    return True, analyzer.missed_triggers, fit_success
 
-def perform_hwp_mapping(folder):
-    global compensator
-
-    compensator.hwp_rotation_stage.set_position(0, absolute=True)
-    hwp_mapping_step_size = int(90/(CONFIG.hwp_mapping_steps-1))
-    for ii in range(CONFIG.hwp_mapping_steps):
-        print(ii*hwp_mapping_step_size)
-        compensator.hwp_rotation_stage.set_position(ii*hwp_mapping_step_size, absolute=True)
-
-        path = f"{folder}/{ii:03d}"
-
-        perform_single_measurement(path)
-
-        experiment_progress.value = (ii+1)/CONFIG.hwp_mapping_steps
-
-def perform_hqwp_mapping(folder):
-    global compensator
-
-    compensator.hwp_rotation_stage.set_position(0, absolute=True)
-    hwp_mapping_step_size = int(90/(CONFIG.hwp_mapping_steps-1))
-    qwp_mapping_step_size = int(180/(CONFIG.qwp_mapping_steps-1))
-    for ii in range(CONFIG.hwp_mapping_steps):
-        print(ii*hwp_mapping_step_size)
-        compensator.hwp_rotation_stage.set_position(ii*hwp_mapping_step_size, absolute=True)
-
-        for jj in range(CONFIG.qwp_mapping_steps):
-            compensator.qwp_rotation_stage.set_position(jj*qwp_mapping_step_size, absolute=True)
-
-            path = f"{folder}/HWP-{ii:03d}_QWP-{jj:03d}"
-
-            perform_single_measurement(path)
-
-        experiment_progress.value = (ii+1)/CONFIG.hwp_mapping_steps    
-
-def perform_compensation_test(folder):
-    global compensator
-
-    filepath = r"...\YYYYMMDDTHHMMSSZ_HQWP_mapping_compensation.npz"
-    data = np.load(filepath)
-
-    HWP_angles = data['hwp']
-    QWP_angles = data['qwp_1']
-
-    for ii in range(len(HWP_angles)):
-        compensator.hwp_rotation_stage.set_position(HWP_angles[ii], absolute=True)
-        compensator.qwp_rotation_stage.set_position(QWP_angles[ii], absolute=True)
-        path = f"{folder}/HWP-{ii:03d}"
-        perform_single_measurement(path)
-        experiment_progress.value = (ii+1)/len(HWP_angles)  
-
-def perform_time_lapse(folder):
-    duration_minutes = 120
+    processed_signal_plot.update()
 
-    for ii in range(duration_minutes):
-        current_datetime = datetime.now().strftime("%Y%m%dT%H%M%SZ")    
-        path = f"{folder}/{current_datetime}"
-        perform_single_measurement(path)
-        time.sleep(60)
-        experiment_progress.value = (ii+1)/duration_minutes  
+def experiment_parameters(name):
+    parameters = {'root_folder': folder_path_input.value}
+
+    match name:
+        case 'HWP mapping':
+            parameters['hwp_mapping_steps'] = int(hwp_steps_input.value)
+        case 'HWP and QWP mapping':
+            parameters['hwp_mapping_steps'] = int(hwp_steps_input.value)
+            parameters['qwp_mapping_steps'] = int(qwp_steps_input.value)
+        case 'Optimal HQWP design':
+            parameters['prior_filepath'] = design_prior_input.value
+            parameters['number_of_points'] = int(design_points_input.value)
+        case 'Compensation test':
+            parameters['compensation_filepath'] = compensation_file_input.value
+        case 'Closed-loop compensation':
+            parameters['compensation_filepath'] = compensation_file_input.value
+            parameters['optimize_hwp'] = closed_loop_hwp_checkbox.value
+        case 'Time lapse':
+            parameters['duration_minutes'] = time_lapse_duration_input.value
+            parameters['interval_in_seconds'] = time_lapse_interval_input.value
+        case 'Resume mapping':
+            parameters = {'folder': resume_folder_input.value}
+        case 'Analyzer velocity search':
+            parameters = {}
+
+    return parameters
+
+def submit_experiment(name):
+    service.submit(name, profile=profile_checkbox.value, **experiment_parameters(name))
+    refresh_experiment_queue()
+
+def toggle_experiment_queue_pause():
+    if experiment_queue.is_paused():
+        experiment_queue.resume()
+        queue_pause_button.text = 'Pause queue'
+    else:
+        experiment_queue.pause()
+        queue_pause_button.text = 'Resume queue'
+
+def refresh_experiment_queue():
+    global experiment_queue_busy
+
+    queue_table.rows = [job.describe() for job in experiment_queue.jobs()]
+    queue_table.update()
+
+    busy = experiment_queue.is_busy()
+    if busy != experiment_queue_busy:
+        set_all_elements_enable_state(queue_locked_elements_list, enable=not busy)
+        experiment_queue_busy = busy
+
+    experiment_progress.value = service.progress
+    experiment_progress.visible = experiment_queue.current_job is not None
+
+def refresh_timing_table():
+    timing_table.rows = [
+        {
+            'phase': phase,
+            'count': summary['count'],
+            'p50': f"{1000*summary['p50']:.1f}",
+            'p90': f"{1000*summary['p90']:.1f}",
+            'p99': f"{1000*summary['p99']:.1f}"
+        } for phase, summary in instrumentation.percentiles().items()
+    ]
+    timing_table.update()
 
 async def single_measurement():
     with disable_all_while_busy(elements_list):
@@ -256,77 +241,49 @@ async def single_measurement():
             path = f"{folder}/{current_datetime}{experiment_name}"
 
 
-        single_measurement_success, missing_analog_triggers, fit_success = await run.io_bound(perform_single_measurement, path)
+        result = await run.io_bound(service.snap, path, profile_checkbox.value)
 
-        if not single_measurement_success:
+        if result is None:
             ui.notify('Unable to acquire data, check DAQ timeout if using Photodiode.', type='warning')
+        else:
+            if result['missed_triggers'] > 0:
+                ui.notify(f"Missing {result['missed_triggers']} analog triggers.", type='warning')
+            if result['reconstructed_triggers'] > 0:
+                ui.notify(f"Reconstructed {result['reconstructed_triggers']} analog triggers.", type='info')
 
-        if missing_analog_triggers > 0:
-            ui.notify(f'Missing {missing_analog_triggers} analog triggers.', type='warning')
-
-        if not fit_success:
-            ui.notify('Unable to fit intensity data.', type='warning')
+            if not result['fit_success']:
+                ui.notify('Unable to fit intensity data.', type='warning')
 
         loading_spinner.visible = False
         loading_spinner.value = 0
 
-async def hwp_mapping():
-    with disable_all_while_busy(elements_list):
-        experiment_progress.visible = True
-
-        folder = f"{folder_path_input.value}/{datetime.now().strftime('%Y%m%dT%H%M%SZ')}_HWP_mapping"
-        Path(folder).mkdir(parents=True, exist_ok=True)
-
-        await run.io_bound(perform_hwp_mapping, folder)
-
-        experiment_progress.visible = False
-
-async def hqwp_mapping():
-    with disable_all_while_busy(elements_list):
-        experiment_progress.visible = True
-
-        folder = f"{folder_path_input.value}/{datetime.now().strftime('%Y%m%dT%H%M%SZ')}_HQWP_mapping"
-        Path(folder).mkdir(parents=True, exist_ok=True)
-
-        await run.io_bound(perform_hqwp_mapping, folder)
-
-        experiment_progress.visible = False
-
-async def test_compensation():
-    with disable_all_while_busy(elements_list):
-        experiment_progress.visible = True
-
-        folder = f"{folder_path_input.value}/{datetime.now().strftime('%Y%m%dT%H%M%SZ')}_compensation_test"
-        Path(folder).mkdir(parents=True, exist_ok=True)
-
-        await run.io_bound(perform_compensation_test, folder)
-
-        experiment_progress.visible = False
-
-async def time_lapse():
-    with disable_all_while_busy(elements_list):
-        experiment_progress.visible = True
-
-        folder = folder_path_input.value
-
-        await run.io_bound(perform_time_lapse, folder)
-
-        experiment_progress.visible = False
-
 async def calibration_measurement():
     with disable_all_while_busy(elements_list):
         calibration_progress.visible = True
         calibration_timer.activate()
-        await run.io_bound(analyzer.photodiode.calibrate)
-        calibration_label.text = f'Calibration offset: {1000 * analyzer.photodiode.calibration_mean:.3f}±{1000 * analyzer.photodiode.calibration_std:.3f}mV'
+        await run.io_bound(service.calibrate)
+        update_calibration_label()
         calibration_timer.deactivate()
         calibration_progress.visible = False
         calibration_progress.value = 0
 
 def clear_calibration():
-    analyzer.photodiode.calibration_mean = 0
-    analyzer.photodiode.calibration_std = 0
-    calibration_label.text = 'No calibration offset'
+    service.analyzer.photodiode.clear_calibration()
+    update_calibration_label()
+
+def refresh_calibration_label():
+    # The calibration of a requested bias voltage is only selected once the coalesced write is applied.
+    if service.is_connected() and getattr(service.analyzer, 'photodiode', None) is not None:
+        update_calibration_label()
+
+def update_calibration_label():
+    photodiode = service.analyzer.photodiode
+
+    if photodiode.calibration_timestamp is None:
+        calibration_label.text = 'No calibration offset'
+    else:
+        calibration_time = datetime.fromtimestamp(photodiode.calibration_timestamp).strftime('%Y-%m-%d %H:%M')
+        calibration_label.text = f'Calibration offset: {1000 * photodiode.calibration_mean:.3f}±{1000 * photodiode.calibration_std:.3f}mV (standard error {1E6 * photodiode.calibration_standard_error:.1f}µV, {calibration_time})'
 
 def create_analog_signal_figure():
     analog_signal_figure = make_subplots(rows=2, shared_xaxes=True, x_title='Samples @ 25kS/s', vertical_spacing=0.1)
@@ -407,18 +364,68 @@ with ui.row():
 
 with ui.row():
     single_measurement_button = ui.button('Acquire single measurement', on_click=single_measurement)
-    hwp_mapping_button = ui.button('Polarization mapping with HWP', on_click=hwp_mapping)
-    hqwp_mapping_button = ui.button('Polarization mapping with HWP and QWP', on_click=hqwp_mapping)
-    test_compensation_button = ui.button('Test compensation', on_click=test_compensation)
-    time_lapse_button = ui.button('Time lapse', on_click=time_lapse)
+    hwp_mapping_button = ui.button('Polarization mapping with HWP', on_click=lambda: submit_experiment('HWP mapping'))
+    hqwp_mapping_button = ui.button('Polarization mapping with HWP and QWP', on_click=lambda: submit_experiment('HWP and QWP mapping'))
+    test_compensation_button = ui.button('Test compensation', on_click=lambda: submit_experiment('Compensation test'))
+    time_lapse_button = ui.button('Time lapse', on_click=lambda: submit_experiment('Time lapse'))
+    fast_mode_checkbox = ui.checkbox(f'Fast polarimetry ({CONFIG.fast_mode_number_of_angles} angles)', value=CONFIG.fast_mode_enabled, on_change=set_fast_mode)
+    adaptive_averaging_checkbox = ui.checkbox(f'Adaptive averaging (ellipticity std {CONFIG.adaptive_averaging_target_ellipticity_std})', value=CONFIG.adaptive_averaging_enabled, on_change=set_adaptive_averaging)
     single_measurement_button.disable()
     hwp_mapping_button.disable()
     hqwp_mapping_button.disable()
     test_compensation_button.disable()
     time_lapse_button.disable()
 
+with ui.card():
+    with ui.row():
+        hwp_steps_input = ui.number(label='HWP steps', value=CONFIG.hwp_mapping_steps, min=2, step=1, format='%d')
+        qwp_steps_input = ui.number(label='QWP steps', value=CONFIG.qwp_mapping_steps, min=2, step=1, format='%d')
+        time_lapse_duration_input = ui.number(label='Time lapse duration (min)', value=CONFIG.time_lapse_duration_in_minutes, min=1)
+        time_lapse_interval_input = ui.number(label='Time lapse interval (s)', value=CONFIG.time_lapse_interval_in_seconds, min=1)
+        compensation_file_input = ui.input(label='Compensation file', value=COMPENSATION_FILEPATH).classes('w-96')
+        closed_loop_hwp_checkbox = ui.checkbox('Closed loop: optimize HWP too')
+        resume_folder_input = ui.input(label='Mapping folder to resume').classes('w-96')
+        design_prior_input = ui.input(label='Optimal design prior (system_parameters.json)').classes('w-96')
+        design_points_input = ui.number(label='Optimal design points', value=CONFIG.optimal_design_number_of_points, min=6, step=1, format='%d')
+    with ui.row():
+        queue_experiment_select = ui.select(list(service.experiments.keys()), value='HWP mapping').classes('w-64')
+        queue_add_button = ui.button('Add to queue', on_click=lambda: submit_experiment(queue_experiment_select.value))
+        queue_pause_button = ui.button('Pause queue', on_click=toggle_experiment_queue_pause)
+        queue_cancel_button = ui.button('Cancel current', on_click=lambda: experiment_queue.cancel())
+        queue_cancel_all_button = ui.button('Cancel all', on_click=experiment_queue.cancel_all)
+        queue_clear_button = ui.button('Clear history', on_click=experiment_queue.clear_history)
+        queue_add_button.disable()
+    queue_table = ui.table(
+        columns=[
+            {'name': 'id', 'label': 'Job', 'field': 'id'},
+            {'name': 'name', 'label': 'Experiment', 'field': 'name', 'align': 'left'},
+            {'name': 'parameters', 'label': 'Parameters', 'field': 'parameters', 'align': 'left'},
+            {'name': 'status', 'label': 'Status', 'field': 'status'},
+            {'name': 'error', 'label': 'Error', 'field': 'error', 'align': 'left'}
+        ],
+        rows=[],
+        row_key='id'
+    ).classes('w-full')
+
+with ui.card():
+    with ui.row():
+        ui.label('Acquisition timing (ms)').style('font-size: 170%; font-weight: 300')
+        profile_checkbox = ui.checkbox('Profile measurements and experiments (cProfile)', value=False)
+        ui.button('Reset timing', on_click=instrumentation.reset)
+    timing_table = ui.table(
+        columns=[
+            {'name': 'phase', 'label': 'Phase', 'field': 'phase', 'align': 'left'},
+            {'name': 'count', 'label': 'Count', 'field': 'count'},
+            {'name': 'p50', 'label': 'p50', 'field': 'p50'},
+            {'name': 'p90', 'label': 'p90', 'field': 'p90'},
+            {'name': 'p99', 'label': 'p99', 'field': 'p99'}
+        ],
+        rows=[],
+        row_key='phase'
+    ).classes('w-full')
+
 calibration_progress = ui.circular_progress(show_value=False, size='100px').props('instant-feedback').classes('absolute-center')
-calibration_timer = ui.timer(0.1, lambda: calibration_progress.set_value(calibration_progress.value + 0.1 / CONFIG.nidaqmx_calibration_duration_in_seconds), active=False)
+calibration_timer = ui.timer(0.1, lambda: calibration_progress.set_value(service.analyzer.photodiode.calibration_progress), active=False)
 calibration_progress.visible = False
 
 experiment_progress = ui.circular_progress(show_value=False, size='100px').props('instant-feedback').classes('absolute-center')
@@ -437,11 +444,32 @@ elements_list = [
     hqwp_mapping_button,
     test_compensation_button,
     time_lapse_button,
+    queue_add_button,
+    single_measurement_button,
+    calibration_measurement_button,
+    calibration_clear_button,
+    bias_slide]
+
+queue_locked_elements_list = [
+    connect_switch,
     single_measurement_button,
     calibration_measurement_button,
     calibration_clear_button,
     bias_slide]
 
+service.measurement_listeners.append(render_measurement)
+
+if CONFIG.live_analysis_enabled:
+    from experiments.AnalysisService import AnalysisService
+
+    analysis_service = AnalysisService(CONFIG.experiment_folder, max_intensity=CONFIG.detector_max_intensity, number_of_starts=CONFIG.live_analysis_system_fit_starts, catch_up=CONFIG.live_analysis_catch_up, chunked=CONFIG.live_analysis_chunked_system_fit)
+    app.on_startup(analysis_service.start)
+    app.on_shutdown(analysis_service.stop)
+
+ui.timer(0.5, refresh_experiment_queue)
+ui.timer(0.5, refresh_calibration_label)
+ui.timer(2, refresh_timing_table)
+
 ui.run(
     port=80,
     title='Polarization Control',
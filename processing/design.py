@@ -0,0 +1,57 @@
+import numpy as np
+
+from processing.processing import general_intensity
+
+SYSTEM_PARAMETER_NAMES = ['intensity_0', 'gamma', 'delta', 'theta_0', 'phi_0', 'alpha_0']
+
+def system_jacobian(primes, parameters, relative_step=1E-6):
+    # Central differences of general_intensity with respect to the six system parameters.
+    parameters = np.asarray(parameters, dtype=float)
+    jacobian = np.empty((primes.shape[1], len(parameters)))
+    for ii in range(len(parameters)):
+        step = relative_step * max(abs(parameters[ii]), 1)
+        forward, backward = parameters.copy(), parameters.copy()
+        forward[ii] += step
+        backward[ii] -= step
+        jacobian[:, ii] = (general_intensity(primes, *forward) - general_intensity(primes, *backward)) / (2 * step)
+
+    return jacobian
+
+def cell_information(hwp_angles, qwp_angles, analyzer_angles, parameters):
+    # Fisher information (per unit noise variance) of one analyzer revolution at each (HWP, QWP) cell, angles in degrees.
+    cells = [(hwp, qwp) for hwp in hwp_angles for qwp in qwp_angles]
+    number_of_angles = len(analyzer_angles)
+
+    primes = np.deg2rad(np.vstack((
+        np.repeat([hwp for hwp, _ in cells], number_of_angles),
+        np.repeat([qwp for _, qwp in cells], number_of_angles),
+        np.tile(analyzer_angles, len(cells))
+    )))
+    jacobian = system_jacobian(primes, parameters).reshape(len(cells), number_of_angles, -1)
+
+    return cells, np.einsum('cai,caj->cij', jacobian, jacobian)
+
+def plan_d_optimal(cell_informations, number_of_points, regularization=1E-9):
+    # Greedy D-optimal selection: each step adds the cell that most increases log det of the summed information.
+    # The small ridge makes the first, rank-deficient steps well defined.
+    total = regularization * np.mean(np.trace(cell_informations, axis1=1, axis2=2)) * np.eye(cell_informations.shape[1])
+    available = np.ones(len(cell_informations), dtype=bool)
+    selected = []
+
+    for _ in range(min(number_of_points, len(cell_informations))):
+        _, log_determinants = np.linalg.slogdet(total + cell_informations)
+        log_determinants[~available] = -np.inf
+        best = int(np.argmax(log_determinants))
+
+        selected.append(best)
+        available[best] = False
+        total = total + cell_informations[best]
+
+    return selected
+
+def expected_covariance(cell_informations, selected, noise_std):
+    information = np.sum(cell_informations[selected], axis=0) / noise_std**2
+    if np.linalg.matrix_rank(information) < information.shape[0]:
+        return np.full(information.shape, np.inf)
+
+    return np.linalg.inv(information)
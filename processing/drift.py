@@ -0,0 +1,81 @@
+import csv
+import os
+from datetime import datetime, timezone
+
+from processing.processing import load_hqwp_map, fit_hqwp_map_chunked, compute_system_parameters, compute_system_parameters_multistart, system_fit_residuals, canonical_system_parameters, closest_system_parameters
+
+DRIFT_COLUMNS = ['started', 'folder', 'intensity_0', 'gamma', 'delta', 'theta_0', 'phi_0', 'alpha_0', 'rmse', 'nrmse', 'number_of_samples', 'warm_started']
+
+def map_start_time(folder):
+    # Map folders are named %Y%m%dT%H%M%SZ_<experiment>.
+    try:
+        return datetime.strptime(os.path.basename(os.path.normpath(folder)).split('_')[0], '%Y%m%dT%H%M%SZ').replace(tzinfo=timezone.utc)
+    except ValueError:
+        return datetime.fromtimestamp(os.path.getmtime(folder), tz=timezone.utc)
+
+def read_drift_table(path):
+    if not os.path.isfile(path):
+        return []
+
+    with open(path, 'r', newline='') as file:
+        return list(csv.DictReader(file))
+
+def fit_map(primes, aggregated_intensities, previous_parameters, max_intensity, number_of_starts):
+    if previous_parameters is not None:
+        try:
+            return compute_system_parameters(primes, aggregated_intensities, max_intensity=max_intensity, p0=previous_parameters), True
+        except RuntimeError:
+            print('WARNING: warm-started fit did not converge, falling back to multi-start.')
+
+    parameters, _ = compute_system_parameters_multistart(primes, aggregated_intensities, number_of_starts=number_of_starts, max_intensity=max_intensity)
+
+    return parameters, False
+
+def track_drift(folders, output_path, max_intensity=10, number_of_starts=16, chunked=False):
+    rows = read_drift_table(output_path)
+    fitted_folders = {os.path.normpath(row['folder']) for row in rows}
+    previous_parameters = None
+    if rows:
+        previous_parameters = [float(rows[-1][column]) for column in DRIFT_COLUMNS[2:8]]
+
+    folders = sorted((folder for folder in folders if os.path.normpath(folder) not in fitted_folders), key=map_start_time)
+    if rows and folders and map_start_time(folders[0]).isoformat() < rows[-1]['started']:
+        print('WARNING: some maps are older than the last fitted map, they are warm-started from the most recent solution.')
+
+    for folder in folders:
+        print(folder)
+        if chunked:
+            # Dense maps are fitted out of core, from the previous solution or the single-start p0.
+            parameters, rmse, nrmse, number_of_samples = fit_hqwp_map_chunked(folder, max_intensity=max_intensity, p0=previous_parameters)
+            warm_started = previous_parameters is not None
+        else:
+            primes, aggregated_intensities = load_hqwp_map(folder)
+            parameters, warm_started = fit_map(primes, aggregated_intensities, previous_parameters, max_intensity, number_of_starts)
+            rmse, nrmse = system_fit_residuals(primes, aggregated_intensities, parameters)
+            number_of_samples = len(aggregated_intensities)
+
+        # Parameters are reduced by the model symmetries so consecutive maps are comparable. Near gamma = 1 the
+        # canonical form can switch to the gamma inversion between maps, so the form closest to the previous map is kept.
+        if previous_parameters is None:
+            reduced_parameters = canonical_system_parameters(*parameters)
+        else:
+            reduced_parameters = closest_system_parameters(parameters, previous_parameters)
+        rows.append(dict(
+            zip(DRIFT_COLUMNS[2:8], (float(value) for value in reduced_parameters)),
+            started=map_start_time(folder).isoformat(),
+            folder=os.path.normpath(folder),
+            rmse=float(rmse),
+            nrmse=float(nrmse),
+            number_of_samples=number_of_samples,
+            warm_started=warm_started
+        ))
+        previous_parameters = reduced_parameters
+
+        # The table is rewritten after every map so an interrupted run keeps its fits.
+        rows.sort(key=lambda row: row['started'])
+        with open(output_path, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=DRIFT_COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+    return rows
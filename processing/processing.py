@@ -1,9 +1,28 @@
 import numpy as np
 from numpy import sin, cos
-import os, re
+import json, os, re, tempfile
+from concurrent.futures import ProcessPoolExecutor
 import plotly.graph_objects as go
 from scipy.optimize import curve_fit, root
+from scipy.stats import qmc
 
+# Periods of delta, theta_0, phi_0 and alpha_0 in general_intensity: shifting one of them by its period leaves the model unchanged.
+SYSTEM_ANGLE_PERIODS = (2*np.pi, np.pi/2, np.pi, np.pi)
+
+
+def update_running_statistics(count, mean, m2, samples):
+    samples = np.asarray(samples, dtype=float)
+
+    chunk_count = samples.size
+    chunk_mean = np.mean(samples)
+    chunk_m2 = np.sum((samples - chunk_mean)**2)
+
+    total_count = count + chunk_count
+    delta = chunk_mean - mean
+    mean = mean + delta * chunk_count / total_count
+    m2 = m2 + chunk_m2 + delta**2 * count * chunk_count / total_count
+
+    return total_count, mean, m2
 
 def linear_polarization(phi, theta, delta):
     return np.tan(2*phi) + np.tan(delta) * np.sin(2 * (2*theta - phi))
@@ -41,7 +60,7 @@ def compute_polarization_parameters(angles: np.ndarray, intensity: np.ndarray, f
             bounds=((0, 0, 0), (np.pi, max_scaled_intensity**0.5, max_scaled_intensity**0.5))
         )
     except RuntimeError:
-        return -1, -1, None, np.inf
+        return -1, -1, np.nan, None, np.inf
 
     alpha_max, k, scaled_e_min = popt
 
@@ -56,6 +75,48 @@ def compute_polarization_parameters(angles: np.ndarray, intensity: np.ndarray, f
 
     return ellipticity, e_max, alpha_max, fitted_intensity, nrmse
 
+def fast_polarimetry_angles(number_of_angles):
+    # polarimeter_intensity has period 180 deg, equally spaced angles over half a turn make the linear fit orthogonal.
+    return np.arange(number_of_angles) * 180 / number_of_angles
+
+def compute_polarization_parameters_linear(angles: np.ndarray, intensity: np.ndarray):
+    # polarimeter_intensity written as a0 + a1*cos(2*alpha) + a2*sin(2*alpha), with a0 = (e_max**2 + e_min**2)/2
+    # and sqrt(a1**2 + a2**2) = (e_max**2 - e_min**2)/2, solved by linear least squares.
+    design = np.column_stack((np.ones_like(angles), np.cos(2*angles), np.sin(2*angles)))
+    coefficients, _, rank, _ = np.linalg.lstsq(design, intensity, rcond=None)
+    if rank < 3:
+        return -1, -1, np.nan, None, np.inf, {'ellipticity': np.inf, 'alpha_max': np.inf}
+
+    a0, a1, a2 = coefficients
+    amplitude = np.hypot(a1, a2)
+    e_max_squared = a0 + amplitude
+    e_min_squared = max(a0 - amplitude, 0)
+
+    ellipticity = np.sqrt(e_min_squared / e_max_squared)
+    e_max = np.sqrt(e_max_squared)
+    alpha_max = (np.arctan2(a2, a1) / 2) % np.pi
+
+    fitted_intensity = design @ coefficients
+    residuals = intensity - fitted_intensity
+    rmse = np.sqrt(np.mean(residuals ** 2))
+    nrmse = rmse / np.mean(intensity)
+
+    # Coefficient covariance from the residual variance, propagated to the ellipticity and angle (delta method).
+    if len(intensity) > 3:
+        covariance = np.sum(residuals ** 2) / (len(intensity) - 3) * np.linalg.inv(design.T @ design)
+        d_ratio_d_a0 = 2 * amplitude / e_max_squared**2
+        d_ratio_d_amplitude = -2 * a0 / e_max_squared**2
+        d_ellipticity = np.array([d_ratio_d_a0, d_ratio_d_amplitude * a1 / amplitude, d_ratio_d_amplitude * a2 / amplitude]) / (2 * max(ellipticity, 1E-12))
+        d_alpha_max = np.array([0, -a2, a1]) / (2 * amplitude**2)
+        uncertainty = {
+            'ellipticity': float(np.sqrt(d_ellipticity @ covariance @ d_ellipticity)),
+            'alpha_max': float(np.sqrt(d_alpha_max @ covariance @ d_alpha_max))
+        }
+    else:
+        uncertainty = {'ellipticity': np.nan, 'alpha_max': np.nan}
+
+    return ellipticity, e_max, alpha_max, fitted_intensity, nrmse, uncertainty
+
 def general_intensity(primes, intensity_0, gamma, delta, theta_0, phi_0, alpha_0):
     theta_prime, phi_prime, alpha_prime = primes
 
@@ -72,15 +133,27 @@ def general_intensity(primes, intensity_0, gamma, delta, theta_0, phi_0, alpha_0
 
     return intensity_0 * ( (d_1**2 + d_2**2)*cos(alpha)**2 + (d_3**2 + d_4**2)*sin(alpha)**2 + 2*(d_1*d_3 + d_2*d_4)*sin(alpha)*cos(alpha) )
 
-def compute_system_parameters(primes, aggregated_intensities, fit_factor=1E4, max_intensity=10):
-    scaled_aggregated_intensities = aggregated_intensities * fit_factor
+def system_parameter_bounds(fit_factor, max_intensity):
     max_scaled_intensity = max_intensity * fit_factor
+
+    return [0, 0, -np.pi, -np.pi, -np.pi, -np.pi], [max_scaled_intensity, np.inf, np.pi, np.pi, np.pi, np.pi]
+
+def compute_system_parameters(primes, aggregated_intensities, fit_factor=1E4, max_intensity=10, p0=None):
+    scaled_aggregated_intensities = aggregated_intensities * fit_factor
+    bounds = system_parameter_bounds(fit_factor, max_intensity)
+    if p0 is None:
+        p0 = [fit_factor, 1, 0, 0, 0, 0]
+    else:
+        # p0 is a previous solution (unscaled intensity_0), kept strictly inside the bounds.
+        intensity_0, gamma, delta, theta_0, phi_0, alpha_0 = canonical_system_parameters(*p0)
+        p0 = np.clip([intensity_0 * fit_factor, gamma, delta, theta_0, phi_0, alpha_0], np.array(bounds[0]) + 1E-9, np.array(bounds[1]) - 1E-9)
+
     popt, _, _, msg, _ = curve_fit(
         general_intensity,
         primes,
         scaled_aggregated_intensities,
-        p0 = [fit_factor, 1, 0, 0, 0, 0],
-        bounds=([0, 0, -np.pi, -np.pi, -np.pi, -np.pi], [max_scaled_intensity, np.inf, np.pi, np.pi, np.pi, np.pi]),
+        p0 = p0,
+        bounds=bounds,
         full_output=True
     )
 
@@ -106,6 +179,285 @@ def compute_system_parameters(primes, aggregated_intensities, fit_factor=1E4, ma
 
     return intensity_0, gamma, delta, theta_0, phi_0, alpha_0
 
+def system_fit_residuals(primes, aggregated_intensities, parameters):
+    fit = general_intensity(primes, *parameters)
+    rmse = np.sqrt(np.mean((aggregated_intensities - fit) ** 2))
+
+    return rmse, rmse / np.mean(aggregated_intensities)
+
+def mirrored_system_parameters(intensity_0, gamma, delta, theta_0, phi_0, alpha_0):
+    # Inverting gamma (with intensity_0 scaled by gamma**2), negating delta and rotating theta_0 by an eighth and
+    # alpha_0 by a quarter turn leaves the model unchanged.
+    return (intensity_0 * gamma**2, 1 / gamma, -delta, theta_0 + np.pi/4, phi_0, alpha_0 - np.pi/2)
+
+def canonical_system_parameters(intensity_0, gamma, delta, theta_0, phi_0, alpha_0):
+    if gamma > 1:
+        return _folded_system_parameters(*mirrored_system_parameters(intensity_0, gamma, delta, theta_0, phi_0, alpha_0))
+
+    return _folded_system_parameters(intensity_0, gamma, delta, theta_0, phi_0, alpha_0)
+
+def _folded_system_parameters(intensity_0, gamma, delta, theta_0, phi_0, alpha_0):
+    angles = [(angle + period/2) % period - period/2 for angle, period in zip((delta, theta_0, phi_0, alpha_0), SYSTEM_ANGLE_PERIODS)]
+
+    # Negating delta and rotating phi_0 by a quarter turn also leaves the model unchanged.
+    if angles[0] < 0:
+        angles[0] = -angles[0]
+        angles[2] = (angles[2] + np.pi) % np.pi - np.pi/2
+
+    return (intensity_0, gamma, *angles)
+
+def equivalent_system_parameters(intensity_0, gamma, delta, theta_0, phi_0, alpha_0):
+    # The canonical form and its gamma inversion with folded angles. Solutions with gamma close to 1 can sit on either side.
+    canonical_parameters = canonical_system_parameters(intensity_0, gamma, delta, theta_0, phi_0, alpha_0)
+
+    return canonical_parameters, _folded_system_parameters(*mirrored_system_parameters(*canonical_parameters))
+
+def closest_system_parameters(parameters, reference):
+    # The equivalent form of parameters closest to reference (relative intensity_0 and gamma, wrapped angles).
+    def distance(candidate):
+        angle_differences = [(angle - reference_angle + period/2) % period - period/2 for angle, reference_angle, period in zip(candidate[2:], reference[2:], SYSTEM_ANGLE_PERIODS)]
+        return np.log(candidate[0] / reference[0])**2 + np.log(candidate[1] / reference[1])**2 + np.sum(np.square(angle_differences))
+
+    return min(equivalent_system_parameters(*parameters), key=distance)
+
+def is_same_system_solution(parameters_1, parameters_2, relative_tolerance=1E-3, absolute_tolerance=1E-9, angle_tolerance=1E-3):
+    canonical_parameters_1 = canonical_system_parameters(*parameters_1)
+
+    return any(
+        _is_same_canonical_solution(canonical_parameters_1, candidate, relative_tolerance, absolute_tolerance, angle_tolerance)
+        for candidate in equivalent_system_parameters(*parameters_2)
+    )
+
+def _is_same_canonical_solution(parameters_1, parameters_2, relative_tolerance, absolute_tolerance, angle_tolerance):
+    for value_1, value_2 in zip(parameters_1[:2], parameters_2[:2]):
+        if abs(value_1 - value_2) > relative_tolerance * max(abs(value_1), abs(value_2)) + absolute_tolerance:
+            return False
+
+    for angle_1, angle_2, period in zip(parameters_1[2:], parameters_2[2:], SYSTEM_ANGLE_PERIODS):
+        difference = abs(angle_1 - angle_2) % period
+        if min(difference, period - difference) > angle_tolerance:
+            return False
+
+    return True
+
+def system_starting_points(number_of_starts, fit_factor, seed=0):
+    # The first start is the single-start p0, the others fill gamma (log scale) and one period of each angle.
+    starts = [[fit_factor, 1, 0, 0, 0, 0]]
+    if number_of_starts > 1:
+        samples = qmc.Halton(d=5, seed=seed).random(number_of_starts - 1)
+        lower = [np.log(0.25), -np.pi, -np.pi/4, -np.pi/2, -np.pi/2]
+        upper = [np.log(4), np.pi, np.pi/4, np.pi/2, np.pi/2]
+        for log_gamma, delta, theta_0, phi_0, alpha_0 in qmc.scale(samples, lower, upper):
+            starts.append([fit_factor, np.exp(log_gamma), delta, theta_0, phi_0, alpha_0])
+
+    return starts
+
+_system_fit_data = {}
+
+def _initialize_system_fit(primes, scaled_aggregated_intensities, bounds):
+    _system_fit_data.update(primes=primes, scaled_aggregated_intensities=scaled_aggregated_intensities, bounds=bounds)
+
+def _fit_system_from(p0):
+    try:
+        popt, _ = curve_fit(
+            general_intensity,
+            _system_fit_data['primes'],
+            _system_fit_data['scaled_aggregated_intensities'],
+            p0=p0,
+            bounds=_system_fit_data['bounds']
+        )
+    except RuntimeError:
+        return None
+
+    residuals = general_intensity(_system_fit_data['primes'], *popt) - _system_fit_data['scaled_aggregated_intensities']
+
+    return popt, float(np.sqrt(np.mean(residuals**2)))
+
+def compute_system_parameters_multistart(primes, aggregated_intensities, number_of_starts=16, fit_factor=1E4, max_intensity=10, max_workers=None, seed=0):
+    scaled_aggregated_intensities = aggregated_intensities * fit_factor
+    initialization = (primes, scaled_aggregated_intensities, system_parameter_bounds(fit_factor, max_intensity))
+    starts = system_starting_points(number_of_starts, fit_factor, seed=seed)
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_initialize_system_fit, initargs=initialization) as executor:
+        fits = [fit for fit in executor.map(_fit_system_from, starts) if fit is not None]
+
+    solutions = []
+    for popt, scaled_rmse in sorted(fits, key=lambda fit: fit[1]):
+        parameters = (popt[0] / fit_factor, *popt[1:])
+        canonical_parameters = canonical_system_parameters(*parameters)
+
+        duplicate = next((solution for solution in solutions if is_same_system_solution(solution['canonical_parameters'], canonical_parameters)), None)
+        if duplicate is not None:
+            duplicate['starts'] += 1
+            continue
+
+        solutions.append({
+            'parameters': tuple(float(value) for value in parameters),
+            'canonical_parameters': tuple(float(value) for value in canonical_parameters),
+            'rmse': scaled_rmse / fit_factor,
+            'starts': 1
+        })
+
+    if not solutions:
+        raise RuntimeError('none of the starting points converged')
+
+    for rank, solution in enumerate(solutions):
+        intensity_0, gamma, delta, theta_0, phi_0, alpha_0 = solution['parameters']
+        print(f"#{rank} ({solution['starts']} starts, RMSE {solution['rmse']:.3g}) Intensity_0: {intensity_0:.2f}, Gamma: {gamma:.2f}, Delta: {np.rad2deg(delta):.2f}, Theta_0: {np.rad2deg(theta_0):.2f}, Phi_0: {np.rad2deg(phi_0):.2f}, Alpha_0: {np.rad2deg(alpha_0):.2f}")
+
+    return solutions[0]['parameters'], solutions
+
+def grid_chunks(hwp_angles, qwp_angles, pol_angles, chunk_size=2**18, dtype=np.float64):
+    # Coordinates follow the create_map order (HWP outermost, analyzer innermost) and are generated per chunk.
+    shape = (len(hwp_angles), len(qwp_angles), len(pol_angles))
+    axes = [np.asarray(axis, dtype=dtype) for axis in (hwp_angles, qwp_angles, pol_angles)]
+
+    for start in range(0, int(np.prod(shape)), chunk_size):
+        stop = min(start + chunk_size, int(np.prod(shape)))
+        indices = np.unravel_index(np.arange(start, stop), shape)
+        yield start, stop, np.vstack([axis[index] for axis, index in zip(axes, indices)])
+
+def _accumulate_normal_equations(hwp_angles, qwp_angles, pol_angles, intensities, parameters, chunk_size, dtype, with_jacobian=True):
+    jtj = np.zeros((6, 6))
+    jtr = np.zeros(6)
+    cost = 0.0
+    steps = np.sqrt(np.finfo(dtype).eps) * np.maximum(np.abs(parameters), 1)
+
+    for start, stop, primes in grid_chunks(hwp_angles, qwp_angles, pol_angles, chunk_size, dtype):
+        model = general_intensity(primes, *parameters.astype(dtype))
+        residuals = np.asarray(intensities[start:stop], dtype=dtype) - model
+        cost += float(np.dot(residuals, residuals.astype(np.float64)))
+        if not with_jacobian:
+            continue
+
+        jacobian = np.empty((stop - start, 6))
+        for jj in range(6):
+            shifted = parameters.copy()
+            shifted[jj] += steps[jj]
+            jacobian[:, jj] = (general_intensity(primes, *shifted.astype(dtype)) - model) / steps[jj]
+        jtj += jacobian.T @ jacobian
+        jtr += jacobian.T @ residuals
+
+    return jtj, jtr, cost
+
+def compute_system_parameters_chunked(hwp_angles, qwp_angles, pol_angles, aggregated_intensities, fit_factor=1E4, max_intensity=10, p0=None,
+                                      chunk_size=2**18, dtype=np.float64, max_iterations=100, tolerance=1E-10):
+    # Levenberg-Marquardt on normal equations accumulated chunk by chunk, aggregated_intensities can be a flat np.memmap.
+    lower, upper = system_parameter_bounds(fit_factor, max_intensity)
+    number_of_samples = len(hwp_angles) * len(qwp_angles) * len(pol_angles)
+    scaled_intensities = _ScaledIntensities(np.reshape(aggregated_intensities, -1), fit_factor)
+
+    if p0 is None:
+        parameters = np.array([fit_factor, 1, 0, 0, 0, 0], dtype=float)
+    else:
+        parameters = np.array(canonical_system_parameters(*p0), dtype=float)
+        parameters[0] *= fit_factor
+
+    damping = 1E-3
+    jtj, jtr, cost = _accumulate_normal_equations(hwp_angles, qwp_angles, pol_angles, scaled_intensities, parameters, chunk_size, dtype)
+    for _ in range(max_iterations):
+        diagonal = np.diag(np.diag(jtj)) + 1E-12 * np.eye(6)
+        step = np.linalg.solve(jtj + damping * diagonal, jtr)
+        candidate = np.clip(parameters + step, lower, upper)
+
+        _, _, candidate_cost = _accumulate_normal_equations(hwp_angles, qwp_angles, pol_angles, scaled_intensities, candidate, chunk_size, dtype, with_jacobian=False)
+        if candidate_cost < cost:
+            converged = cost - candidate_cost <= tolerance * cost or np.linalg.norm(candidate - parameters) <= tolerance * (np.linalg.norm(parameters) + tolerance)
+            parameters = candidate
+            damping = max(damping / 10, 1E-12)
+            jtj, jtr, cost = _accumulate_normal_equations(hwp_angles, qwp_angles, pol_angles, scaled_intensities, parameters, chunk_size, dtype)
+            if converged:
+                break
+        else:
+            damping *= 10
+            if damping > 1E12:
+                break
+
+    intensity_0, gamma, delta, theta_0, phi_0, alpha_0 = float(parameters[0] / fit_factor), *(float(value) for value in parameters[1:])
+    rmse = float(np.sqrt(cost / number_of_samples) / fit_factor)
+
+    print(f"Intensity_0: {intensity_0:.2f}, Gamma: {gamma:.2f}, Delta: {np.rad2deg(delta):.2f}, Theta_0: {np.rad2deg(theta_0):.2f}, Phi_0: {np.rad2deg(phi_0):.2f}, Alpha_0: {np.rad2deg(alpha_0):.2f}")
+
+    return (intensity_0, gamma, delta, theta_0, phi_0, alpha_0), rmse
+
+class _ScaledIntensities:
+    # Scales slices on access so the (possibly memory-mapped) intensities are never copied whole.
+    def __init__(self, intensities, fit_factor):
+        self.intensities = intensities
+        self.fit_factor = fit_factor
+
+    def __getitem__(self, index):
+        return self.intensities[index] * self.fit_factor
+
+def hqwp_map_points(folder, hwp_range=90, qwp_range=180):
+    manifest_path = os.path.join(folder, 'manifest.json')
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as file:
+            manifest = json.load(file)
+        points = [(point['name'], point['hwp'], point['qwp']) for point in manifest['points'] if point['name'] in manifest['completed']]
+    else:
+        # Maps acquired before the manifest: the motor angles are evenly spaced over the file indices.
+        indices = [re.match(r"HWP-(\d{3})_QWP-(\d{3}).npz", ff) for ff in os.listdir(folder)]
+        indices = [(int(match.group(1)), int(match.group(2))) for match in indices if match is not None]
+        hwp_steps = max(hh for hh, _ in indices) + 1
+        qwp_steps = max(qq for _, qq in indices) + 1
+        points = [(f'HWP-{hh:03d}_QWP-{qq:03d}', hh*hwp_range/(hwp_steps-1), qq*qwp_range/(qwp_steps-1)) for hh, qq in sorted(indices)]
+
+    return points
+
+def load_hqwp_map(folder, hwp_range=90, qwp_range=180):
+    points = hqwp_map_points(folder, hwp_range, qwp_range)
+
+    primes = []
+    aggregated_intensities = []
+    for name, hwp, qwp in points:
+        measurement_data = np.load(os.path.join(folder, name + '.npz'))['measurement_data']
+        number_of_angles = measurement_data.shape[1]
+        primes.append(np.deg2rad(np.vstack((np.full(number_of_angles, hwp), np.full(number_of_angles, qwp), measurement_data[0, :]))))
+        aggregated_intensities.append(measurement_data[1, :])
+
+    return np.hstack(primes), np.concatenate(aggregated_intensities)
+
+def load_hqwp_grid(folder, intensities_path=None, hwp_range=90, qwp_range=180):
+    # Full HWP x QWP grid for compute_system_parameters_chunked: the angle axes (radians) and the flat intensities in
+    # create_map order, written to an np.memmap at intensities_path. Points whose analyzer angles differ from the first
+    # point (missed triggers) are interpolated onto its angles.
+    points = hqwp_map_points(folder, hwp_range, qwp_range)
+    hwp_angles = sorted({hwp for _, hwp, _ in points})
+    qwp_angles = sorted({qwp for _, _, qwp in points})
+    if len(points) != len(hwp_angles) * len(qwp_angles):
+        raise ValueError(f'{folder} is not a complete HWP x QWP grid')
+
+    pol_angles = np.load(os.path.join(folder, points[0][0] + '.npz'))['measurement_data'][0]
+    number_of_samples = len(points) * len(pol_angles)
+    if intensities_path is None:
+        intensities = np.empty(number_of_samples)
+    else:
+        intensities = np.memmap(intensities_path, dtype=np.float64, mode='w+', shape=(number_of_samples,))
+
+    for name, hwp, qwp in points:
+        measurement_data = np.load(os.path.join(folder, name + '.npz'))['measurement_data']
+        start = (hwp_angles.index(hwp) * len(qwp_angles) + qwp_angles.index(qwp)) * len(pol_angles)
+        if measurement_data.shape[1] == len(pol_angles) and np.allclose(measurement_data[0], pol_angles):
+            intensities[start:start + len(pol_angles)] = measurement_data[1]
+        else:
+            intensities[start:start + len(pol_angles)] = np.interp(pol_angles, measurement_data[0], measurement_data[1], period=360)
+
+    return np.deg2rad(hwp_angles), np.deg2rad(qwp_angles), np.deg2rad(pol_angles), intensities
+
+def fit_hqwp_map_chunked(folder, max_intensity=10, p0=None, chunk_size=2**18, dtype=np.float64):
+    # Out-of-core fit of a dense map, the intensities go through a temporary memory-mapped file.
+    with tempfile.TemporaryDirectory() as temporary_folder:
+        hwp_angles, qwp_angles, pol_angles, intensities = load_hqwp_grid(folder, os.path.join(temporary_folder, 'intensities.dat'))
+        parameters, rmse = compute_system_parameters_chunked(hwp_angles, qwp_angles, pol_angles, intensities, max_intensity=max_intensity, p0=p0, chunk_size=chunk_size, dtype=dtype)
+
+        number_of_samples = len(intensities)
+        mean_intensity = sum(float(np.sum(intensities[start:start + chunk_size])) for start in range(0, number_of_samples, chunk_size)) / number_of_samples
+        # The memory map has to be released before its folder is removed.
+        del intensities
+
+    return parameters, rmse, rmse / mean_intensity, number_of_samples
+
 def process_hwp_map(folder):
     data_files = [ff for ff in os.listdir(folder) if re.match(r"\d{3}.npz", ff)]
     number_of_files = len(data_files)
@@ -115,7 +467,7 @@ def process_hwp_map(folder):
 
     for ii in range(number_of_files):
         measurement_data = np.load(os.path.join(folder, data_files[ii]))['measurement_data']
-        ellipticity[ii], _, _, _ = compute_polarization_parameters(np.deg2rad(measurement_data[0, :]), measurement_data[1, :])
+        ellipticity[ii], _, _, _, _ = compute_polarization_parameters(np.deg2rad(measurement_data[0, :]), measurement_data[1, :])
 
     return hwp_angles, ellipticity
 
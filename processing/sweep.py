@@ -0,0 +1,44 @@
+import csv
+import os
+
+import numpy as np
+
+from processing.processing import compute_polarization_parameters, compute_polarization_parameters_linear
+
+SWEEP_LOG_FILENAME = 'sweep.csv'
+SWEEP_COLUMNS = ['name', 'started', 'ended', 'hwp_start', 'hwp_end', 'hwp', 'ellipticity', 'e_max', 'alpha_max', 'nrmse', 'missed_triggers']
+
+def read_sweep_log(folder):
+    with open(os.path.join(folder, SWEEP_LOG_FILENAME), 'r', newline='') as file:
+        return list(csv.DictReader(file))
+
+def rebin_hwp_sweep(folder, bin_width_in_deg, max_intensity=10, fast_mode=False):
+    # The revolutions tagged within one HWP bin are pooled and fitted once, so the bin ellipticity uses all
+    # their analyzer samples instead of averaging the ellipticities of the individual revolutions.
+    revolutions = [row for row in read_sweep_log(folder) if os.path.isfile(os.path.join(folder, row['name'] + '.npz'))]
+    if not revolutions:
+        return None
+
+    hwp = np.array([float(row['hwp']) for row in revolutions])
+    bin_indices = np.floor((hwp - hwp.min()) / bin_width_in_deg).astype(int)
+
+    binned = {key: [] for key in ('hwp', 'hwp_min', 'hwp_max', 'ellipticity', 'e_max', 'alpha_max', 'nrmse', 'revolutions')}
+    for bin_index in np.unique(bin_indices):
+        members = np.flatnonzero(bin_indices == bin_index)
+        measurement_data = np.hstack([np.load(os.path.join(folder, revolutions[ii]['name'] + '.npz'))['measurement_data'] for ii in members])
+
+        if fast_mode:
+            ellipticity, e_max, alpha_max, _, nrmse, _ = compute_polarization_parameters_linear(np.deg2rad(measurement_data[0]), measurement_data[1])
+        else:
+            ellipticity, e_max, alpha_max, _, nrmse = compute_polarization_parameters(np.deg2rad(measurement_data[0]), measurement_data[1], max_intensity=max_intensity)
+
+        binned['hwp'].append(hwp[members].mean())
+        binned['hwp_min'].append(min(float(revolutions[ii]['hwp_start']) for ii in members))
+        binned['hwp_max'].append(max(float(revolutions[ii]['hwp_end']) for ii in members))
+        binned['ellipticity'].append(ellipticity)
+        binned['e_max'].append(e_max)
+        binned['alpha_max'].append(alpha_max)
+        binned['nrmse'].append(nrmse)
+        binned['revolutions'].append(len(members))
+
+    return {key: np.array(values) for key, values in binned.items()}
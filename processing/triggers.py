@@ -0,0 +1,94 @@
+import numpy as np
+
+# Longest rising edge, in samples, searched for the sub-sample threshold crossing.
+MAX_EDGE_SAMPLES = 16
+
+def hysteresis_state(signal, low_threshold, high_threshold):
+    # 1 above the high threshold, 0 below the low threshold, and the previous state in between (forward fill).
+    state = np.full(len(signal), -1, dtype=np.int8)
+    state[signal >= high_threshold] = 1
+    state[signal <= low_threshold] = 0
+
+    last_known = np.where(state >= 0, np.arange(len(signal)), 0)
+    np.maximum.accumulate(last_known, out=last_known)
+    state = state[last_known]
+    state[state < 0] = 0
+
+    return state
+
+def rising_edges(signal, low_threshold, high_threshold):
+    # Rising edges with hysteresis, located at the sub-sample crossing of the mid threshold.
+    state = hysteresis_state(signal, low_threshold, high_threshold)
+    edges = np.flatnonzero((state[1:] == 1) & (state[:-1] == 0)) + 1
+    if len(edges) == 0:
+        return np.zeros(0)
+
+    last_low = np.where(signal <= low_threshold, np.arange(len(signal)), 0)
+    np.maximum.accumulate(last_low, out=last_low)
+    starts = np.maximum(last_low[edges], edges - MAX_EDGE_SAMPLES)
+
+    mid_threshold = (low_threshold + high_threshold) / 2
+    window = np.minimum(starts[:, None] + np.arange(MAX_EDGE_SAMPLES + 1), edges[:, None])
+    after = window[np.arange(len(edges)), np.argmax(signal[window] >= mid_threshold, axis=1)]
+    before = np.maximum(after - 1, 0)
+
+    rise = signal[after] - signal[before]
+    fraction = np.divide(mid_threshold - signal[before], rise, out=np.ones(len(edges)), where=rise > 0)
+
+    return before + np.clip(fraction, 0, 1)
+
+def reconstruct_triggers(trigger_times, expected_number_of_triggers, number_of_samples, samples_averaged):
+    # Edges closer than half the median spacing are glitches. Larger gaps are filled with evenly spaced triggers,
+    # and triggers missing at the end are extrapolated while their averaging window still fits in the capture.
+    if len(trigger_times) < 2:
+        return trigger_times, np.zeros(len(trigger_times), dtype=bool)
+
+    spacing = np.median(np.diff(trigger_times))
+    kept = np.concatenate(([True], np.diff(trigger_times) >= spacing / 2))
+    while not np.all(kept):
+        trigger_times = trigger_times[kept]
+        kept = np.concatenate(([True], np.diff(trigger_times) >= spacing / 2))
+
+    gaps = np.diff(trigger_times)
+    segments = np.maximum(np.rint(gaps / spacing).astype(int), 1)
+    offsets = np.arange(segments.sum()) - np.repeat(np.cumsum(segments) - segments, segments)
+    times = np.append(np.repeat(trigger_times[:-1], segments) + offsets * np.repeat(gaps / segments, segments), trigger_times[-1])
+    reconstructed = np.append(offsets > 0, False)
+
+    missing_at_end = expected_number_of_triggers - len(times)
+    if missing_at_end > 0:
+        extrapolated = times[-1] + spacing * np.arange(1, missing_at_end + 1)
+        extrapolated = extrapolated[np.ceil(extrapolated) + samples_averaged <= number_of_samples]
+        times = np.append(times, extrapolated)
+        reconstructed = np.append(reconstructed, np.ones(len(extrapolated), dtype=bool))
+
+    return times[:expected_number_of_triggers], reconstructed[:expected_number_of_triggers]
+
+def extract_signal_at_triggers(trigger_signal, photodiode_signal, interval_in_deg, samples_averaged, low_threshold, high_threshold, reconstruct=True):
+    # The acquisition starts on the first stage trigger, so sample 0 is the trigger at 0 deg.
+    expected_number_of_triggers = int(360/interval_in_deg)
+    number_of_samples = len(photodiode_signal)
+
+    edges = rising_edges(trigger_signal, low_threshold, high_threshold)
+    trigger_times = np.concatenate(([0], edges))
+    if reconstruct:
+        trigger_times, reconstructed = reconstruct_triggers(trigger_times, expected_number_of_triggers, number_of_samples, samples_averaged)
+    else:
+        trigger_times, reconstructed = trigger_times[:expected_number_of_triggers], np.zeros(min(len(trigger_times), expected_number_of_triggers), dtype=bool)
+    trigger_times = trigger_times[np.ceil(trigger_times) + samples_averaged <= number_of_samples]
+    reconstructed = reconstructed[:len(trigger_times)]
+
+    # Angle of every sample, interpolated between the triggers and extrapolated with the mean spacing past the last one.
+    trigger_angles = np.arange(len(trigger_times)) * interval_in_deg
+    sample_indices = np.arange(number_of_samples)
+    sample_angles = np.interp(sample_indices, trigger_times, trigger_angles)
+    if len(trigger_times) > 1:
+        degrees_per_sample = (trigger_angles[-1] - trigger_angles[0]) / (trigger_times[-1] - trigger_times[0])
+        past_last = sample_indices > trigger_times[-1]
+        sample_angles[past_last] = trigger_angles[-1] + (sample_indices[past_last] - trigger_times[-1]) * degrees_per_sample
+
+    # Each value averages the samples_averaged samples following its trigger, at the angle of their center.
+    window = np.ceil(trigger_times).astype(int)[:, None] + np.arange(samples_averaged)
+    data_at_triggers = np.vstack((sample_angles[window].mean(axis=1), photodiode_signal[window].mean(axis=1)))
+
+    return data_at_triggers, sample_angles, int(reconstructed.sum())
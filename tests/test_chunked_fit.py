@@ -0,0 +1,74 @@
+import json
+import os
+
+import numpy as np
+
+from processing.processing import general_intensity, compute_system_parameters, compute_system_parameters_chunked, grid_chunks, load_hqwp_map, load_hqwp_grid, fit_hqwp_map_chunked, is_same_system_solution
+
+
+PARAMETERS = (1.2, 0.85, 0.6, 0.1, -0.2, 0.3)
+
+def small_grid():
+    return np.deg2rad(np.linspace(0, 90, 7)), np.deg2rad(np.linspace(0, 180, 9)), np.deg2rad(np.arange(0, 360, 10))
+
+def grid_primes(hwp_angles, qwp_angles, pol_angles):
+    return np.vstack([axis.ravel() for axis in np.meshgrid(hwp_angles, qwp_angles, pol_angles, indexing='ij')])
+
+def noisy_intensities(primes, seed=0):
+    return general_intensity(primes, *PARAMETERS) + np.random.default_rng(seed).normal(0, 1E-3, primes.shape[1])
+
+def test_grid_chunks_follow_the_create_map_order():
+    axes = small_grid()
+    primes = grid_primes(*axes)
+
+    chunks = list(grid_chunks(*axes, chunk_size=100))
+    assert chunks[-1][1] == primes.shape[1]
+    assert np.array_equal(np.hstack([chunk for _, _, chunk in chunks]), primes)
+
+def test_chunked_fit_matches_the_in_memory_fit():
+    axes = small_grid()
+    primes = grid_primes(*axes)
+    intensities = noisy_intensities(primes)
+
+    parameters = compute_system_parameters(primes, intensities)
+    chunked_parameters, rmse = compute_system_parameters_chunked(*axes, intensities, chunk_size=500)
+
+    assert is_same_system_solution(parameters, chunked_parameters, relative_tolerance=1E-4, angle_tolerance=1E-4)
+    assert is_same_system_solution(PARAMETERS, chunked_parameters, relative_tolerance=1E-2, angle_tolerance=1E-2)
+    assert np.isclose(rmse, np.sqrt(np.mean((intensities - general_intensity(primes, *parameters)) ** 2)), rtol=1E-3)
+
+def write_map(folder, hwp_angles, qwp_angles, pol_angles):
+    points = []
+    for hh, hwp in enumerate(hwp_angles):
+        for qq, qwp in enumerate(qwp_angles):
+            name = f'HWP-{hh:03d}_QWP-{qq:03d}'
+            primes = np.deg2rad(np.vstack((np.full(len(pol_angles), hwp), np.full(len(pol_angles), qwp), pol_angles)))
+            np.savez(os.path.join(folder, name + '.npz'), measurement_data=np.vstack((pol_angles, noisy_intensities(primes, seed=len(points)))))
+            points.append({'name': name, 'hwp': hwp, 'qwp': qwp})
+
+    # Points are listed out of create_map order, as an adaptive design would.
+    points.reverse()
+    with open(os.path.join(folder, 'manifest.json'), 'w') as file:
+        json.dump({'experiment': 'HQWP_mapping', 'parameters': {}, 'points': points, 'completed': {point['name']: True for point in points}}, file)
+
+def test_map_folder_grid_matches_the_loaded_map(tmp_path):
+    hwp_angles, qwp_angles, pol_angles = np.linspace(0, 90, 4), np.linspace(0, 180, 5), np.arange(0, 360, 15.0)
+    write_map(tmp_path, hwp_angles, qwp_angles, pol_angles)
+
+    grid_hwp, grid_qwp, grid_pol, intensities = load_hqwp_grid(tmp_path, os.path.join(tmp_path, 'intensities.dat'))
+    primes, aggregated_intensities = load_hqwp_map(tmp_path)
+
+    assert np.allclose(grid_hwp, np.deg2rad(hwp_angles)) and np.allclose(grid_qwp, np.deg2rad(qwp_angles)) and np.allclose(grid_pol, np.deg2rad(pol_angles))
+    order = np.lexsort((primes[2], primes[1], primes[0]))
+    assert np.allclose(np.asarray(intensities), aggregated_intensities[order])
+
+def test_map_folder_chunked_fit_matches_the_in_memory_fit(tmp_path):
+    write_map(tmp_path, np.linspace(0, 90, 5), np.linspace(0, 180, 7), np.arange(0, 360, 10.0))
+
+    primes, aggregated_intensities = load_hqwp_map(tmp_path)
+    parameters = compute_system_parameters(primes, aggregated_intensities)
+    chunked_parameters, rmse, nrmse, number_of_samples = fit_hqwp_map_chunked(tmp_path, chunk_size=256)
+
+    assert number_of_samples == len(aggregated_intensities)
+    assert is_same_system_solution(parameters, chunked_parameters, relative_tolerance=1E-4, angle_tolerance=1E-4)
+    assert np.isclose(nrmse, rmse / np.mean(aggregated_intensities))
@@ -0,0 +1,81 @@
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+
+from experiments.DataCatalog import DataCatalog
+from experiments.MappingManifest import MappingManifest
+from experiments.TimeSeriesStore import TimeSeriesStore
+
+
+def save_point(folder, name, photodiode=True):
+    arrays = {'measurement_data': np.zeros((2, 36))}
+    if photodiode:
+        arrays |= {'analog_data': np.zeros((2, 1000)), 'calibration_mean': 0.002, 'calibration_std': 0.0001, 'calibration_timestamp': 1.7E9}
+    np.savez(os.path.join(folder, name + '.npz'), **arrays)
+
+def create_hqwp_map(root_folder):
+    folder = os.path.join(root_folder, '20250915T101500Z_HQWP_mapping')
+    os.makedirs(folder)
+    points = [{'name': f'HWP-{hh:03d}_QWP-{qq:03d}', 'hwp': 45.0 * hh, 'qwp': 90.0 * qq} for hh in range(2) for qq in range(2)]
+    manifest = MappingManifest.create(folder, 'HQWP_mapping', {'detector': 'photodiode', 'hwp_mapping_steps': 2, 'qwp_mapping_steps': 2}, points)
+    for point in points[:3]:
+        save_point(folder, point['name'])
+        manifest.mark_completed(point, {})
+
+    return folder, manifest, points
+
+def create_time_lapse(root_folder, timestamps):
+    store = TimeSeriesStore(os.path.join(root_folder, '20250920T080000Z_time_lapse'), 36)
+    for slot, timestamp in enumerate(timestamps):
+        store.append(timestamp, slot, np.zeros((2, 36)), 0.1, 1.0, 0.0, 0.01)
+    store.close()
+
+def test_scan_indexes_maps_legacy_runs_and_time_lapses(tmp_path):
+    create_hqwp_map(tmp_path)
+    legacy_folder = os.path.join(tmp_path, '20240102T030405Z_HWP_mapping')
+    os.makedirs(legacy_folder)
+    for index in range(3):
+        save_point(legacy_folder, f'{index:03d}', photodiode=False)
+    create_time_lapse(tmp_path, [1.758E9, 1.758E9 + 10])
+
+    with DataCatalog(tmp_path) as catalog:
+        assert catalog.scan() == {'indexed_folders': 2, 'removed_files': 0, 'files': 6, 'indexed_time_lapses': 1, 'removed_time_lapses': 0, 'time_lapses': 1}
+
+        hqwp_map, = catalog.runs('HQWP_mapping', detector='Photodiode')
+        assert hqwp_map['started'] == datetime(2025, 9, 15, 10, 15, tzinfo=timezone.utc).timestamp()
+        assert (hqwp_map['hwp_steps'], hqwp_map['qwp_steps'], hqwp_map['number_of_points'], hqwp_map['number_of_files'], hqwp_map['complete']) == (2, 2, 4, 3, 0)
+        files = catalog.files(hqwp_map['folder'])
+        assert [(file['hwp_index'], file['qwp_index'], file['hwp'], file['qwp']) for file in files] == [(0, 0, 0.0, 0.0), (0, 1, 0.0, 90.0), (1, 0, 45.0, 0.0)]
+        assert files[0]['calibration_mean'] == 0.002 and files[0]['analog_samples'] == 1000 and files[0]['acquired'] is not None
+
+        legacy_run, = catalog.runs('HWP_mapping')
+        assert (legacy_run['detector'], legacy_run['hwp_steps'], legacy_run['number_of_files'], legacy_run['complete']) == ('powermeter', 3, 3, None)
+
+        time_lapse, = catalog.runs('time_lapse')
+        assert (time_lapse['number_of_records'], time_lapse['first_timestamp'], time_lapse['last_timestamp']) == (2, 1.758E9, 1.758E9 + 10)
+        september = catalog.runs(since=datetime(2025, 9, 1, tzinfo=timezone.utc), until=datetime(2025, 10, 1, tzinfo=timezone.utc))
+        assert [run['run_type'] for run in september] == ['HQWP_mapping', 'time_lapse']
+
+def test_rescan_only_reindexes_what_changed(tmp_path):
+    folder, manifest, points = create_hqwp_map(tmp_path)
+    create_time_lapse(tmp_path, [1.758E9])
+
+    with DataCatalog(tmp_path) as catalog:
+        catalog.scan()
+        assert catalog.scan() | {'files': None} == {'indexed_folders': 0, 'removed_files': 0, 'files': None, 'indexed_time_lapses': 0, 'removed_time_lapses': 0, 'time_lapses': 1}
+
+        save_point(folder, points[3]['name'])
+        manifest.mark_completed(points[3], {})
+        os.remove(os.path.join(folder, points[0]['name'] + '.npz'))
+        create_time_lapse(tmp_path, [1.758E9 + 60])
+        assert catalog.scan() == {'indexed_folders': 1, 'removed_files': 1, 'files': 3, 'indexed_time_lapses': 1, 'removed_time_lapses': 0, 'time_lapses': 1}
+
+        hqwp_map, = catalog.runs('HQWP_mapping', complete=True)
+        assert hqwp_map['number_of_files'] == 3
+        assert catalog.runs('time_lapse')[0]['last_timestamp'] == 1.758E9 + 60
+
+        for extension in ('.bin', '.json'):
+            os.remove(os.path.join(tmp_path, '20250920T080000Z_time_lapse' + extension))
+        assert catalog.scan()['removed_time_lapses'] == 1
+        assert catalog.runs('time_lapse') == []
@@ -0,0 +1,43 @@
+import numpy as np
+
+from processing.design import cell_information, plan_d_optimal, expected_covariance
+
+
+PARAMETERS = (1.2, 0.85, 0.6, 0.1, -0.2, 0.3)
+
+def small_design():
+    return cell_information(np.linspace(0, 90, 7), np.linspace(0, 180, 9), np.arange(0, 360, 30.0), PARAMETERS)
+
+def log_determinant(cell_informations, selected):
+    return np.linalg.slogdet(np.sum(cell_informations[selected], axis=0))[1]
+
+def test_greedy_selection_completes_the_information():
+    # The strongest cell alone is not enough, the second pick must add the missing direction.
+    cell_informations = np.array([np.diag([10.0, 0]), np.diag([9.0, 0]), np.diag([0, 1.0])])
+
+    assert plan_d_optimal(cell_informations, 2) == [0, 2]
+
+def test_selection_has_distinct_cells_and_is_bounded_by_the_grid():
+    cells, cell_informations = small_design()
+
+    selected = plan_d_optimal(cell_informations, 12)
+    assert len(selected) == 12 and len(set(selected)) == 12
+    assert sorted(plan_d_optimal(cell_informations, 1000)) == list(range(len(cells)))
+
+def test_d_optimal_points_beat_random_points():
+    cells, cell_informations = small_design()
+    selected = plan_d_optimal(cell_informations, 8)
+
+    random_log_determinants = [log_determinant(cell_informations, np.random.default_rng(seed).choice(len(cells), 8, replace=False)) for seed in range(50)]
+    assert log_determinant(cell_informations, selected) >= max(random_log_determinants)
+
+def test_expected_covariance_needs_identifiable_parameters():
+    _, cell_informations = small_design()
+    selected = plan_d_optimal(cell_informations, 8)
+
+    # A single revolution does not separate the six parameters.
+    assert np.all(np.isinf(expected_covariance(cell_informations, selected[:1], 0.01)))
+    covariance = expected_covariance(cell_informations, selected, 0.01)
+    assert np.all(np.isfinite(covariance)) and np.all(np.diag(covariance) > 0)
+    # The covariance scales with the noise variance.
+    assert np.allclose(expected_covariance(cell_informations, selected, 0.02), 4 * covariance)
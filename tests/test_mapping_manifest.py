@@ -0,0 +1,46 @@
+import os
+
+import numpy as np
+import pytest
+
+from experiments.MappingManifest import MappingManifest, ManifestMismatchError
+
+
+POINTS = [{'name': f'HWP-{hh:03d}', 'hwp': 10.0 * hh} for hh in range(5)]
+
+def measure(manifest, name, failures, save=True):
+    point = next(point for point in manifest.points if point['name'] == name)
+    if save:
+        np.savez(manifest.point_path(point) + '.npz', measurement_data=np.zeros((2, 4)))
+        manifest.mark_completed(point, {'quality_passed': not failures})
+    manifest.record_quality(point, {'ellipticity': 0.1, 'nrmse': 0.01, 'missed_triggers': 0}, failures)
+
+def names(points):
+    return [point['name'] for point in points]
+
+def test_points_to_measure_are_the_missing_and_the_failed_points(tmp_path):
+    manifest = MappingManifest.create(str(tmp_path), 'HWP_mapping', {'detector': 'photodiode'}, POINTS)
+    measure(manifest, 'HWP-000', [])
+    measure(manifest, 'HWP-001', ['nrmse'])
+    measure(manifest, 'HWP-002', ['missed_triggers'])
+    measure(manifest, 'HWP-002', [])
+    measure(manifest, 'HWP-003', ['analog_data'], save=False)
+
+    assert names(manifest.points_to_measure()) == ['HWP-001', 'HWP-003', 'HWP-004']
+    assert names(manifest.missing_points()) == ['HWP-003', 'HWP-004']
+    # The order of the plan is kept, and the state survives a reload.
+    assert names(MappingManifest.load(str(tmp_path)).points_to_measure()) == ['HWP-001', 'HWP-003', 'HWP-004']
+
+def test_validate_requeues_completed_points_without_data(tmp_path):
+    manifest = MappingManifest.create(str(tmp_path), 'HWP_mapping', {'detector': 'photodiode'}, POINTS)
+    for point in POINTS:
+        measure(manifest, point['name'], [])
+    os.remove(os.path.join(tmp_path, 'HWP-002.npz'))
+    assert manifest.points_to_measure() == []
+
+    manifest.validate('photodiode')
+    assert names(manifest.points_to_measure()) == ['HWP-002']
+    assert not manifest.is_complete()
+
+    with pytest.raises(ManifestMismatchError):
+        manifest.validate('powermeter')
@@ -0,0 +1,42 @@
+import csv
+import os
+
+import numpy as np
+
+from processing.sweep import SWEEP_COLUMNS, SWEEP_LOG_FILENAME, rebin_hwp_sweep
+
+
+def write_sweep(folder, revolutions, saved=None):
+    # revolutions: (hwp_start, hwp_end, ellipticity), each saved as a noise-free analyzer revolution.
+    with open(os.path.join(folder, SWEEP_LOG_FILENAME), 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=SWEEP_COLUMNS)
+        writer.writeheader()
+        for ii, (hwp_start, hwp_end, ellipticity) in enumerate(revolutions):
+            name = f'REV-{ii:05d}'
+            angles = np.arange(0, 360, 10.0) + ii
+            intensity = np.cos(np.deg2rad(angles - 30))**2 + ellipticity**2 * np.sin(np.deg2rad(angles - 30))**2
+            if saved is None or ii in saved:
+                np.savez(os.path.join(folder, name + '.npz'), measurement_data=np.vstack((angles, intensity)))
+            writer.writerow({'name': name, 'hwp_start': hwp_start, 'hwp_end': hwp_end, 'hwp': (hwp_start + hwp_end) / 2, 'ellipticity': ellipticity})
+
+def test_revolutions_are_pooled_per_hwp_bin(tmp_path):
+    write_sweep(tmp_path, [(0.0, 0.2, 0.1), (0.3, 0.5, 0.1), (0.8, 1.0, 0.1), (1.2, 1.4, 0.3), (1.6, 1.8, 0.3), (3.4, 3.6, 0.5)])
+
+    binned = rebin_hwp_sweep(tmp_path, 1)
+
+    assert list(binned['revolutions']) == [3, 2, 1]
+    assert np.allclose(binned['hwp'], [1.4 / 3, 1.5, 3.5])
+    assert np.allclose(binned['hwp_min'], [0.0, 1.2, 3.4]) and np.allclose(binned['hwp_max'], [1.0, 1.8, 3.6])
+    assert np.allclose(binned['ellipticity'], [0.1, 0.3, 0.5], atol=1E-4)
+    assert np.allclose(binned['alpha_max'], np.deg2rad(30), atol=1E-4)
+
+def test_revolutions_without_data_are_skipped(tmp_path):
+    write_sweep(tmp_path, [(0.0, 0.2, 0.1), (0.3, 0.5, 0.1), (1.2, 1.4, 0.3)], saved={0, 2})
+
+    binned = rebin_hwp_sweep(tmp_path, 1)
+    assert list(binned['revolutions']) == [1, 1]
+
+    for name in os.listdir(tmp_path):
+        if name.endswith('.npz'):
+            os.remove(os.path.join(tmp_path, name))
+    assert rebin_hwp_sweep(tmp_path, 1) is None
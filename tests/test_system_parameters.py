@@ -0,0 +1,64 @@
+import numpy as np
+
+from processing.processing import general_intensity, canonical_system_parameters, mirrored_system_parameters, is_same_system_solution, closest_system_parameters, compute_system_parameters_multistart
+
+
+def random_primes(number_of_samples=2000, seed=0):
+    return np.random.default_rng(seed).uniform(-np.pi, np.pi, (3, number_of_samples))
+
+def test_mirrored_parameters_give_the_same_intensity():
+    primes = random_primes()
+    parameters = (2.0, 1.3, 0.7, 0.2, 0.3, 0.4)
+
+    assert np.allclose(general_intensity(primes, *parameters), general_intensity(primes, *mirrored_system_parameters(*parameters)), rtol=0, atol=1E-12)
+
+def test_gamma_inversion_collapses_to_one_canonical_form():
+    parameters = (2.0, 1.3, 0.7, 0.2, 0.3, 0.4)
+    mirrored = (2.0 * 1.3**2, 1 / 1.3, -0.7, 0.2 + np.pi/4, 0.3, 0.4 - np.pi/2)
+
+    canonical = canonical_system_parameters(*parameters)
+    assert canonical[1] <= 1
+    assert np.allclose(canonical, canonical_system_parameters(*mirrored))
+    assert is_same_system_solution(parameters, mirrored)
+
+def test_canonical_form_keeps_the_model():
+    primes = random_primes()
+    for parameters in [(1.5, 0.8, -2.5, 1.9, -2.8, 3.0), (0.5, 3.2, 2.0, -1.1, 0.4, -0.2), (1.0, 1.0, -0.1, 0.0, 0.0, 0.0)]:
+        canonical = canonical_system_parameters(*parameters)
+
+        assert canonical[1] <= 1 and canonical[2] >= 0
+        assert np.allclose(general_intensity(primes, *parameters), general_intensity(primes, *canonical), rtol=0, atol=1E-12)
+
+def test_delta_sign_and_periods_collapse():
+    parameters = (1.0, 0.7, 0.5, 0.1, 0.2, 0.3)
+
+    assert is_same_system_solution(parameters, (1.0, 0.7, -0.5, 0.1 + np.pi/2, 0.2 + np.pi/2, 0.3 - np.pi))
+
+def test_solutions_on_either_side_of_gamma_one_are_the_same():
+    parameters = (1.0, 1 - 1E-5, 0.5, 0.1, 0.2, 0.3)
+
+    assert is_same_system_solution(parameters, mirrored_system_parameters(*parameters))
+
+def test_closest_form_does_not_jump_across_gamma_one():
+    previous = canonical_system_parameters(1.0, 1.0005, 0.3, 0.1, 0.2, 0.15)
+
+    for gamma in (0.9995, 1.0004, 1.3):
+        closest = closest_system_parameters(mirrored_system_parameters(1.0, gamma, 0.3, 0.1, 0.2, 0.15), previous)
+        assert np.allclose(closest[2:], previous[2:], atol=1E-9)
+
+def test_different_solutions_are_kept_apart():
+    assert not is_same_system_solution((1.0, 0.7, 0.5, 0.1, 0.2, 0.3), (1.0, 0.7, 0.5, 0.4, 0.2, 0.3))
+    assert not is_same_system_solution((1.0, 0.7, 0.5, 0.1, 0.2, 0.3), (1.0, 0.5, 0.5, 0.1, 0.2, 0.3))
+
+def test_multistart_merges_equivalent_solutions():
+    primes = random_primes(1000)
+    parameters = (1.2, 0.9, 0.6, 0.1, -0.2, 0.3)
+    intensities = general_intensity(primes, *parameters)
+
+    best, solutions = compute_system_parameters_multistart(primes, intensities, number_of_starts=8, max_workers=2)
+
+    # Noise-free data: every start lands on a form of the true solution and they are counted as one.
+    assert is_same_system_solution(best, parameters)
+    assert solutions[0]['starts'] > 1 and sum(solution['starts'] for solution in solutions) <= 8
+    for ii, solution in enumerate(solutions):
+        assert not any(is_same_system_solution(solution['parameters'], other['parameters']) for other in solutions[ii + 1:])
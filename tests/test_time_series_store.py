@@ -0,0 +1,54 @@
+import json
+
+import numpy as np
+import pytest
+
+from experiments.TimeSeriesStore import TimeSeriesStore
+
+
+def measurement(number_of_angles, offset=0.0):
+    angles = np.linspace(0, 360, number_of_angles, endpoint=False)
+
+    return np.vstack((angles, np.cos(np.deg2rad(angles))**2 + offset))
+
+def test_records_round_trip(tmp_path):
+    path = str(tmp_path / 'store')
+    store = TimeSeriesStore(path, 8)
+    store.append(1000.25, 0, measurement(8), 0.1, 2.0, 30.0, 0.01, missed_triggers=1, scheduled=1000.0)
+    store.append(1010.5, 1, measurement(6, 0.5), 0.2, 2.1, 31.0, 0.02, scheduled=1010.0)
+    store.close()
+
+    records = TimeSeriesStore.read(path)
+    assert len(records) == 2
+    assert np.allclose(records['timestamp'], [1000.25, 1010.5])
+    assert np.allclose(records['scheduled'], [1000.0, 1010.0])
+    assert list(records['slot']) == [0, 1] and list(records['missed_triggers']) == [1, 0]
+    assert np.allclose(records[0]['intensity'], measurement(8)[1])
+    # Shorter measurements are padded with NaN.
+    assert np.allclose(records[1]['angles'][:6], measurement(6)[0]) and np.all(np.isnan(records[1]['intensity'][6:]))
+
+def test_missed_slots_are_the_gaps_between_records(tmp_path):
+    path = str(tmp_path / 'store')
+    store = TimeSeriesStore(path, 4)
+    for slot in [2, 3, 5, 8]:
+        store.append(float(slot), slot, measurement(4), 0, 0, 0, 0)
+    store.close()
+
+    assert list(TimeSeriesStore.missed_slots(TimeSeriesStore.read(path))) == [4, 6, 7]
+    assert len(TimeSeriesStore.missed_slots(np.zeros(0, dtype=TimeSeriesStore.record_dtype(4)))) == 0
+
+def test_stores_without_a_field_are_read_with_their_header(tmp_path):
+    path = str(tmp_path / 'store')
+    fields = [name for name, _ in TimeSeriesStore.FIELDS if name != 'scheduled']
+    record = np.zeros(1, dtype=TimeSeriesStore.record_dtype(4, fields))
+    record['timestamp'] = 5.0
+    record['slot'] = 3
+    with open(path + '.json', 'w') as file:
+        json.dump({'number_of_angles': 4, 'fields': fields}, file)
+    with open(path + '.bin', 'wb') as file:
+        file.write(record.tobytes())
+
+    records = TimeSeriesStore.read(path)
+    assert records['timestamp'][0] == 5.0 and records['slot'][0] == 3
+    with pytest.raises(ValueError):
+        TimeSeriesStore(path, 4)
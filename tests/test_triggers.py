@@ -0,0 +1,62 @@
+import numpy as np
+
+from processing.triggers import hysteresis_state, rising_edges, reconstruct_triggers, extract_signal_at_triggers
+
+
+def trigger_train(trigger_times, number_of_samples, pulse_samples=5, rise_samples=2):
+    # Trapezoidal 0-5V pulses starting at the (fractional) trigger times.
+    samples = np.arange(number_of_samples)
+    signal = np.zeros(number_of_samples)
+    for time in trigger_times:
+        rising = np.clip((samples - time) / rise_samples, 0, 1)
+        falling = np.clip((time + pulse_samples - samples) / rise_samples, 0, 1)
+        signal = np.maximum(signal, 5 * np.minimum(rising, falling))
+
+    return signal
+
+def test_hysteresis_holds_the_state_between_the_thresholds():
+    signal = np.array([0.5, 1.5, 2.5, 3.5, 2.0, 1.5, 0.9, 2.0, 3.0])
+
+    assert list(hysteresis_state(signal, 1, 3)) == [0, 0, 0, 1, 1, 1, 0, 0, 1]
+
+def test_noise_between_the_thresholds_gives_a_single_edge():
+    signal = np.array([0, 0, 2.9, 1.1, 2.9, 1.1, 3.5, 2.0, 3.5, 0, 0])
+
+    assert len(rising_edges(signal, 1, 3)) == 1
+
+def test_edges_are_located_at_the_sub_sample_mid_crossing():
+    true_times = np.array([10.3, 40.7, 70.0])
+    signal = trigger_train(true_times, 100, rise_samples=2)
+
+    # The mid threshold (2.5V) is crossed one sample after the start of a 2-sample rise.
+    assert np.allclose(rising_edges(signal, 1, 4), true_times + 1, atol=1E-9)
+
+def test_reconstruction_drops_glitches_and_fills_gaps():
+    trigger_times = np.array([0, 10, 20, 21, 30, 60, 70.0])
+
+    times, reconstructed = reconstruct_triggers(trigger_times, 10, 200, 3)
+
+    assert np.allclose(times, np.arange(10) * 10)
+    assert list(np.flatnonzero(reconstructed)) == [4, 5, 8, 9]
+
+def test_reconstruction_only_extrapolates_triggers_that_fit():
+    times, reconstructed = reconstruct_triggers(np.arange(5) * 10.0, 10, 65, 3)
+
+    assert np.allclose(times, np.arange(7) * 10)
+    assert list(reconstructed) == [False] * 5 + [True] * 2
+
+def test_extracted_signal_recovers_a_missed_trigger():
+    interval_in_deg, samples_averaged, spacing = 30, 3, 20
+    true_times = np.arange(360 // interval_in_deg) * spacing
+    # Sample 0 is the first trigger and the fifth is missed. The mid threshold is crossed half a sample into each
+    # 1-sample rise, exactly on the trigger times.
+    trigger_signal = trigger_train(np.delete(true_times, [0, 4]) - 0.5, 12 * spacing, rise_samples=1)
+    photodiode_signal = np.arange(12 * spacing, dtype=float)
+
+    data_at_triggers, sample_angles, number_reconstructed = extract_signal_at_triggers(trigger_signal, photodiode_signal, interval_in_deg, samples_averaged, 1, 4)
+
+    assert number_reconstructed == 1
+    assert np.allclose(sample_angles[true_times], np.arange(12) * interval_in_deg)
+    # Each value averages the three samples from its trigger on.
+    assert np.allclose(data_at_triggers[0], np.arange(12) * interval_in_deg + interval_in_deg / spacing)
+    assert np.allclose(data_at_triggers[1], true_times + 1)